@@ -1,57 +1,179 @@
+import argparse
 import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
 import torch
-import pandas as pd
 
-# Specify the parent directory containing the study subfolders
-parent_directory = '/directed_evolution/esm-extract/results_means/'
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'grid_search'))
+from embedding_store import open_store, store_paths, write_store_index
+
+# Concatenates the per-variant .pt files written by extract.py into one binary embedding store per study/model:
+#   {output_directory}/{study}_{model}.npy           float32 matrix, one row of mean embeddings per variant
+#   {output_directory}/{study}_{model}_variants.txt  the variant of each row (sorted)
+#   {output_directory}/{study}_{model}.json          dtype, shape and metadata
+# This is the layout grid_search/embedding_store.py writes and read_data opens with --file_type npys, written with its
+# write_store_index: the new matrix replaces the old one, then the metadata and the variant index, so a crash in
+# between leaves a store that fails to open (or to be extended with --incremental) instead of a misaligned one.
+# Rows are labeled with the 'label' of each .pt file, like the csv of older versions. extract.py names every file after
+# its label, so the file names tell which variants are new for --incremental.
+
+# Create the parser for the command line arguments
+def create_parser():
+    parser = argparse.ArgumentParser(description="Concatenate per-variant ESM mean embeddings into a binary embedding store.")
+    parser.add_argument("--parent_directory", type=str, default='/directed_evolution/esm-extract/results_means/',
+                        help="Directory containing the study subfolders, each with one subfolder of .pt files per model")
+    parser.add_argument("--output_directory", type=str, default='/directed_evolution/esm-extract/results_means/npys/',
+                        help="Output directory for the embedding stores")
+    parser.add_argument("--studies", type=str, nargs="+", default=['brenan'], help="Study subfolders to concatenate. Example: brenan stiffler")
+    parser.add_argument("--num_workers", type=int, default=8, help="Number of threads loading .pt files. Default: 8")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Only load the .pt files of variants that are not in an existing store yet (e.g. after extending the FASTA)")
+    parser.add_argument("--write_csv", action="store_true", help="Also write the matrix as a csv, as older versions of this script did")
+    return parser
+
+# Function to list all .pt files of a model subfolder, keyed by variant label (the file name written by extract.py)
+def discover_files(model_folder_path):
+    files = {}
+    for r, d, f in os.walk(model_folder_path):
+        for file in f:
+            if file.endswith('.pt'):
+                file_path = os.path.join(r, file)
+                label = os.path.relpath(file_path, model_folder_path)[:-len('.pt')]
+                files[label] = file_path
+    return files
+
+# Function to load the label and the mean representation (as a float32 vector) of one .pt file
+def load_mean_representation(file_path):
+    file_data = torch.load(file_path)
+    # Extract the single key-value pair from representations
+    key, tensor = file_data['mean_representations'].popitem()
+    return file_data['label'], tensor.numpy().astype(np.float32, copy=False)
+
+# Function to load .pt files on a thread pool and write each one into its row of the matrix, returns their labels
+def fill_rows(matrix, rows, file_paths, num_workers):
+    def load_row(row_and_path):
+        row, file_path = row_and_path
+        label, matrix[row] = load_mean_representation(file_path)
+        return label
+
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        # consume the iterator so that exceptions in the threads are raised here
+        return list(executor.map(load_row, zip(rows, file_paths)))
+
+# Function to read the variants of an existing store (checked against its matrix)
+def read_store_variants(prefix):
+    _, variants, _ = open_store(prefix)
+    return variants
+
+# Function to sort the rows of a temporary matrix by their labels, when the labels of the files are not their names
+def sort_rows(matrix_path, labels):
+    order = np.argsort(np.asarray(labels, dtype=object), kind='stable')
+    matrix = np.load(matrix_path, mmap_mode='r')
+    sorted_matrix = np.lib.format.open_memmap(matrix_path + '.sorted', mode='w+', dtype=matrix.dtype, shape=matrix.shape)
+    for start in range(0, len(order), 4096):
+        sorted_matrix[start:start + 4096] = matrix[order[start:start + 4096]]
+    sorted_matrix.flush()
+    del matrix, sorted_matrix
+    os.replace(matrix_path + '.sorted', matrix_path)
+    return [labels[i] for i in order]
+
+# Function to concatenate the .pt files of one model subfolder into a store
+def concatenate_model(model_folder_path, prefix, num_workers=8, incremental=False):
+    # Discover the files once
+    files = discover_files(model_folder_path)
+    if len(files) == 0:
+        return
+
+    # Variants already in the store are kept, only new files are loaded
+    matrix_path, _, _ = store_paths(prefix)
+    old_variants = []
+    if incremental and os.path.exists(matrix_path):
+        old_variants = read_store_variants(prefix)
+    new_labels = sorted(set(files) - set(old_variants))
+    if len(new_labels) == 0:
+        print(f"{prefix}: no new variants")
+        return
 
-# Specify the output directory
-output_directory = '/directed_evolution/esm-extract/results_means/csvs/'
+    # Preallocate the float32 matrix, rows sorted by variant
+    variants = sorted(set(old_variants) | set(new_labels))
+    row_of = {variant: row for row, variant in enumerate(variants)}
+    width = load_mean_representation(files[new_labels[0]])[1].shape[0]
+    matrix = np.lib.format.open_memmap(matrix_path + '.tmp', mode='w+', dtype=np.float32, shape=(len(variants), width))
 
-# Iterate over each study subfolder in the parent directory
-for study_folder_name in os.listdir(parent_directory):
-    if study_folder_name == 'brenan':  # Filter for the 'sarkisyan' dataset
-        study_folder_path = os.path.join(parent_directory, study_folder_name)
+    # Copy the rows of the existing store
+    if len(old_variants) > 0:
+        old_matrix = np.load(matrix_path, mmap_mode='r')
+        if old_matrix.shape[1] != width:
+            raise ValueError(f"{prefix}: existing store has width {old_matrix.shape[1]}, new files have width {width}")
+        old_rows = np.array([row_of[variant] for variant in old_variants])
+        for start in range(0, len(old_rows), 4096):
+            matrix[old_rows[start:start + 4096]] = old_matrix[start:start + 4096]
+        del old_matrix
+
+    # Load the new files in parallel, straight into the rows of their names
+    new_rows = [row_of[label] for label in new_labels]
+    file_labels = fill_rows(matrix, new_rows, [files[label] for label in new_labels], num_workers)
+    matrix.flush()
+    shape = matrix.shape
+    del matrix
+
+    # label the rows with the labels in the files, sorting them again if a file is not named after its label
+    labels = list(variants)
+    for row, label in zip(new_rows, file_labels):
+        labels[row] = label
+    if labels != variants:
+        if len(set(labels)) != len(labels):
+            os.remove(matrix_path + '.tmp')
+            duplicate = next(label for label in labels if labels.count(label) > 1)
+            raise ValueError(f"{prefix}: several rows are labeled {duplicate} (run without --incremental if files were renamed)")
+        variants = sort_rows(matrix_path + '.tmp', labels)
+
+    # matrix first, index last: a crash in between leaves a store that fails to open, not a misaligned one
+    os.replace(matrix_path + '.tmp', matrix_path)
+    write_store_index(prefix, variants, shape, np.float32, {'embeddings': [0, shape[1]]}, source='csvs')
+    print(f"{prefix}: {len(new_labels)} new variants, {len(variants)} total")
+
+# Function to write a store as a csv (index = variant), as older versions of this script did
+def write_csv(prefix, output_path):
+    import pandas as pd
+
+    matrix, variants, _ = open_store(prefix)
+    header = True
+    with open(output_path, 'w') as f:
+        for start in range(0, len(variants), 4096):
+            chunk = pd.DataFrame(matrix[start:start + 4096], index=variants[start:start + 4096])
+            chunk.to_csv(f, header=header)
+            header = False
+
+def main():
+    parser = create_parser()
+    args = parser.parse_args()
+    os.makedirs(args.output_directory, exist_ok=True)
+
+    # Iterate over each study subfolder in the parent directory
+    for study_folder_name in args.studies:
+        study_folder_path = os.path.join(args.parent_directory, study_folder_name)
 
         # Skip non-directory items
         if not os.path.isdir(study_folder_path):
             continue
 
         # Iterate over the model subfolders within the study subfolder
-        for model_folder_name in os.listdir(study_folder_path):
+        for model_folder_name in sorted(os.listdir(study_folder_path)):
             model_folder_path = os.path.join(study_folder_path, model_folder_name)
 
             # Skip non-directory items
             if not os.path.isdir(model_folder_path):
                 continue
 
-            # Create an empty dataframe
-            dataframe = pd.DataFrame()
-
-            # List all .pt files in the model subfolder
-            files = []
-            for r, d, f in os.walk(model_folder_path):
-                for file in f:
-                    if file.endswith('.pt'):
-                        files.append(os.path.join(r, file))
-
-            # Iterate over each file in the model subfolder
-            for file_path in files:
-                file_data = torch.load(file_path)  # Load the file data
-                label = file_data['label']  # Extract the label
-                representations = file_data['mean_representations']  # Extract the mean representations
-
-                # Extract the single key-value pair from representations
-                key, tensor = representations.popitem()
-
-                row_name = label  # Unique row name with label and model name
-                row_data = tensor.tolist()  # Convert the tensor to a list
-                new_row = pd.DataFrame([row_data], index=[row_name])
+            # Save the store with the study and model names
+            prefix = os.path.join(args.output_directory, f"{study_folder_name}_{model_folder_name}")
+            concatenate_model(model_folder_path, prefix, num_workers=args.num_workers, incremental=args.incremental)
 
-                # Append the new row to the dataframe
-                dataframe = dataframe.append(new_row)
+            if args.write_csv and os.path.exists(store_paths(prefix)[0]):
+                write_csv(prefix, prefix + '.csv')
 
-            # Save the dataframe as a CSV file with the study and model names
-            output_filename = f"{study_folder_name}_{model_folder_name}.csv"
-            output_path = os.path.join(output_directory, output_filename)
-            dataframe.to_csv(output_path)
+if __name__ == "__main__":
+    main()
@@ -7,7 +7,7 @@
 #SBATCH -n 1 
 #SBATCH -N 1   
 ##SBATCH --gres=gpu:1
-#SBATCH --cpus-per-task=1  
+#SBATCH --cpus-per-task=8  
 ##SBATCH --constraint=high-capacity    
 #SBATCH --mem=4gb  
 #SBATCH --output /om/group/abugoot/Projects/Matteo/esm-extract/out/concatenate_new-%j.out 
@@ -15,4 +15,4 @@
 source ~/.bashrc
 conda activate embeddings
 
-python3 concatenate.py
\ No newline at end of file
+python3 concatenate.py --studies brenan --num_workers ${SLURM_CPUS_PER_TASK:-8}
\ No newline at end of file
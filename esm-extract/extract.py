@@ -5,12 +5,23 @@
 # LICENSE file in the root directory of this source tree.
 
 import argparse
+import contextlib
+import json
+import os
 import pathlib
+import queue
+import sys
+import threading
+import time
 
+import numpy as np
 import torch
 
 from esm import Alphabet, FastaBatchedDataset, ProteinBertModel, pretrained, MSATransformer
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "grid_search"))
+from embedding_store import store_paths, write_store_index
+
 
 def create_parser():
     parser = argparse.ArgumentParser(
@@ -46,8 +57,7 @@ def create_parser():
         type=str,
         nargs="+",
         choices=["mean", "per_tok", "bos", "contacts"],
-        help="specify which representations to return",
-        required=True,
+        help="specify which representations to return (required unless --mutant_scan is used)",
     )
     parser.add_argument(
         "--truncation_seq_length",
@@ -57,22 +67,423 @@ def create_parser():
     )
 
     parser.add_argument("--nogpu", action="store_true", help="Do not use GPU even if available")
+    parser.add_argument(
+        "--output_format",
+        type=str,
+        default="pt",
+        choices=["pt", "shards"],
+        help="pt: one {label}.pt file per sequence. shards: append the mean/bos representations of every batch "
+        "to one array file per layer ({kind}_{layer}.npy plus a variant index), written on a background thread",
+    )
+    parser.add_argument(
+        "--cpu_precision",
+        type=str,
+        default="fp32",
+        choices=["fp32", "bf16", "int8"],
+        help="precision of the forward pass on CPU: bf16 autocast, or int8 dynamic quantization of the linear layers "
+        "(ignored on GPU)",
+    )
+    parser.add_argument("--num_threads", type=int, default=None, help="intra-op threads of torch on CPU")
+    parser.add_argument("--num_interop_threads", type=int, default=None, help="inter-op threads of torch on CPU")
+    parser.add_argument(
+        "--length_buckets",
+        action="store_true",
+        help="batch only sequences of the same length, so that no batch is padded",
+    )
+    parser.add_argument(
+        "--validate_batches",
+        type=int,
+        default=0,
+        help="with --cpu_precision bf16/int8, also run the first N batches (of the scan with --mutant_scan) in fp32 and "
+        "fail if a mean representation differs from fp32 by more than --validate_tolerance",
+    )
+    parser.add_argument(
+        "--validate_tolerance",
+        type=float,
+        default=0.05,
+        help="maximum ||mean - mean_fp32|| / ||mean_fp32|| accepted by --validate_batches",
+    )
+    parser.add_argument(
+        "--mutant_scan",
+        type=pathlib.Path,
+        default=None,
+        help="variant list (one substitution like A2C per line, or a labels csv with a 'variant' column). "
+        "fasta_file is then the WT FASTA. With --scan_mode exact, output_dir/mutant_scan.pt holds the "
+        "{'average', 'mutated'} embeddings per variant read by grid_search.py --file_type pts",
+    )
+    parser.add_argument(
+        "--scan_mode",
+        type=str,
+        default="exact",
+        choices=["exact", "masked_marginal"],
+        help="exact: embeddings, one forward pass per distinct mutant sequence, i.e. one per single substitution: no "
+        "faster than extracting the mutant FASTA, it only saves the per-variant files. masked_marginal: scores only, one "
+        "forward pass per mutated position with that position masked, giving the masked-marginal score "
+        "log p(mut) - log p(wt) of each variant in output_dir/mutant_scan_scores.csv (no embeddings: the "
+        "substitutions at a position would share them)",
+    )
+    parser.add_argument(
+        "--recover_shards",
+        action="store_true",
+        help="turn the raw files left in output_dir by an interrupted --output_format shards run into stores of the "
+        "sequences written so far, without loading the model (model_location and fasta_file are ignored)",
+    )
+    parser.add_argument(
+        "--shard_batches",
+        type=int,
+        default=1,
+        help="number of batches buffered before they are handed to the writer thread (shards output only)",
+    )
     return parser
 
 
+# Raw files of a shards run: the labels of the rows written so far and the width of each (kind, layer) file
+SHARD_LABELS = "shards_labels.txt"
+SHARD_WIDTHS = "shards_widths.json"
+
+
+class ShardWriter:
+    """Appends batches of representations to one growing raw float32 file per (kind, layer) on a
+    background thread, so writing overlaps with the next forward pass. The labels are appended to
+    shards_labels.txt after the rows of every batch, so the raw files of a killed run can still be
+    turned into stores with build_shard_stores. close() does that for the whole run."""
+
+    def __init__(self, output_dir, max_pending=2):
+        self.output_dir = output_dir
+        self.widths = {}
+        self.files = {}
+        self.labels_file = None
+        self.error = None
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            if self.error is not None:
+                continue
+            try:
+                self._write(*item)
+            except Exception as e:
+                self.error = e
+
+    def _write(self, labels, arrays):
+        if self.labels_file is None:
+            self.widths = {name: array.shape[1] for name, array in arrays.items()}
+            self.files = {name: open(self.output_dir / f"{name}.bin", "wb") for name in arrays}
+            with open(self.output_dir / SHARD_WIDTHS, "w") as widths_file:
+                json.dump(self.widths, widths_file)
+            self.labels_file = open(self.output_dir / SHARD_LABELS, "w")
+        for name, array in arrays.items():
+            self.files[name].write(np.ascontiguousarray(array, dtype=np.float32).tobytes())
+            self.files[name].flush()
+        # labels last, so every listed label has its row in every raw file
+        self.labels_file.write("".join(f"{label}\n" for label in labels))
+        self.labels_file.flush()
+
+    def append(self, labels, arrays):
+        if self.error is not None:
+            raise self.error
+        # blocks when the writer is max_pending batches behind
+        self.queue.put((labels, arrays))
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        for f in self.files.values():
+            f.close()
+        if self.labels_file is not None:
+            self.labels_file.close()
+        if self.error is not None:
+            raise self.error
+        if self.labels_file is None:
+            return 0
+        return build_shard_stores(self.output_dir)
+
+
+def build_shard_stores(output_dir):
+    """Turns the raw files of a shards run into one binary embedding store per (kind, layer)
+    (.npy matrix with rows sorted by label, _variants.txt, .json), the layout read by grid_search.py
+    with --file_type npys. Rows past the last label (a batch cut short by a crash) are dropped. Each
+    store is written through embedding_store.write_store_index, matrix first and index last.
+    Returns the number of sequences in the stores."""
+    with open(output_dir / SHARD_WIDTHS) as widths_file:
+        widths = json.load(widths_file)
+    with open(output_dir / SHARD_LABELS) as labels_file:
+        labels = labels_file.read().splitlines()
+
+    order = np.argsort(np.asarray(labels, dtype=object), kind="stable")
+    sorted_labels = [labels[i] for i in order]
+    for name, width in widths.items():
+        raw_path = output_dir / f"{name}.bin"
+        if os.path.getsize(raw_path) < len(labels) * width * 4:
+            raise ValueError(f"{raw_path} holds fewer rows than {SHARD_LABELS}")
+        shape = (len(labels), width)
+        raw = np.memmap(raw_path, dtype=np.float32, mode="r", shape=shape)
+        matrix_path, _, _ = store_paths(str(output_dir / name))
+        matrix = np.lib.format.open_memmap(matrix_path + ".tmp", mode="w+", dtype=np.float32, shape=shape)
+        for start in range(0, shape[0], 4096):
+            matrix[start : start + 4096] = raw[order[start : start + 4096]]
+        matrix.flush()
+        del raw, matrix
+        os.replace(matrix_path + ".tmp", matrix_path)
+        write_store_index(str(output_dir / name), sorted_labels, shape, np.float32, {"embeddings": [0, width]}, source="shards")
+        os.remove(raw_path)
+
+    os.remove(output_dir / SHARD_LABELS)
+    os.remove(output_dir / SHARD_WIDTHS)
+    return len(labels)
+
+
+def configure_cpu(args):
+    """Sets the torch thread pools, before any parallel work is started."""
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+    if args.num_interop_threads is not None:
+        torch.set_num_interop_threads(args.num_interop_threads)
+    print(f"Using {torch.get_num_threads()} intra-op and {torch.get_num_interop_threads()} inter-op threads")
+
+
+def quantize_model(model):
+    """Returns a copy of the model with int8 dynamically quantized linear layers, for CPU inference."""
+    return torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+
+def check_cpu_precision(cpu_precision):
+    """Fails early if the installed torch cannot run cpu_precision (CPU autocast needs torch>=1.10)."""
+    if cpu_precision == "bf16" and not hasattr(torch, "autocast"):
+        raise ValueError(
+            f"--cpu_precision bf16 needs CPU autocast (torch>=1.10), but torch {torch.__version__} is installed. "
+            "Use --cpu_precision int8 or fp32, or a newer torch."
+        )
+
+
+def precision_context(cpu_precision, use_gpu):
+    """bf16 autocast on CPU, fp32 otherwise (int8 is applied to the model itself)."""
+    if cpu_precision == "bf16" and not use_gpu:
+        return torch.autocast(device_type="cpu", dtype=torch.bfloat16)
+    return contextlib.nullcontext()
+
+
+def get_length_bucket_indices(dataset, toks_per_batch, extra_toks_per_seq=1):
+    """Like FastaBatchedDataset.get_batch_indices, but a batch only holds sequences of one length."""
+    buckets = {}
+    for i, seq in enumerate(dataset.sequence_strs):
+        buckets.setdefault(len(seq), []).append(i)
+    batches = []
+    for length in sorted(buckets):
+        batch_size = max(1, toks_per_batch // (length + extra_toks_per_seq))
+        indices = buckets[length]
+        batches.extend(indices[start : start + batch_size] for start in range(0, len(indices), batch_size))
+    return batches
+
+
+def print_throughput(num_sequences, num_tokens, elapsed):
+    """Prints the sequences/s and tokens/s of a run."""
+    print(
+        f"Processed {num_sequences} sequences ({num_tokens} tokens) in {elapsed:.1f} s: "
+        f"{num_sequences / elapsed:.2f} sequences/s, {num_tokens / elapsed:.1f} tokens/s"
+    )
+
+
+def check_validation(max_error, cpu_precision, validate_tolerance):
+    """Reports the error of the validated batches, fails if it is above validate_tolerance."""
+    print(f"Max relative error of the {cpu_precision} mean representations vs fp32: {max_error:.2e}")
+    if max_error > validate_tolerance:
+        raise ValueError(
+            f"{cpu_precision} mean representations differ from fp32 by {max_error:.2e} "
+            f"(> --validate_tolerance {validate_tolerance})"
+        )
+
+
+def relative_error(mean, mean_fp32):
+    """Largest ||mean - mean_fp32|| / ||mean_fp32|| over the rows of two (sequences, dim) tensors."""
+    return ((mean - mean_fp32).norm(dim=-1) / mean_fp32.norm(dim=-1)).max().item()
+
+
+def read_variants(path):
+    """Reads a variant list: one variant per line, or the 'variant' column of a labels csv."""
+    if path.suffix == ".csv":
+        import pandas as pd
+
+        return pd.read_csv(path)["variant"].astype(str).tolist()
+    with open(path) as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def parse_substitution(variant, wt_seq):
+    """Returns (0-based position, wt residue, mutant residue) of a substitution like A2C, None for WT."""
+    if variant == "WT":
+        return None
+    wt, position, mut = variant[0], int(variant[1:-1]), variant[-1]
+    if position < 1 or position > len(wt_seq) or wt_seq[position - 1] != wt:
+        raise ValueError(f"Variant {variant} does not match the WT sequence")
+    return position - 1, wt, mut
+
+
+def forward_batches(model, alphabet, seqs, args, repr_layer, use_gpu, mask_positions=None, reference_model=None):
+    """Runs equal-length sequences through the model in batches of at most args.toks_per_batch tokens,
+    at args.cpu_precision. Yields (sequence indices, representations of repr_layer, logits) on the CPU.
+    With mask_positions, the (0-based) residue mask_positions[i] of sequence i is replaced by the mask
+    token. With a reference_model, the first args.validate_batches batches are checked against it as in
+    run()."""
+    batch_converter = alphabet.get_batch_converter()
+    batch_size = max(1, args.toks_per_batch // (len(seqs[0]) + 2))
+    num_batches = (len(seqs) + batch_size - 1) // batch_size
+    max_error = 0.0
+    for batch_idx, start in enumerate(range(0, len(seqs), batch_size)):
+        indices = list(range(start, min(start + batch_size, len(seqs))))
+        _, _, toks = batch_converter([(str(i), seqs[i]) for i in indices])
+        if mask_positions is not None:
+            # +1 for the BOS token
+            toks[torch.arange(len(indices)), torch.tensor([mask_positions[i] + 1 for i in indices])] = alphabet.mask_idx
+        if use_gpu:
+            toks = toks.to(device="cuda", non_blocking=True)
+        with precision_context(args.cpu_precision, use_gpu):
+            out = model(toks, repr_layers=[repr_layer], return_contacts=False)
+        representations = out["representations"][repr_layer].to(device="cpu").float()
+
+        if reference_model is not None and batch_idx < args.validate_batches:
+            reference = reference_model(toks, repr_layers=[repr_layer])["representations"][repr_layer]
+            n = len(seqs[0])
+            max_error = max(max_error, relative_error(representations[:, 1 : n + 1].mean(1), reference[:, 1 : n + 1].mean(1)))
+            # fail before the rest of the scan once the last validated batch is done
+            if batch_idx + 1 == min(args.validate_batches, num_batches):
+                check_validation(max_error, args.cpu_precision, args.validate_tolerance)
+
+        yield indices, representations, out["logits"].to(device="cpu").float()
+
+
+def run_mutant_scan(args, model, alphabet, repr_layer, use_gpu, reference_model=None):
+    """Embeds or scores every variant of a saturation mutagenesis scan of one WT sequence.
+
+    exact: each distinct mutant sequence is embedded once (WT included), 'average' is the mean over
+    residues and 'mutated' the representation at the substituted position, saved to mutant_scan.pt.
+    Nothing is shared between the sequences: it runs as many forward passes as extracting the mutant
+    FASTA would.
+    masked_marginal: the WT is run once per mutated position with that position masked, so the ~19
+    substitutions at a position share one forward pass. Their representations would be identical (every
+    model would see them as ties), so only the masked-marginal score of each variant is saved, to
+    mutant_scan_scores.csv.
+    With a reference_model, the first --validate_batches batches are checked against fp32.
+    Returns the number of sequences and tokens run through the model."""
+    wt_label, wt_seq = FastaBatchedDataset.from_file(args.fasta_file)[0]
+    if len(wt_seq) > args.truncation_seq_length:
+        raise ValueError(f"WT sequence is longer than --truncation_seq_length ({args.truncation_seq_length})")
+    variants = read_variants(args.mutant_scan)
+    substitutions = {variant: parse_substitution(variant, wt_seq) for variant in variants}
+    print(f"Read {wt_label} ({len(wt_seq)} residues) and {len(variants)} variants, scan mode {args.scan_mode}")
+
+    result = {}
+    num_sequences = 0
+    if args.scan_mode == "exact":
+        # one forward pass per distinct sequence
+        seq_of = {}
+        for variant, sub in substitutions.items():
+            if sub is None:
+                seq_of[variant] = wt_seq
+            else:
+                position, _, mut = sub
+                seq_of[variant] = wt_seq[:position] + mut + wt_seq[position + 1 :]
+        seqs = sorted(set(seq_of.values()))
+        variants_of_seq = {}
+        for variant, seq in seq_of.items():
+            variants_of_seq.setdefault(seq, []).append(variant)
+
+        for indices, representations, _ in forward_batches(
+            model, alphabet, seqs, args, repr_layer, use_gpu, reference_model=reference_model
+        ):
+            num_sequences += len(indices)
+            for k, i in enumerate(indices):
+                average = representations[k, 1 : len(wt_seq) + 1].mean(0)
+                for variant in variants_of_seq[seqs[i]]:
+                    sub = substitutions[variant]
+                    # WT has no mutated position, use its average as for the mean embeddings
+                    mutated = average if sub is None else representations[k, sub[0] + 1]
+                    result[variant] = {"average": average.clone(), "mutated": mutated.clone()}
+            print(f"Embedded {min(indices[-1] + 1, len(seqs))} of {len(seqs)} distinct sequences")
+
+        torch.save(result, args.output_dir / "mutant_scan.pt")
+        print(f"Wrote {len(result)} variants to {args.output_dir / 'mutant_scan.pt'}")
+    else:
+        # one masked forward pass per mutated position (the score of WT is 0)
+        positions = sorted({sub[0] for sub in substitutions.values() if sub is not None})
+        seqs = [wt_seq] * len(positions)
+        log_probs_of = {}
+        for indices, _, logits in forward_batches(
+            model, alphabet, seqs, args, repr_layer, use_gpu, mask_positions=positions, reference_model=reference_model
+        ):
+            num_sequences += len(indices)
+            log_probs = torch.log_softmax(logits, dim=-1)
+            for k, i in enumerate(indices):
+                log_probs_of[positions[i]] = log_probs[k, positions[i] + 1]
+            print(f"Scored {min(indices[-1] + 1, len(positions))} of {len(positions)} positions")
+
+        with open(args.output_dir / "mutant_scan_scores.csv", "w") as f:
+            f.write("variant,masked_marginal_score\n")
+            for variant in variants:
+                sub = substitutions[variant]
+                if sub is None:
+                    score = 0.0
+                else:
+                    position, wt, mut = sub
+                    log_prob = log_probs_of[position]
+                    score = (log_prob[alphabet.get_idx(mut)] - log_prob[alphabet.get_idx(wt)]).item()
+                f.write(f"{variant},{score}\n")
+        print(f"Wrote the scores of {len(variants)} variants to {args.output_dir / 'mutant_scan_scores.csv'}")
+
+    return num_sequences, num_sequences * len(wt_seq)
+
+
 def run(args):
+    if args.recover_shards:
+        num_sequences = build_shard_stores(args.output_dir)
+        print(f"Recovered {num_sequences} sequences to {args.output_dir}")
+        return
+    check_cpu_precision(args.cpu_precision)
     model, alphabet = pretrained.load_model_and_alphabet(args.model_location)
     model.eval()
     if isinstance(model, MSATransformer):
         raise ValueError(
             "This script currently does not handle models with MSA input (MSA Transformer)."
         )
-    if torch.cuda.is_available() and not args.nogpu:
+    use_gpu = torch.cuda.is_available() and not args.nogpu
+    reference_model = None
+    if use_gpu:
         model = model.cuda()
         print("Transferred model to GPU")
+        if args.cpu_precision != "fp32":
+            print(f"Ignoring --cpu_precision {args.cpu_precision} on GPU")
+    else:
+        configure_cpu(args)
+        if args.cpu_precision != "fp32" and args.validate_batches > 0:
+            reference_model = model
+        if args.cpu_precision == "int8":
+            model = quantize_model(model)
+            print("Quantized the linear layers to int8")
+
+    if args.mutant_scan is not None:
+        args.output_dir.mkdir(parents=True, exist_ok=True)
+        assert all(-(model.num_layers + 1) <= i <= model.num_layers for i in args.repr_layers)
+        repr_layer = (args.repr_layers[-1] + model.num_layers + 1) % (model.num_layers + 1)
+        if args.length_buckets:
+            print("Ignoring --length_buckets with --mutant_scan: the scanned sequences all have the WT length")
+        start_time = time.perf_counter()
+        with torch.no_grad():
+            num_sequences, num_tokens = run_mutant_scan(args, model, alphabet, repr_layer, use_gpu, reference_model)
+        print_throughput(num_sequences, num_tokens, time.perf_counter() - start_time)
+        return
+    if not args.include:
+        raise ValueError("--include is required unless --mutant_scan is used")
 
     dataset = FastaBatchedDataset.from_file(args.fasta_file)
-    batches = dataset.get_batch_indices(args.toks_per_batch, extra_toks_per_seq=1)
+    if args.length_buckets:
+        batches = get_length_bucket_indices(dataset, args.toks_per_batch, extra_toks_per_seq=1)
+    else:
+        batches = dataset.get_batch_indices(args.toks_per_batch, extra_toks_per_seq=1)
     data_loader = torch.utils.data.DataLoader(
         dataset, collate_fn=alphabet.get_batch_converter(), batch_sampler=batches
     )
@@ -82,25 +493,64 @@ def run(args):
     args.output_dir.mkdir(parents=True, exist_ok=True)
     return_contacts = "contacts" in args.include
 
+    writer = None
+    if args.output_format == "shards":
+        if "per_tok" in args.include or return_contacts:
+            raise ValueError("The shards output only holds fixed-size representations, use --include mean and/or bos.")
+        writer = ShardWriter(args.output_dir)
+        pending_labels, pending_arrays = [], {}
+
     assert all(-(model.num_layers + 1) <= i <= model.num_layers for i in args.repr_layers)
     repr_layers = [(i + model.num_layers + 1) % (model.num_layers + 1) for i in args.repr_layers]
 
+    num_sequences, num_tokens, max_error = 0, 0, 0.0
+    start_time = time.perf_counter()
     with torch.no_grad():
         for batch_idx, (labels, strs, toks) in enumerate(data_loader):
             print(
                 f"Processing {batch_idx + 1} of {len(batches)} batches ({toks.size(0)} sequences)"
             )
-            if torch.cuda.is_available() and not args.nogpu:
+            if use_gpu:
                 toks = toks.to(device="cuda", non_blocking=True)
 
-            out = model(toks, repr_layers=repr_layers, return_contacts=return_contacts)
+            with precision_context(args.cpu_precision, use_gpu):
+                out = model(toks, repr_layers=repr_layers, return_contacts=return_contacts)
 
-            logits = out["logits"].to(device="cpu")
+            logits = out["logits"].to(device="cpu").float()
             representations = {
-                layer: t.to(device="cpu") for layer, t in out["representations"].items()
+                layer: t.to(device="cpu").float() for layer, t in out["representations"].items()
             }
             if return_contacts:
-                contacts = out["contacts"].to(device="cpu")
+                contacts = out["contacts"].to(device="cpu").float()
+
+            truncate_lens = [min(args.truncation_seq_length, len(seq)) for seq in strs]
+            num_sequences += len(strs)
+            num_tokens += sum(truncate_lens)
+
+            if reference_model is not None and batch_idx < args.validate_batches:
+                reference = reference_model(toks, repr_layers=repr_layers)["representations"]
+                for layer, t in representations.items():
+                    means = torch.stack([t[i, 1 : n + 1].mean(0) for i, n in enumerate(truncate_lens)])
+                    means_fp32 = torch.stack([reference[layer][i, 1 : n + 1].mean(0) for i, n in enumerate(truncate_lens)])
+                    max_error = max(max_error, relative_error(means, means_fp32))
+                # fail before the rest of the run once the last validated batch is done
+                if batch_idx + 1 == min(args.validate_batches, len(batches)):
+                    check_validation(max_error, args.cpu_precision, args.validate_tolerance)
+
+            if writer is not None:
+                # mean/bos of the whole batch as (batch, dim) arrays, handed to the writer every shard_batches batches
+                for layer, t in representations.items():
+                    if "mean" in args.include:
+                        means = torch.stack([t[i, 1 : n + 1].mean(0) for i, n in enumerate(truncate_lens)])
+                        pending_arrays.setdefault(f"mean_{layer}", []).append(means.numpy())
+                    if "bos" in args.include:
+                        pending_arrays.setdefault(f"bos_{layer}", []).append(t[:, 0].numpy())
+                pending_labels.extend(labels)
+
+                if (batch_idx + 1) % args.shard_batches == 0 or batch_idx + 1 == len(batches):
+                    writer.append(pending_labels, {name: np.concatenate(parts) for name, parts in pending_arrays.items()})
+                    pending_labels, pending_arrays = [], {}
+                continue
 
             for i, label in enumerate(labels):
                 args.output_file = args.output_dir / f"{label}.pt"
@@ -131,6 +581,12 @@ def run(args):
                     args.output_file,
                 )
 
+    if writer is not None:
+        num_written = writer.close()
+        print(f"Wrote {num_written} sequences to {args.output_dir}")
+
+    print_throughput(num_sequences, num_tokens, time.perf_counter() - start_time)
+
 
 def main():
     parser = create_parser()
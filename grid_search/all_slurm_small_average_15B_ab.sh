@@ -37,6 +37,7 @@ function run_grid_search() {
         --base_path ../esm-extract/results_means \
         --num_simulations ${num_simulations} \
         --num_iterations ${num_iterations[*]} \
+        --share_prefixes \
         --measured_var ${measured_var} \
         --learning_strategies ${learning_strategies} \
         --num_mutants_per_round ${num_mutants_per_round} \
@@ -0,0 +1,55 @@
+#!/bin/bash
+# Configuration values for SLURM job submission.
+# One leading hash ahead of the word SBATCH is not a comment, but two are.
+# Job array version of all_slurm_small_average.sh: every array task runs one shard of the grid of one dataset
+# (27 datasets x 10 shards), then all_slurm_small_average_merge.sh merges the shards into the results csvs:
+#   jobid=$(sbatch --parsable all_slurm_small_average_array.sh)
+#   sbatch --dependency=afterok:${jobid} all_slurm_small_average_merge.sh
+# Shards that hit the time limit can be resubmitted with --array=<their task ids>, they resume where they stopped.
+#SBATCH --time=4:00:00
+##SBATCH -x node[110]
+#SBATCH --job-name=all_slurm_small_average_array
+#SBATCH --array=0-269
+#SBATCH -n 1
+#SBATCH -N 1
+#SBATCH --cpus-per-task=1
+#SBATCH --mem=4gb
+#SBATCH --output /om/group/abugoot/Projects/Matteo/Github/directed_evolution/grid_search/out/all_slurm_small_average_array-%A_%a.out
+
+source ~/.bashrc
+conda activate embeddings
+
+datasets=("esm2_650M_brenan" "esm2_3B_brenan" "esm2_15B_brenan" "esm2_650M_stiffler" "esm2_3B_stiffler" "esm2_15B_stiffler" "esm2_650M_doud" "esm2_3B_doud" "esm2_15B_doud" "esm2_650M_haddox" "esm2_3B_haddox" "esm2_15B_haddox" "esm2_650M_giacomelli" "esm2_3B_giacomelli" "esm2_15B_giacomelli" "esm2_650M_jones" "esm2_3B_jones" "esm2_15B_jones" "esm2_650M_kelsic" "esm2_3B_kelsic" "esm2_15B_kelsic" "esm2_650M_lee" "esm2_3B_lee" "esm2_15B_lee" "esm2_650M_markin" "esm2_3B_markin" "esm2_15B_markin")
+num_shards=10
+num_simulations=10
+num_iterations=(2 3 4 5 6 7 8 9 10 11)
+measured_var="fitness"
+learning_strategies="top10"
+num_mutants_per_round=16
+first_round_strategies="random"
+embedding_types="embeddings"
+regression_types="randomforest"
+file_type="pts"
+embedding_type_pt="average"
+
+# Dataset and shard of this array task
+dataset_name=${datasets[$((SLURM_ARRAY_TASK_ID / num_shards))]}
+shard_index=$((SLURM_ARRAY_TASK_ID % num_shards))
+
+python3 -u grid_search.py \
+    --dataset_name ${dataset_name} \
+    --base_path ../esm-extract/results_means \
+    --num_simulations ${num_simulations} \
+    --num_iterations ${num_iterations[*]} \
+    --share_prefixes \
+    --measured_var ${measured_var} \
+    --learning_strategies ${learning_strategies} \
+    --num_mutants_per_round ${num_mutants_per_round} \
+    --first_round_strategies ${first_round_strategies} \
+    --embedding_types ${embedding_types} \
+    --regression_types ${regression_types} \
+    --file_type ${file_type} \
+    --embeddings_type_pt ${embedding_type_pt} \
+    --num_shards ${num_shards} \
+    --shard_index ${shard_index} \
+    --resume
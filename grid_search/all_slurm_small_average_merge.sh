@@ -0,0 +1,45 @@
+#!/bin/bash
+# Configuration values for SLURM job submission.
+# One leading hash ahead of the word SBATCH is not a comment, but two are.
+# Merges the shards of all_slurm_small_average_array.sh into one results csv per dataset
+#SBATCH --time=1:00:00
+#SBATCH --job-name=all_slurm_small_average_merge
+#SBATCH -n 1
+#SBATCH -N 1
+#SBATCH --cpus-per-task=1
+#SBATCH --mem=4gb
+#SBATCH --output /om/group/abugoot/Projects/Matteo/Github/directed_evolution/grid_search/out/all_slurm_small_average_merge-%j.out
+
+source ~/.bashrc
+conda activate embeddings
+
+datasets=("esm2_650M_brenan" "esm2_3B_brenan" "esm2_15B_brenan" "esm2_650M_stiffler" "esm2_3B_stiffler" "esm2_15B_stiffler" "esm2_650M_doud" "esm2_3B_doud" "esm2_15B_doud" "esm2_650M_haddox" "esm2_3B_haddox" "esm2_15B_haddox" "esm2_650M_giacomelli" "esm2_3B_giacomelli" "esm2_15B_giacomelli" "esm2_650M_jones" "esm2_3B_jones" "esm2_15B_jones" "esm2_650M_kelsic" "esm2_3B_kelsic" "esm2_15B_kelsic" "esm2_650M_lee" "esm2_3B_lee" "esm2_15B_lee" "esm2_650M_markin" "esm2_3B_markin" "esm2_15B_markin")
+num_shards=10
+num_simulations=10
+num_iterations=(2 3 4 5 6 7 8 9 10 11)
+measured_var="fitness"
+learning_strategies="top10"
+num_mutants_per_round=16
+first_round_strategies="random"
+embedding_types="embeddings"
+regression_types="randomforest"
+file_type="pts"
+embedding_type_pt="average"
+
+# Loop over datasets
+for dataset_name in "${datasets[@]}"; do
+    python3 -u merge_shards.py \
+        --dataset_name ${dataset_name} \
+        --base_path ../esm-extract/results_means \
+        --num_simulations ${num_simulations} \
+        --num_iterations ${num_iterations[*]} \
+        --measured_var ${measured_var} \
+        --learning_strategies ${learning_strategies} \
+        --num_mutants_per_round ${num_mutants_per_round} \
+        --first_round_strategies ${first_round_strategies} \
+        --embedding_types ${embedding_types} \
+        --regression_types ${regression_types} \
+        --file_type ${file_type} \
+        --embeddings_type_pt ${embedding_type_pt} \
+        --num_shards ${num_shards}
+done
@@ -0,0 +1,196 @@
+import math
+
+import numpy as np
+import torch
+
+# Batched neuralnet backend (grid_search.py --neuralnet_backend batched). Every simulation and round of the neuralnet
+# regression type trains the same small MLPRegressor (one hidden layer of 5 relu units, adam, 1000 epochs), so the
+# networks of all simulations of a round are trained together: their weights are stacked along a leading batch
+# dimension and every adam step is a handful of batched matrix products. The training sets are padded to the largest
+# one and masked, so every network trains on its own variants, shuffles its own minibatches and stops on its own.
+# The training loop follows MLPRegressor's (Glorot initialization, squared loss with an L2 penalty, adam, stopping when
+# the loss has not improved by tol for n_iter_no_change epochs), but the random draws differ, so the networks are not
+# the ones sklearn would fit.
+# Every network draws its initial weights, validation split and minibatch order from its own generator, seeded from
+# random_state and its network key (e.g. its simulation seed and round), so a network trains the same way whatever
+# the other networks of its batch are, e.g. when the grid is split into shards.
+
+# Hyperparameters of the MLPRegressor of top_layer
+MLP_PARAMS = dict(hidden_units=5, alpha=0.001, batch_size=200, learning_rate_init=0.001, max_iter=1000, tol=1e-4,
+                  n_iter_no_change=10, beta_1=0.9, beta_2=0.999, epsilon=1e-8, early_stopping=False,
+                  validation_fraction=0.1, random_state=1)
+
+# One trained network, predicting like MLPRegressor
+class MLPNetwork:
+    def __init__(self, coefs, intercepts, n_iter):
+        self.coefs_ = coefs
+        self.intercepts_ = intercepts
+        self.n_iter_ = n_iter
+
+    def predict(self, X):
+        hidden = np.maximum(np.asarray(X, dtype=np.float64) @ self.coefs_[0] + self.intercepts_[0], 0)
+        return hidden @ self.coefs_[1] + self.intercepts_[1]
+
+# Function to pad the training sets to the same number of rows, returns X (B, m, d), y (B, m) and the mask of real rows
+def pad_training_sets(X_train_list, y_train_list, dtype=torch.float32):
+    num_rows = max(len(y_train) for y_train in y_train_list)
+    X = torch.zeros((len(X_train_list), num_rows, X_train_list[0].shape[1]), dtype=dtype)
+    y = torch.zeros((len(y_train_list), num_rows), dtype=dtype)
+    mask = torch.zeros((len(y_train_list), num_rows), dtype=torch.bool)
+    for b, (X_train, y_train) in enumerate(zip(X_train_list, y_train_list)):
+        X[b, :len(y_train)] = torch.as_tensor(np.asarray(X_train), dtype=dtype)
+        y[b, :len(y_train)] = torch.as_tensor(np.asarray(y_train), dtype=dtype)
+        mask[b, :len(y_train)] = True
+    return X, y, mask
+
+# Function to create the generator of one network from random_state and its key (a tuple of non-negative ints)
+def network_generator(random_state, key):
+    seed = int(np.random.SeedSequence([random_state, *key]).generate_state(1)[0])
+    return torch.Generator().manual_seed(seed)
+
+# Function to shuffle the rows of every network independently, returns positions with the rows in mask first. Network
+# b draws num_rows[b] keys from its own generator (whatever the padded width of the batch), and the networks not in
+# shuffled keep their rows in order
+def shuffle_rows(mask, generators, num_rows, shuffled=None):
+    keys = torch.arange(mask.shape[1], dtype=torch.float32)[None, :].repeat(mask.shape[0], 1) / mask.shape[1]
+    for b, generator in enumerate(generators):
+        if shuffled is None or shuffled[b]:
+            keys[b, :num_rows[b]] = torch.rand(int(num_rows[b]), generator=generator)
+    keys[~mask] = 2.0
+    return keys.argsort(dim=1)
+
+# Function to compute the squared loss with the L2 penalty and its gradients for a minibatch of every network.
+# X (B, m, d), y (B, m) and weight (B, m), the 0/1 mask of the rows in the minibatch, with count (B,) rows each
+def loss_and_gradients(params, X, y, weight, count, alpha):
+    W1, b1, W2, b2 = params
+    count = count.clamp(min=1)
+    pre_activation = torch.baddbmm(b1[:, None, :], X, W1)
+    hidden = pre_activation.clamp(min=0)
+    y_pred = torch.baddbmm(b2[:, None, :], hidden, W2)[:, :, 0]
+
+    residual = (y_pred - y) * weight
+    penalty = (W1 ** 2).sum(dim=(1, 2)) + (W2 ** 2).sum(dim=(1, 2))
+    loss = (residual ** 2).sum(dim=1) / (2 * count) + 0.5 * alpha * penalty / count
+
+    delta = (residual / count[:, None])[:, :, None]
+    grad_W2 = torch.bmm(hidden.transpose(1, 2), delta) + alpha * W2 / count[:, None, None]
+    grad_b2 = delta.sum(dim=1)
+    delta_hidden = torch.bmm(delta, W2.transpose(1, 2)) * (pre_activation > 0)
+    grad_W1 = torch.bmm(X.transpose(1, 2), delta_hidden) + alpha * W1 / count[:, None, None]
+    grad_b1 = delta_hidden.sum(dim=1)
+    return loss, (grad_W1, grad_b1, grad_W2, grad_b2)
+
+# Function to compute the R^2 of every network on the rows of mask, the validation score of early stopping
+def masked_r2(params, X, y, mask):
+    W1, b1, W2, b2 = params
+    hidden = torch.baddbmm(b1[:, None, :], X, W1).clamp(min=0)
+    y_pred = torch.baddbmm(b2[:, None, :], hidden, W2)[:, :, 0]
+    weight = mask.to(y.dtype)
+    count = weight.sum(dim=1).clamp(min=1)
+    y_mean = (y * weight).sum(dim=1) / count
+    residual_ss = (((y - y_pred) * weight) ** 2).sum(dim=1)
+    total_ss = (((y - y_mean[:, None]) * weight) ** 2).sum(dim=1)
+    return 1 - residual_ss / total_ss.clamp(min=torch.finfo(y.dtype).tiny)
+
+# Function to train one MLPRegressor-like network per training set, all at once. X_train_list and y_train_list hold the
+# training sets, which can differ in size. network_keys holds the key of the generator of every network (default: its
+# position in the batch). Returns one MLPNetwork per training set
+def fit_mlp_batched(X_train_list, y_train_list, hidden_units=5, alpha=0.001, batch_size=200, learning_rate_init=0.001,
+                    max_iter=1000, tol=1e-4, n_iter_no_change=10, beta_1=0.9, beta_2=0.999, epsilon=1e-8,
+                    early_stopping=False, validation_fraction=0.1, random_state=1, network_keys=None):
+    if network_keys is None:
+        network_keys = [(b,) for b in range(len(X_train_list))]
+    generators = [network_generator(random_state, key) for key in network_keys]
+    X, y, mask = pad_training_sets(X_train_list, y_train_list)
+    num_networks, _, num_features = X.shape
+    rows = torch.arange(num_networks)[:, None]
+
+    # hold out a validation set per network for early stopping
+    train_mask = mask.clone()
+    if early_stopping:
+        order = shuffle_rows(mask, generators, [len(y_train) for y_train in y_train_list])
+        num_validation = torch.tensor([math.ceil(validation_fraction * len(y_train)) for y_train in y_train_list])
+        validation_mask = torch.zeros_like(mask)
+        validation_mask[rows, order] = torch.arange(mask.shape[1])[None, :] < num_validation[:, None]
+        train_mask &= ~validation_mask
+    num_train = train_mask.sum(dim=1)
+    network_batch_size = num_train.clamp(max=batch_size)
+    steps_per_epoch = int((-(-num_train // network_batch_size.clamp(min=1))).max())
+    # a network with its whole training set in one minibatch keeps its rows in order
+    shuffled = (num_train > network_batch_size).tolist()
+    num_rows = [len(y_train) for y_train in y_train_list]
+
+    # Glorot uniform initialization like MLPRegressor, every network from its own generator
+    params = []
+    for fan_in, fan_out in ((num_features, hidden_units), (hidden_units, 1)):
+        bound = math.sqrt(6.0 / (fan_in + fan_out))
+        weights = [(torch.rand((fan_in, fan_out), generator=generator) * 2 - 1) * bound for generator in generators]
+        biases = [(torch.rand(fan_out, generator=generator) * 2 - 1) * bound for generator in generators]
+        params.append(torch.stack(weights))
+        params.append(torch.stack(biases))
+    first_moments = [torch.zeros_like(param) for param in params]
+    second_moments = [torch.zeros_like(param) for param in params]
+    adam_steps = torch.zeros(num_networks)
+
+    active = torch.ones(num_networks, dtype=torch.bool)
+    n_iter = torch.zeros(num_networks, dtype=torch.int64)
+    no_improvement_count = torch.zeros(num_networks, dtype=torch.int64)
+    best_loss = torch.full((num_networks,), np.inf)
+    best_score = torch.full((num_networks,), -np.inf)
+    best_params = [param.clone() for param in params]
+    # with every training set in a single minibatch the row order does not matter, so X is used as is
+    full_batch = steps_per_epoch == 1
+
+    for _ in range(max_iter):
+        if not active.any():
+            break
+        if not full_batch:
+            order = shuffle_rows(train_mask, generators, num_rows, shuffled)
+
+        accumulated_loss = torch.zeros(num_networks)
+        for step in range(steps_per_epoch):
+            if full_batch:
+                X_batch, y_batch, batch_mask = X, y, train_mask
+            else:
+                positions = step * network_batch_size[:, None] + torch.arange(int(network_batch_size.max()))[None, :]
+                batch_mask = ((torch.arange(positions.shape[1])[None, :] < network_batch_size[:, None])
+                              & (positions < num_train[:, None]))
+                batch_rows = order[rows, positions.clamp(max=order.shape[1] - 1)]
+                X_batch, y_batch = X[rows, batch_rows], y[rows, batch_rows]
+            count = batch_mask.sum(dim=1)
+            loss, gradients = loss_and_gradients(params, X_batch, y_batch, batch_mask.to(X.dtype), count.to(X.dtype), alpha)
+            accumulated_loss += loss * count
+
+            # adam update of the networks that are still training and have rows in this minibatch
+            update = active & (count > 0)
+            adam_steps += update
+            learning_rate = (learning_rate_init * torch.sqrt(1 - beta_2 ** adam_steps) / (1 - beta_1 ** adam_steps)).nan_to_num(0)
+            for param, gradient, first_moment, second_moment in zip(params, gradients, first_moments, second_moments):
+                shape = (-1,) + (1,) * (param.dim() - 1)
+                selected = update.view(shape)
+                first_moment.copy_(torch.where(selected, beta_1 * first_moment + (1 - beta_1) * gradient, first_moment))
+                second_moment.copy_(torch.where(selected, beta_2 * second_moment + (1 - beta_2) * gradient ** 2, second_moment))
+                step_size = (learning_rate * update).view(shape)
+                param -= step_size * first_moment / (second_moment.sqrt() + epsilon)
+
+        n_iter += active
+        # stop each network once its loss (or validation score) has not improved by tol for n_iter_no_change epochs
+        if early_stopping:
+            score = masked_r2(params, X, y, validation_mask)
+            not_improved = score < best_score + tol
+            improved = active & (score > best_score)
+            best_score = torch.where(improved, score, best_score)
+            for param, best_param in zip(params, best_params):
+                best_param.copy_(torch.where(improved.view((-1,) + (1,) * (param.dim() - 1)), param, best_param))
+        else:
+            epoch_loss = accumulated_loss / num_train.clamp(min=1)
+            not_improved = epoch_loss > best_loss - tol
+            best_loss = torch.where(active & (epoch_loss < best_loss), epoch_loss, best_loss)
+        no_improvement_count = torch.where(active, torch.where(not_improved, no_improvement_count + 1, 0), no_improvement_count)
+        active &= no_improvement_count <= n_iter_no_change
+
+    if early_stopping:
+        # restore the weights with the best validation score
+        params = best_params
+    W1, b1, W2, b2 = (param.double().numpy() for param in params)
+    return [MLPNetwork([W1[b], W2[b, :, 0]], [b1[b], b2[b, 0]], int(n_iter[b])) for b in range(num_networks)]
@@ -0,0 +1,62 @@
+import numpy as np
+import torch
+
+from incremental_models import GramRidge
+
+# Batched ridge backend (grid_search.py --ridge_backend batched). The simulations of a combination train RidgeCV on a
+# few dozen to a few hundred variants of 1280-5120 dimensional embeddings, so every fit is solved in the dual: the
+# centered Gram matrices of all simulations are stacked and eigendecomposed in one call, and the leave-one-out error of
+# every alpha is computed in closed form for all simulations at once, as RidgeCV does for a single one (gcv_mode='eigen').
+
+# Alphas of RidgeCV()
+RIDGE_ALPHAS = (0.1, 1.0, 10.0)
+
+# Function to fit RidgeCV on a batch of training sets of the same size, X_train (B, n, d) and y_train (B, n).
+# Returns one fitted model (predict, coef_, intercept_, alpha_) per training set. The batched products and
+# eigendecompositions run in float64 torch on the CPU, which is several times faster than numpy's for these sizes
+def fit_ridge_gcv_batched(X_train, y_train, alphas=RIDGE_ALPHAS):
+    X_train = torch.as_tensor(np.asarray(X_train), dtype=torch.float64)
+    y_train = torch.as_tensor(np.asarray(y_train), dtype=torch.float64)
+    batch_size, n = y_train.shape
+
+    X_mean = X_train.mean(dim=1)
+    y_mean = y_train.mean(dim=1)
+    X_centered = X_train - X_mean[:, None, :]
+    y_centered = y_train - y_mean[:, None]
+
+    # Gram matrices of the centered rows, plus the constant column of the intercept
+    gram = torch.bmm(X_centered, X_centered.transpose(1, 2)) + 1.0
+    eigvals, Q = torch.linalg.eigh(gram)
+    QT_y = torch.bmm(Q.transpose(1, 2), y_centered[:, :, None])[:, :, 0]
+    # the eigenvector of the intercept is not regularized
+    intercept_dim = Q.sum(dim=1).abs().argmax(dim=1)
+    rows = torch.arange(batch_size)
+    Q_squared = Q ** 2
+
+    best_score = torch.full((batch_size,), -np.inf, dtype=torch.float64)
+    best_alpha = torch.zeros(batch_size, dtype=torch.float64)
+    best_dual_coef = torch.zeros((batch_size, n), dtype=torch.float64)
+    for alpha in alphas:
+        w = 1.0 / (eigvals + alpha)
+        w[rows, intercept_dim] = 0
+        dual_coef = torch.bmm(Q, (w * QT_y)[:, :, None])[:, :, 0]
+        G_inverse_diag = torch.bmm(Q_squared, w[:, :, None])[:, :, 0]
+        score = -((dual_coef / G_inverse_diag) ** 2).mean(dim=1)
+        # keep the first best alpha like RidgeCV
+        better = score > best_score
+        best_score[better] = score[better]
+        best_alpha[better] = alpha
+        best_dual_coef[better] = dual_coef[better]
+
+    coef = torch.bmm(X_centered.transpose(1, 2), best_dual_coef[:, :, None])[:, :, 0]
+    intercept = y_mean - (X_mean * coef).sum(dim=1)
+    coef, intercept, best_alpha = coef.numpy(), intercept.numpy(), best_alpha.numpy()
+    return [GramRidge(coef[b], intercept[b], best_alpha[b]) for b in range(batch_size)]
+
+# Model fit outside of top_layer, handed to it in place of the incremental model
+class PrefitModel:
+    def __init__(self, model):
+        self.model = model
+
+    def fit(self, model, X_train, y_train, idx_train):
+        return self.model
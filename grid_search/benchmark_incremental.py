@@ -0,0 +1,101 @@
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+from grid_search import UNSELECTED, first_round, read_data, top_k_descending, top_layer
+from incremental_models import IncrementalTopLayer
+
+# Per-round fit time of the top layer, fit from scratch every round vs --incremental, on one top10 trajectory per
+# regression type. Runs on a dataset read like grid_search.py, or on random embeddings the size of brenan.
+
+# Create the parser for the command line arguments
+def create_parser():
+    parser = argparse.ArgumentParser(description="Benchmark the per-round fit time of the top layer with and without --incremental.")
+    parser.add_argument("--dataset_name", type=str, default=None, help="Dataset to read like grid_search.py. Default: random embeddings")
+    parser.add_argument("--base_path", type=str, default=None, help="Base path of the dataset")
+    parser.add_argument("--file_type", type=str, default="csvs", help="Type of file to read. Options: csvs pts npys")
+    parser.add_argument("--num_variants", type=int, default=6800, help="Number of random variants. Default: 6800")
+    parser.add_argument("--num_features", type=int, default=1280, help="Number of random embedding features. Default: 1280")
+    parser.add_argument("--num_iterations", type=int, default=11, help="Number of rounds. Default: 11")
+    parser.add_argument("--num_mutants_per_round", type=int, default=16, help="Number of mutants per round. Default: 16")
+    parser.add_argument("--regression_types", type=str, nargs="+", default=["ridge", "lasso", "neuralnet", "gradientboosting"],
+                        help="Regression types to benchmark. Default: ridge lasso neuralnet gradientboosting")
+    parser.add_argument("--output_file", type=str, default=None, help="Optional csv of the per-round fit times")
+    return parser
+
+# Function to generate random embeddings and labels with a linear fitness signal
+def random_dataset(num_variants, num_features, seed=0):
+    rng = np.random.default_rng(seed)
+    embeddings = rng.normal(size=(num_variants, num_features)).astype(np.float32)
+    fitness = embeddings @ rng.normal(size=num_features) / np.sqrt(num_features) + rng.normal(size=num_variants)
+    fitness_scaled = (fitness - fitness.min()) / (fitness.max() - fitness.min())
+    labels = pd.DataFrame({'variant': [f"V{i}" for i in range(num_variants)], 'fitness': fitness,
+                           'fitness_scaled': fitness_scaled, 'fitness_binary': (fitness_scaled > 0.7).astype(int)})
+    return pd.DataFrame(embeddings), labels
+
+# Fits the model of every round from scratch, timing each fit
+class TimedFit:
+    def __init__(self):
+        self.times = []
+
+    def fit(self, model, X_train, y_train, idx_train):
+        start = time.perf_counter()
+        model.fit(X_train, y_train)
+        self.times.append(time.perf_counter() - start)
+        return model
+
+# Updates the model of the previous round like --incremental, timing each fit
+class TimedIncrementalFit(IncrementalTopLayer):
+    def __init__(self, regression_type):
+        super().__init__(regression_type)
+        self.times = []
+
+    def fit(self, model, X_train, y_train, idx_train):
+        start = time.perf_counter()
+        model = super().fit(model, X_train, y_train, idx_train)
+        self.times.append(time.perf_counter() - start)
+        return model
+
+# Function to run one top10 trajectory and return the fit time of every round
+def time_rounds(X, labels, regression_type, num_iterations, num_mutants_per_round, fitter):
+    rounds = first_round(labels, X, None, num_mutants_per_round, first_round_strategy='random', random_seed=0)
+    y = labels['fitness'].to_numpy()
+    y_scaled = labels['fitness_scaled'].to_numpy()
+    y_binary = labels['fitness_binary'].to_numpy()
+    for j in range(2, num_iterations + 1):
+        *_, (idx_test, y_pred_test) = top_layer(X, y, y_scaled, y_binary, rounds, regression_type=regression_type,
+                                                   final_round=num_mutants_per_round, incremental_model=fitter)
+        rounds[idx_test[top_k_descending(y_pred_test, num_mutants_per_round)]] = j
+    return fitter.times
+
+def main():
+    parser = create_parser()
+    args = parser.parse_args()
+
+    if args.dataset_name is not None:
+        embeddings, labels, _ = read_data(args.dataset_name, args.base_path, args.file_type, [])
+    else:
+        embeddings, labels = random_dataset(args.num_variants, args.num_features)
+    X = np.asarray(embeddings)
+    print(f"{X.shape[0]} variants, {X.shape[1]} features, {args.num_iterations} rounds of {args.num_mutants_per_round} mutants")
+
+    rows = []
+    for regression_type in args.regression_types:
+        fresh = time_rounds(X, labels, regression_type, args.num_iterations, args.num_mutants_per_round, TimedFit())
+        incremental = time_rounds(X, labels, regression_type, args.num_iterations, args.num_mutants_per_round,
+                                  TimedIncrementalFit(regression_type))
+        for round_number, (fresh_time, incremental_time) in enumerate(zip(fresh, incremental), start=2):
+            rows.append({'regression_type': regression_type, 'round': round_number, 'fresh_fit_s': fresh_time,
+                         'incremental_fit_s': incremental_time, 'speedup': fresh_time / incremental_time})
+
+    df_times = pd.DataFrame(rows)
+    with pd.option_context('display.max_rows', None, 'display.float_format', '{:.4f}'.format):
+        print(df_times.to_string(index=False))
+        print(df_times.groupby('regression_type')[['fresh_fit_s', 'incremental_fit_s']].sum())
+    if args.output_file is not None:
+        df_times.to_csv(args.output_file, index=False)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+from grid_search import argsort_descending, read_data, top_k_descending
+
+# Time of the per-round top-k selection and metrics of top_layer on a library the size of R2 (22k variants): the
+# DataFrame concat and sort_values of the original script, a full argsort of the prediction vectors, and the partial
+# sort of top_k_descending. Runs on random predictions, or on the labels of a dataset read like grid_search.py.
+
+# Create the parser for the command line arguments
+def create_parser():
+    parser = argparse.ArgumentParser(description="Benchmark the top-k selection and metrics of a round.")
+    parser.add_argument("--dataset_name", type=str, default=None, help="Dataset to read like grid_search.py. Default: random labels")
+    parser.add_argument("--base_path", type=str, default=None, help="Base path of the dataset")
+    parser.add_argument("--file_type", type=str, default="csvs", help="Type of file to read. Options: csvs pts npys")
+    parser.add_argument("--num_variants", type=int, default=22000, help="Number of random variants. Default: 22000")
+    parser.add_argument("--num_train", type=int, default=176, help="Number of training variants. Default: 176")
+    parser.add_argument("--num_mutants_per_round", type=int, default=16, help="Number of mutants per round. Default: 16")
+    parser.add_argument("--repeats", type=int, default=200, help="Number of timed rounds. Default: 200")
+    return parser
+
+# Function to generate random labels
+def random_labels(num_variants, seed=0):
+    rng = np.random.default_rng(seed)
+    fitness_scaled = rng.uniform(size=num_variants)
+    return pd.DataFrame({'variant': [f"V{i}" for i in range(num_variants)], 'fitness_scaled': fitness_scaled,
+                         'fitness_binary': (fitness_scaled > 0.7).astype(int)})
+
+# Metrics and top10 selection of a round with DataFrames, like the original top_layer and directed_evolution_simulation
+def dataframe_round(labels, idx_train, idx_test, y_pred_train, y_pred_test, n):
+    df_train = labels.iloc[idx_train].assign(y_pred=y_pred_train)
+    df_test = labels.iloc[idx_test].assign(y_pred=y_pred_test)
+    df_all = pd.concat([df_train, df_test]).sort_values(by='y_pred', ascending=False).head(n + 1)
+    metrics = (df_all['fitness_scaled'].median(), df_all['fitness_scaled'].max(), df_all['fitness_binary'].mean())
+    selected = df_test.sort_values(by='y_pred', ascending=False).head(n).index
+    return metrics, selected
+
+# Metrics and top10 selection of a round on arrays, sorting the predictions with select
+def array_round(y_scaled, y_binary, idx_train, idx_test, y_pred_train, y_pred_test, n, select):
+    idx_all = np.concatenate([idx_train, idx_test])
+    top_idx = idx_all[select(np.concatenate([y_pred_train, y_pred_test]), n + 1)]
+    metrics = (np.nanmedian(y_scaled[top_idx]), np.nanmax(y_scaled[top_idx]), np.nanmean(y_binary[top_idx]))
+    return metrics, idx_test[select(y_pred_test, n)]
+
+# Function to time a round function, returns the mean time in milliseconds
+def time_round(round_function, repeats):
+    start = time.perf_counter()
+    for _ in range(repeats):
+        round_function()
+    return (time.perf_counter() - start) / repeats * 1000
+
+def main():
+    parser = create_parser()
+    args = parser.parse_args()
+
+    if args.dataset_name is not None:
+        _, labels, _ = read_data(args.dataset_name, args.base_path, args.file_type, [])
+    else:
+        labels = random_labels(args.num_variants)
+    rng = np.random.default_rng(0)
+    idx_train = np.sort(rng.choice(len(labels), size=args.num_train, replace=False))
+    idx_test = np.setdiff1d(np.arange(len(labels)), idx_train)
+    y_pred_train = rng.normal(size=len(idx_train))
+    y_pred_test = rng.normal(size=len(idx_test))
+    y_scaled = labels['fitness_scaled'].to_numpy()
+    y_binary = labels['fitness_binary'].to_numpy()
+    n = args.num_mutants_per_round
+    print(f"{len(labels)} variants, {len(idx_train)} training variants, top {n}")
+
+    def argsort_select(values, k):
+        return argsort_descending(values)[:k]
+
+    # all three paths select the same variants and compute the same metrics
+    reference_metrics, reference_selected = array_round(y_scaled, y_binary, idx_train, idx_test, y_pred_train, y_pred_test, n, argsort_select)
+    metrics, selected = array_round(y_scaled, y_binary, idx_train, idx_test, y_pred_train, y_pred_test, n, top_k_descending)
+    assert np.allclose(metrics, reference_metrics) and set(selected) == set(reference_selected)
+    metrics, selected = dataframe_round(labels, idx_train, idx_test, y_pred_train, y_pred_test, n)
+    assert np.allclose(metrics, reference_metrics) and set(selected) == set(reference_selected)
+
+    timings = {
+        'dataframe sort_values': time_round(lambda: dataframe_round(labels, idx_train, idx_test, y_pred_train, y_pred_test, n), args.repeats),
+        'argsort': time_round(lambda: array_round(y_scaled, y_binary, idx_train, idx_test, y_pred_train, y_pred_test, n, argsort_select), args.repeats),
+        'argpartition': time_round(lambda: array_round(y_scaled, y_binary, idx_train, idx_test, y_pred_train, y_pred_test, n, top_k_descending), args.repeats),
+    }
+    for name, milliseconds in timings.items():
+        print(f"{name:>22}: {milliseconds:.3f} ms per round")
+
+if __name__ == "__main__":
+    main()
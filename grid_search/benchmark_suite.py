@@ -0,0 +1,234 @@
+import argparse
+import datetime
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+from grid_search import BACKEND_MODULES, BATCHED_BACKEND_MODULES, UNSELECTED, read_data, run_simulation, top_layer
+from synthetic_data import LAYOUTS, dataset_name_for, generate_dataset, library_size
+
+# Benchmark suite of the simulation pipeline on synthetic datasets (synthetic_data.py), from brenan size (6.8k x 1280)
+# to R2 size (22k x 5120), without the real embeddings or a SLURM job:
+#   io:         read_data of the csvs, pts and npys layouts, and esm-extract/concatenate.py on per-variant .pt files
+#   top_layer:  one round (fit, predict, metrics) of every regression type on num_train training variants
+#   simulation: run_simulation of every learning strategy with ridge, num_iterations rounds
+#   startup:    import time of grid_search.py (python -X importtime) and of each backend it imports on demand, and the
+#               wall time of python grid_search.py --help. The slowest imports of grid_search.py are printed
+# Every benchmark keeps the best and the mean of its repeats. The timings are appended to a csv with the commit, so runs
+# on different commits can be compared:
+#   python benchmark_suite.py --size brenan
+#   python benchmark_suite.py --compare
+
+GROUPS = ('io', 'top_layer', 'simulation', 'startup')
+REGRESSION_TYPES = ['ridge', 'lasso', 'elasticnet', 'linear', 'neuralnet', 'randomforest', 'gradientboosting']
+LEARNING_STRATEGIES = ['random', 'top5bottom5', 'top10', 'dist']
+IO_LAYOUTS = ['csvs', 'pts', 'npys', 'concatenate']
+
+# Create the parser for the command line arguments
+def create_parser():
+    parser = argparse.ArgumentParser(description="Benchmark read_data, top_layer, run_simulation and concatenate.py on synthetic datasets.")
+    parser.add_argument("--size", type=str, nargs="+", default=["brenan"], help="Library sizes of synthetic_data.py. Options: small brenan r2. Default: brenan")
+    parser.add_argument("--groups", type=str, nargs="+", default=list(GROUPS), help="Benchmarks to run. Options: io top_layer simulation startup. Default: all")
+    parser.add_argument("--io_layouts", type=str, nargs="+", default=IO_LAYOUTS, help="I/O paths to benchmark. Options: csvs pts npys concatenate. Default: all")
+    parser.add_argument("--regression_types", type=str, nargs="+", default=REGRESSION_TYPES, help="Regression types of the top_layer benchmark. Default: all")
+    parser.add_argument("--learning_strategies", type=str, nargs="+", default=LEARNING_STRATEGIES, help="Learning strategies of the simulation benchmark. Default: all")
+    parser.add_argument("--num_train", type=int, default=97, help="Training variants of the top_layer benchmark. Default: 97 (6 rounds of 16)")
+    parser.add_argument("--num_iterations", type=int, default=11, help="Rounds of the simulation benchmark. Default: 11")
+    parser.add_argument("--num_mutants_per_round", type=int, default=16, help="Mutants per round. Default: 16")
+    parser.add_argument("--repeats", type=int, default=3, help="Timed repeats of every benchmark. Default: 3")
+    parser.add_argument("--data_dir", type=str, default="bench_data", help="Directory of the synthetic datasets, generated when missing. Default: bench_data")
+    parser.add_argument("--output", type=str, default="benchmark_results.csv", help="Csv the timings are appended to. Default: benchmark_results.csv")
+    parser.add_argument("--compare", action="store_true", help="Print the timings of every commit in --output side by side instead of running")
+    return parser
+
+# Function to get the commit of the working tree, with -dirty if it has uncommitted changes
+def current_commit():
+    directory = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=directory, capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=directory, capture_output=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+    return commit + ('-dirty' if dirty else '')
+
+# Function to time a function, returns the best and mean seconds of its repeats (NaN and the error if it fails)
+def time_function(function, repeats):
+    seconds = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        try:
+            function()
+        except Exception as error:
+            return np.nan, np.nan, f"{type(error).__name__}: {error}"
+        seconds.append(time.perf_counter() - start)
+    return min(seconds), float(np.mean(seconds)), ''
+
+# Function to make sure a synthetic dataset has the given layouts, generating the missing ones
+def ensure_dataset(data_dir, num_variants, embedding_dim, layouts):
+    dataset_name = dataset_name_for(num_variants, embedding_dim)
+    paths = {'csvs': os.path.join(data_dir, 'csvs', f"{dataset_name}.csv"),
+             'pts': os.path.join(data_dir, 'pts', f"{dataset_name}.pt"),
+             'npys': os.path.join(data_dir, 'npys', f"{dataset_name}.npy"),
+             'per_variant': os.path.join(data_dir, 'per_variant', dataset_name)}
+    missing = [layout for layout in layouts if not os.path.exists(paths[layout])]
+    if missing or not os.path.exists(os.path.join(data_dir, 'labels', f"{dataset_name}_labels.csv")):
+        print(f"Generating {dataset_name}: {' '.join(missing)}")
+        generate_dataset(data_dir, num_variants, embedding_dim, missing, dataset_name)
+    return dataset_name
+
+# Function to benchmark the I/O paths, yields (benchmark, params, best, mean, error)
+def benchmark_io(data_dir, dataset_name, io_layouts, repeats):
+    for layout in io_layouts:
+        if layout == 'concatenate':
+            sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'esm-extract'))
+            from concatenate import concatenate_model
+
+            output_directory = tempfile.mkdtemp()
+            model_path = os.path.join(data_dir, 'per_variant', dataset_name, 'model')
+            try:
+                yield ('concatenate', 'num_workers=8',
+                       *time_function(lambda: concatenate_model(model_path, os.path.join(output_directory, dataset_name)), repeats))
+            finally:
+                shutil.rmtree(output_directory)
+        else:
+            yield (f"read_data_{layout}", 'embeddings_type=average',
+                   *time_function(lambda: read_data(dataset_name, data_dir, layout, ['random'], 'average'), repeats))
+
+# Function to benchmark one top layer round of every regression type, yields (benchmark, params, best, mean, error)
+def benchmark_top_layer(embeddings, labels, regression_types, num_train, num_mutants_per_round, repeats):
+    X = np.asarray(embeddings)
+    y = labels['fitness'].to_numpy()
+    y_scaled = labels['fitness_scaled'].to_numpy()
+    y_binary = labels['fitness_binary'].to_numpy()
+    rounds = np.full(len(X), UNSELECTED, dtype=np.int16)
+    rounds[np.random.default_rng(0).choice(len(X), size=num_train, replace=False)] = 1
+    for regression_type in regression_types:
+        yield (f"top_layer_{regression_type}", f"num_train={num_train}",
+               *time_function(lambda: top_layer(X, y, y_scaled, y_binary, rounds, regression_type=regression_type,
+                                                final_round=num_mutants_per_round), repeats))
+
+# Function to benchmark a ridge simulation of every learning strategy, yields (benchmark, params, best, mean, error)
+def benchmark_simulation(embeddings, labels, learning_strategies, num_iterations, num_mutants_per_round, repeats):
+    for learning_strategy in learning_strategies:
+        yield (f"simulation_{learning_strategy}", f"ridge num_iterations={num_iterations} num_mutants_per_round={num_mutants_per_round}",
+               *time_function(lambda: run_simulation(labels, embeddings, pd.DataFrame(), num_iterations,
+                                                     num_mutants_per_round=num_mutants_per_round, regression_type='ridge',
+                                                     learning_strategy=learning_strategy, final_round=num_mutants_per_round,
+                                                     random_seed=0), repeats))
+
+# Function to get the import times of a python statement from python -X importtime, as a DataFrame of module, depth
+# (0 for the modules the statement imports), self and cumulative seconds in import order
+def import_times(statement):
+    directory = os.path.dirname(os.path.abspath(__file__))
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', statement], cwd=directory, capture_output=True,
+                            text=True, check=True)
+    rows = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        rows.append({'module': name.strip(), 'depth': depth, 'self_seconds': int(self_us) / 1e6,
+                     'cumulative_seconds': int(cumulative_us) / 1e6})
+    return pd.DataFrame(rows)
+
+# Function to get the import seconds of the top-level modules of a statement
+def statement_import_seconds(statement, modules):
+    times = import_times(statement)
+    times = times[(times['depth'] == 0) & times['module'].isin(modules)]
+    return float(times['cumulative_seconds'].sum())
+
+# Function to print the slowest modules imported directly by grid_search.py
+def print_import_report(top=10):
+    times = import_times('import grid_search')
+    end = times.index[times['module'] == 'grid_search'][-1]
+    # a module is printed after the modules it imports, so the ones of grid_search follow the previous top-level module
+    previous = times.index[(times['depth'] == 0) & (times.index < end)]
+    imported = times.loc[(previous.max() + 1 if len(previous) else 0):end - 1]
+    total = times.loc[end, 'cumulative_seconds']
+    direct = imported[imported['depth'] == 1].sort_values('cumulative_seconds', ascending=False).head(top)
+    print(f"import grid_search: {total:.3f} s, slowest imports:")
+    for row in direct.itertuples():
+        print(f"  {row.module:<32} {row.cumulative_seconds:8.3f} s")
+
+# Function to benchmark the startup of grid_search.py, yields (benchmark, params, best, mean, error)
+def benchmark_startup(repeats):
+    print_import_report()
+    backends = dict(BACKEND_MODULES, batched=BATCHED_BACKEND_MODULES)
+    seconds = {'import_grid_search': ('import grid_search', ['grid_search'])}
+    for name, modules in backends.items():
+        # on top of grid_search, so only the cost of the backend itself counts
+        seconds[f"import_backend_{name}"] = ('import grid_search; ' + '; '.join(f"import {module}" for module in modules), modules)
+    for benchmark, (statement, modules) in seconds.items():
+        times = []
+        for _ in range(repeats):
+            times.append(statement_import_seconds(statement, modules))
+        yield benchmark, 'python -X importtime', min(times), float(np.mean(times)), ''
+
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'grid_search.py')
+    yield ('startup_help', 'python grid_search.py --help',
+           *time_function(lambda: subprocess.run([sys.executable, script, '--help'], capture_output=True, check=True), repeats))
+
+# Function to print the best time of every benchmark for every commit, in the order the commits were first benchmarked
+def compare(output):
+    results = pd.read_csv(output)
+    commits = list(dict.fromkeys(results['commit']))
+    # latest run of every benchmark on every commit
+    latest = results.drop_duplicates(['commit', 'size', 'benchmark', 'params'], keep='last')
+    table = latest.pivot_table(index=['size', 'benchmark'], columns='commit', values='best_seconds', aggfunc='first')
+    print(table[[commit for commit in commits if commit in table.columns]].to_string(float_format=lambda value: f"{value:.4f}"))
+
+def main():
+    parser = create_parser()
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(args.output)
+        return
+
+    commit = current_commit()
+    date = datetime.datetime.now().isoformat(timespec='seconds')
+    rows = []
+    for size in args.size:
+        num_variants, embedding_dim = library_size(size)
+        layouts = ['npys']
+        if 'io' in args.groups:
+            layouts += [layout for layout in args.io_layouts if layout in LAYOUTS and layout != 'npys']
+            if 'concatenate' in args.io_layouts:
+                layouts.append('per_variant')
+        dataset_name = ensure_dataset(args.data_dir, num_variants, embedding_dim, layouts)
+
+        benchmarks = []
+        if 'startup' in args.groups:
+            benchmarks.append(benchmark_startup(args.repeats))
+        if 'io' in args.groups:
+            benchmarks.append(benchmark_io(args.data_dir, dataset_name, args.io_layouts, args.repeats))
+        if 'top_layer' in args.groups or 'simulation' in args.groups:
+            embeddings, labels, _ = read_data(dataset_name, args.data_dir, 'npys', ['random'])
+            if 'top_layer' in args.groups:
+                benchmarks.append(benchmark_top_layer(embeddings, labels, args.regression_types, args.num_train,
+                                                      args.num_mutants_per_round, args.repeats))
+            if 'simulation' in args.groups:
+                benchmarks.append(benchmark_simulation(embeddings, labels, args.learning_strategies, args.num_iterations,
+                                                       args.num_mutants_per_round, args.repeats))
+
+        for benchmark in benchmarks:
+            for name, params, best, mean, error in benchmark:
+                print(f"{size:>7} {name:<36} best {best:9.4f} s  mean {mean:9.4f} s  {error}")
+                rows.append({'commit': commit, 'date': date, 'host': platform.node(), 'size': size,
+                             'num_variants': num_variants, 'embedding_dim': embedding_dim, 'benchmark': name,
+                             'params': params, 'repeats': args.repeats, 'best_seconds': best, 'mean_seconds': mean,
+                             'error': error})
+
+    pd.DataFrame(rows).to_csv(args.output, mode='a', header=not os.path.exists(args.output), index=False)
+    print(f"Appended {len(rows)} timings of {commit} to {args.output}")
+
+if __name__ == "__main__":
+    main()
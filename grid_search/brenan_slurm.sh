@@ -86,6 +86,7 @@ python3 -u grid_search.py \
     --base_path ../esm-extract/results_means \
     --num_simulations 10 \
     --num_iterations 2 3 4 5 6 7 8 9 10 11 \
+    --share_prefixes \
     --measured_var fitness \
     --learning_strategies top10 \
     --num_mutants_per_round 16 \
@@ -101,6 +102,7 @@ python3 -u grid_search.py \
     --base_path ../esm-extract/results_means \
     --num_simulations 10 \
     --num_iterations 2 3 4 5 6 7 8 9 10 11 \
+    --share_prefixes \
     --measured_var fitness \
     --learning_strategies top10 \
     --num_mutants_per_round 16 \
@@ -117,6 +119,7 @@ python3 -u grid_search.py \
     --base_path ../esm-extract/results_means \
     --num_simulations 10 \
     --num_iterations 2 3 4 5 6 7 8 9 10 11 \
+    --share_prefixes \
     --measured_var fitness \
     --learning_strategies top10 \
     --num_mutants_per_round 16 \
@@ -133,6 +136,7 @@ python3 -u grid_search.py \
     --base_path ../esm-extract/results_means \
     --num_simulations 10 \
     --num_iterations 2 3 4 5 6 7 8 9 10 11 \
+    --share_prefixes \
     --measured_var fitness \
     --learning_strategies top10 \
     --num_mutants_per_round 16 \
@@ -0,0 +1,135 @@
+import argparse
+import heapq
+import json
+import sqlite3
+
+import numpy as np
+
+from sharding import REGRESSION_COST
+
+# Runtime model of the top layer rounds of grid_search.py, used to run the most expensive batches of tasks first and to
+# project the wall-clock of a grid before it starts. The time of a round (fit and predict) of each regression type is
+# modeled as seconds = exp(intercept) * n_train^n_train_exponent * n_features^n_features_exponent, fit on the round
+# times that grid_search.py saves in its result stores:
+#   python cost_model.py results/*.sqlite --output cost_model.json
+#   python grid_search.py ... --cost_model cost_model.json
+# Regression types without enough timings keep the default model, the relative costs of sharding.py scaled to the
+# time of a ridge round on a brenan-sized library (0.055 s for 97 training variants of 1280 features), linear in both.
+
+# Time of a ridge round of the default model, and the size it was measured at
+RIDGE_ROUND_SECONDS = 0.055
+REFERENCE_N_TRAIN = 97
+REFERENCE_N_FEATURES = 1280
+
+# Minimum number of timed rounds to fit the model of a regression type
+MIN_TIMINGS = 10
+
+# Create the parser for the command line arguments
+def create_parser():
+    parser = argparse.ArgumentParser(description="Calibrate the runtime model of grid_search.py from the round times saved in its result stores.")
+    parser.add_argument("stores", type=str, nargs="+", help="Result stores (.sqlite) of past grid_search.py runs")
+    parser.add_argument("--output", type=str, default="cost_model.json", help="Path of the calibrated model. Default: cost_model.json")
+    return parser
+
+# Function to get the default model of a regression type
+def default_coefficients(regression_type):
+    seconds = RIDGE_ROUND_SECONDS * REGRESSION_COST.get(regression_type, 1)
+    return {'intercept': float(np.log(seconds / (REFERENCE_N_TRAIN * REFERENCE_N_FEATURES))), 'n_train_exponent': 1.0,
+            'n_features_exponent': 1.0}
+
+class CostModel:
+    def __init__(self, coefficients=None):
+        self.coefficients = coefficients if coefficients is not None else {}
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            return cls(json.load(f))
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.coefficients, f, indent=2, sort_keys=True)
+
+    # Function to fit the model of every regression type with enough timings, from (regression_type, n_train,
+    # n_features, seconds) rows. With a single embedding size the features exponent is kept at 1
+    @classmethod
+    def fit(cls, timings):
+        by_type = {}
+        for regression_type, n_train, n_features, seconds in timings:
+            if seconds is not None and seconds > 0 and n_train > 0:
+                by_type.setdefault(regression_type, []).append((n_train, n_features, seconds))
+        coefficients = {}
+        for regression_type, rows in by_type.items():
+            if len(rows) < MIN_TIMINGS:
+                continue
+            n_train, n_features, seconds = (np.log(np.array(column, dtype=np.float64)) for column in zip(*rows))
+            if np.ptp(n_features) > 0:
+                design = np.column_stack([np.ones_like(n_train), n_train, n_features])
+                (intercept, n_train_exponent, n_features_exponent), *_ = np.linalg.lstsq(design, seconds, rcond=None)
+            else:
+                design = np.column_stack([np.ones_like(n_train), n_train])
+                (intercept, n_train_exponent), *_ = np.linalg.lstsq(design, seconds - n_features, rcond=None)
+                n_features_exponent = 1.0
+            coefficients[regression_type] = {'intercept': float(intercept), 'n_train_exponent': float(n_train_exponent),
+                                             'n_features_exponent': float(n_features_exponent), 'timings': len(rows)}
+        return cls(coefficients)
+
+    # Function to predict the seconds of a round
+    def round_seconds(self, regression_type, n_train, n_features):
+        coefficients = self.coefficients.get(regression_type, default_coefficients(regression_type))
+        return float(np.exp(coefficients['intercept'] + coefficients['n_train_exponent'] * np.log(max(n_train, 1))
+                            + coefficients['n_features_exponent'] * np.log(max(n_features, 1))))
+
+    # Function to predict the seconds of a (combination, seeds) task. The training set starts from the first round
+    # (num_mutants_per_round and WT) and grows by the variants selected every round
+    def task_seconds(self, task, n_features):
+        combination, seeds = task
+        strategy, _, iterations, mutants_per_round, _, regression_type, _ = combination
+        selected_per_round = int(mutants_per_round / 2) if strategy == 'top5bottom5' else mutants_per_round
+        seconds = sum(self.round_seconds(regression_type, mutants_per_round + 1 + (j - 2) * selected_per_round, n_features)
+                      for j in range(2, iterations + 1))
+        return seconds * len(seeds)
+
+# Function to project the wall-clock of running jobs of the given seconds in order on num_workers workers, each job
+# going to the first worker that is free like a process pool
+def projected_wall_clock(job_seconds, num_workers):
+    workers = [0.0] * max(num_workers, 1)
+    for seconds in job_seconds:
+        heapq.heappush(workers, heapq.heappop(workers) + seconds)
+    return max(workers)
+
+# Function to format a duration in seconds
+def format_duration(seconds):
+    if seconds >= 3600:
+        return f"{int(seconds // 3600)}h{int(seconds % 3600 // 60):02d}m"
+    if seconds >= 60:
+        return f"{int(seconds // 60)}m{int(seconds % 60):02d}s"
+    return f"{seconds:.1f}s"
+
+# Function to read the round times saved in result stores
+def read_timings(paths):
+    timings = []
+    for path in paths:
+        connection = sqlite3.connect(path)
+        try:
+            timings.extend(connection.execute("SELECT regression_type, n_train, n_features, seconds FROM timings"))
+        except sqlite3.OperationalError:
+            # store without timings
+            pass
+        connection.close()
+    return timings
+
+def main():
+    parser = create_parser()
+    args = parser.parse_args()
+
+    timings = read_timings(args.stores)
+    model = CostModel.fit(timings)
+    for regression_type, coefficients in sorted(model.coefficients.items()):
+        print(f"{regression_type}: {coefficients['timings']} rounds, seconds = {np.exp(coefficients['intercept']):.3g} "
+              f"* n_train^{coefficients['n_train_exponent']:.2f} * n_features^{coefficients['n_features_exponent']:.2f}")
+    model.save(args.output)
+    print(f"Saved the model of {len(model.coefficients)} regression types ({len(timings)} timed rounds) to {args.output}")
+
+if __name__ == "__main__":
+    main()
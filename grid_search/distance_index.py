@@ -0,0 +1,61 @@
+import numpy as np
+
+# Distance of every variant of the library to its closest training variant, for the dist learning strategy. The
+# training set of a simulation only grows, by the variants selected each round, so instead of the full
+# |test| x |train| distance matrix of every round the index keeps the running minimum distance of every variant and
+# only updates it with the newly selected variants (|library| x |batch| per round). Distances are float32 and computed
+# over blocks of block_rows library variants, which bounds the memory on large libraries.
+# The float32 features (and their squared norms) are built once per run by DistanceFeatures and shared read-only by
+# the indexes of every simulation (and, forked, by the worker processes), so an index only holds its minimum distances.
+# The features are centered first: embeddings of single mutants are nearly identical, and without centering their
+# common offset dominates ||a||^2 + ||b||^2 - 2 a.b, whose float32 cancellation would then swamp the distances.
+
+# Library variants per block of the distance update
+BLOCK_ROWS = 4096
+
+class DistanceFeatures:
+    def __init__(self, X, block_rows=BLOCK_ROWS):
+        X = np.asarray(X)
+        mean = X.mean(axis=0, dtype=np.float64)
+        # centered block by block, so no float64 copy of the whole library is made
+        self.X = np.empty(X.shape, dtype=np.float32)
+        self.squared_norms = np.empty(len(X), dtype=np.float32)
+        for start in range(0, len(X), block_rows):
+            block = X[start:start + block_rows] - mean
+            self.X[start:start + block_rows] = block
+            self.squared_norms[start:start + block_rows] = np.einsum('ij,ij->i', block, block)
+        self.X.flags.writeable = False
+        self.squared_norms.flags.writeable = False
+
+    def __len__(self):
+        return len(self.X)
+
+class DistanceIndex:
+    # features: the DistanceFeatures of the library, shared by every index (built from X, the embeddings, if None)
+    def __init__(self, X=None, block_rows=BLOCK_ROWS, features=None):
+        self.features = features if features is not None else DistanceFeatures(X, block_rows)
+        self.block_rows = block_rows
+        self.min_squared_distance = np.full(len(self.features), np.inf, dtype=np.float32)
+
+    # Function to add variants to the training set, updating the minimum distance of every variant
+    def add(self, idx_new):
+        idx_new = np.asarray(idx_new)
+        if len(idx_new) == 0:
+            return
+        X, squared_norms = self.features.X, self.features.squared_norms
+        X_new = X[idx_new]
+        squared_norms_new = squared_norms[idx_new]
+        for start in range(0, len(X), self.block_rows):
+            block = slice(start, start + self.block_rows)
+            # ||a - b||^2 = ||a||^2 + ||b||^2 - 2 a.b
+            squared_distances = X[block] @ X_new.T
+            squared_distances *= -2
+            squared_distances += squared_norms[block, None]
+            squared_distances += squared_norms_new[None, :]
+            np.minimum(self.min_squared_distance[block], squared_distances.min(axis=1), out=self.min_squared_distance[block])
+        # a training variant is at distance 0 of itself, whatever the rounding
+        self.min_squared_distance[idx_new] = 0
+
+    # Function to get the distance of the given variants to their closest training variant
+    def distances(self, idx):
+        return np.sqrt(np.maximum(self.min_squared_distance[idx], 0))
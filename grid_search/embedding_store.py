@@ -0,0 +1,154 @@
+import argparse
+import hashlib
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+# Binary embedding store: one 2-D .npy matrix, the variant of each row and a json with the column views.
+#   {prefix}.npy           float32 (or float16) matrix, rows sorted by variant
+#   {prefix}_variants.txt  one variant per line, aligned to the rows of the matrix
+#   {prefix}.json          dtype, shape, source layout and the column range of each view
+# Rows written by esm-extract/concatenate.py follow the same layout.
+# A store is written matrix first, then the json and the variant index last, each through a temporary file. The json
+# holds the shape of the matrix and a hash of the index, so a store left half-written by a crash (e.g. a new matrix
+# with the old index) fails to open instead of silently misaligning its rows and variants.
+
+# Column views of the matrix converted from a pts file, 'both' is the whole row
+PT_VIEWS = ('average', 'mutated')
+
+# Create the parser for the command line arguments
+def create_parser():
+    parser = argparse.ArgumentParser(description="Convert csvs/pts embeddings into a binary embedding store that read_data opens with np.memmap.")
+    parser.add_argument("input_file", type=str, help="Embeddings csv (variants x features) or pt (dict of {'average', 'mutated'} tensors) file")
+    parser.add_argument("output_prefix", type=str, help="Prefix of the store, e.g. ../esm-extract/results_means/npys/esm2_15B_brenan")
+    parser.add_argument("--dtype", type=str, default="float32", help="Dtype of the stored matrix. Options: float32 float16. Default: float32")
+    parser.add_argument("--chunksize", type=int, default=2048, help="Rows of the csv parsed at a time. Default: 2048")
+    return parser
+
+# Function to get the paths of the files of a store
+def store_paths(prefix):
+    return prefix + '.npy', prefix + '_variants.txt', prefix + '.json'
+
+# Function to hash the variant index of a store
+def variants_hash(variants_text):
+    return hashlib.sha1(variants_text.encode()).hexdigest()
+
+# Function to write the variant index and metadata of a store, once its matrix is in place. Both are written to
+# temporary files first and the index is replaced last
+def write_store_index(prefix, variants, matrix_shape, dtype, views, source):
+    _, variants_path, meta_path = store_paths(prefix)
+    variants_text = '\n'.join(variants) + '\n'
+    meta = {'dtype': np.dtype(dtype).name, 'shape': list(matrix_shape), 'source': source, 'views': views,
+            'variants_sha1': variants_hash(variants_text)}
+    with open(variants_path + '.tmp', 'w') as f:
+        f.write(variants_text)
+    with open(meta_path + '.tmp', 'w') as f:
+        json.dump(meta, f, indent=2)
+    os.replace(meta_path + '.tmp', meta_path)
+    os.replace(variants_path + '.tmp', variants_path)
+
+# Function to read the variant index and metadata of a store, checking that the index is the one of the metadata
+def read_store_index(prefix):
+    _, variants_path, meta_path = store_paths(prefix)
+    with open(variants_path) as f:
+        variants_text = f.read()
+    with open(meta_path) as f:
+        meta = json.load(f)
+    variants = variants_text.splitlines()
+    # stores written before the hash was added are only checked by their number of rows
+    if ('variants_sha1' in meta and meta['variants_sha1'] != variants_hash(variants_text)) or len(variants) != meta['shape'][0]:
+        raise ValueError(f"{prefix}: the variant index does not match the store (interrupted write?), rebuild the store")
+    return variants, meta
+
+# Function to count the data rows of a csv without parsing it
+def count_csv_rows(csv_file):
+    with open(csv_file, 'rb') as f:
+        return sum(1 for _ in f) - 1
+
+# Function to convert an embeddings csv (index column = variant) into a store
+def convert_csv(csv_file, prefix, dtype='float32', chunksize=2048):
+    num_rows = count_csv_rows(csv_file)
+    matrix_path, _, _ = store_paths(prefix)
+
+    # Parse the csv in chunks straight into a preallocated matrix
+    matrix = None
+    variants = []
+    start = 0
+    for chunk in pd.read_csv(csv_file, index_col=0, chunksize=chunksize):
+        if matrix is None:
+            matrix = np.lib.format.open_memmap(matrix_path + '.tmp', mode='w+', dtype=dtype, shape=(num_rows, chunk.shape[1]))
+        matrix[start:start + len(chunk)] = chunk.to_numpy(dtype=dtype)
+        variants.extend(chunk.index.astype(str))
+        start += len(chunk)
+
+    views = {'embeddings': [0, matrix.shape[1]]}
+    _sort_and_save(matrix, matrix_path, variants, prefix, dtype, views, source='csvs')
+
+# Function to convert a dict of {'average': tensor, 'mutated': tensor} per variant into a store
+def convert_pt(pt_file, prefix, dtype='float32'):
+    import torch
+
+    embeddings = torch.load(pt_file)
+    variants = sorted(embeddings)
+    width = embeddings[variants[0]]['average'].numel()
+    matrix_path, _, _ = store_paths(prefix)
+
+    # average and mutated side by side, so every view is a contiguous column range
+    matrix = np.lib.format.open_memmap(matrix_path, mode='w+', dtype=dtype, shape=(len(variants), width * len(PT_VIEWS)))
+    for i, variant in enumerate(variants):
+        for j, view in enumerate(PT_VIEWS):
+            matrix[i, j * width:(j + 1) * width] = embeddings[variant][view].numpy()
+    matrix.flush()
+
+    views = {view: [j * width, (j + 1) * width] for j, view in enumerate(PT_VIEWS)}
+    views['both'] = [0, width * len(PT_VIEWS)]
+    write_store_index(prefix, variants, matrix.shape, dtype, views, source='pts')
+
+# Function to write the rows of a temporary matrix sorted by variant
+def _sort_and_save(matrix, matrix_path, variants, prefix, dtype, views, source):
+    shape = matrix.shape
+    order = np.argsort(np.asarray(variants, dtype=object), kind='stable')
+    if np.array_equal(order, np.arange(len(order))):
+        matrix.flush()
+        del matrix
+        os.replace(matrix_path + '.tmp', matrix_path)
+    else:
+        sorted_matrix = np.lib.format.open_memmap(matrix_path, mode='w+', dtype=dtype, shape=matrix.shape)
+        for start in range(0, len(order), 4096):
+            sorted_matrix[start:start + 4096] = matrix[order[start:start + 4096]]
+        sorted_matrix.flush()
+        del matrix, sorted_matrix
+        os.remove(matrix_path + '.tmp')
+    sorted_variants = [variants[i] for i in order]
+    write_store_index(prefix, sorted_variants, shape, dtype, views, source)
+
+# Function to open a store without reading it into memory, returns a zero-copy view of the matrix and the variants
+def open_store(prefix, view=None):
+    matrix_path, _, _ = store_paths(prefix)
+    variants, meta = read_store_index(prefix)
+    matrix = np.load(matrix_path, mmap_mode='r')
+    if list(matrix.shape) != meta['shape']:
+        raise ValueError(f"{prefix}: the matrix has shape {matrix.shape}, the store index {tuple(meta['shape'])} (interrupted write?), rebuild the store")
+
+    if view is None:
+        return matrix, variants, meta
+    if view not in meta['views']:
+        raise ValueError(f"Invalid view '{view}'. Options: {' '.join(meta['views'])}")
+    start, end = meta['views'][view]
+    return matrix[:, start:end], variants, meta
+
+def main():
+    parser = create_parser()
+    args = parser.parse_args()
+    os.makedirs(os.path.dirname(os.path.abspath(args.output_prefix)), exist_ok=True)
+    if args.input_file.endswith('.csv'):
+        convert_csv(args.input_file, args.output_prefix, dtype=args.dtype, chunksize=args.chunksize)
+    elif args.input_file.endswith('.pt'):
+        convert_pt(args.input_file, args.output_prefix, dtype=args.dtype)
+    else:
+        raise ValueError("Invalid input file. Please provide a .csv or .pt file")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+import hashlib
+from collections import OrderedDict
+
+import numpy as np
+
+# Cache of the top layer outputs (metrics and predictions of the test variants) keyed by the identity of
+# the training set. The combinations that only differ in learning strategy train on the same first round, and the
+# ones that only differ in num_iterations run the same rounds, so their fits are only computed once. Entries are
+# evicted least recently used first once the cached arrays exceed max_bytes.
+
+# Function to hash the (sorted) indices of the training variants
+def training_set_key(idx_train):
+    return hashlib.sha1(np.ascontiguousarray(idx_train, dtype=np.int64).tobytes()).hexdigest()
+
+# Function to get the memory used by the arrays of a cached value
+def value_nbytes(value):
+    nbytes = 0
+    for item in value:
+        if isinstance(item, np.ndarray):
+            nbytes += item.nbytes
+        elif isinstance(item, tuple):
+            nbytes += value_nbytes(item)
+    return nbytes
+
+# Function to make the arrays of a cached value read-only, since hits share them
+def freeze(value):
+    for item in value:
+        if isinstance(item, np.ndarray):
+            item.flags.writeable = False
+        elif isinstance(item, tuple):
+            freeze(item)
+    return value
+
+# Least recently used cache bounded by the memory of its arrays
+class FitCache:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self.entries[key][0]
+        self.misses += 1
+        return None
+
+    def put(self, key, value):
+        nbytes = value_nbytes(value)
+        if nbytes > self.max_bytes:
+            return value
+        if key in self.entries:
+            self.nbytes -= self.entries.pop(key)[1]
+        self.entries[key] = (freeze(value), nbytes)
+        self.nbytes += nbytes
+        while self.nbytes > self.max_bytes:
+            _, (_, evicted_nbytes) = self.entries.popitem(last=False)
+            self.nbytes -= evicted_nbytes
+        return value
@@ -1,33 +1,44 @@
 import pandas as pd
 import numpy as np
-from sklearn import linear_model, preprocessing
-import matplotlib.pyplot as plt
+from sklearn import linear_model
 from sklearn.metrics import r2_score, mean_squared_error
-from sklearn.preprocessing import StandardScaler
-import seaborn as sns
-from scipy.spatial.distance import cdist
-from sklearn.utils import resample
-from sklearn.model_selection import train_test_split
-from sklearn.neural_network import MLPRegressor
-from sklearn.ensemble import RandomForestRegressor
 from sklearn.exceptions import ConvergenceWarning
-import xgboost
-from sklearn.decomposition import PCA
 import warnings
 import random
+import math
 import time
 import os
 import sys
 import argparse
-import torch
-from sklearn.cluster import KMeans
-from sklearn_extra.cluster import KMedoids
+import importlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from embedding_store import open_store
+from preprocessing_cache import cached_array, cached_transform, fingerprint, pca_projection
+from medoids import CLARA_THRESHOLD, fit_medoids
+from incremental_models import IncrementalTopLayer
+from fit_cache import FitCache, training_set_key
+from distance_index import DistanceFeatures, DistanceIndex
+from result_store import ResultStore
+from sharding import shard_simulations, shard_store_path, slurm_shard_index
+from cost_model import CostModel, format_duration, projected_wall_clock
+from running_stats import RunningStats
+import tracing
 
 # Ignore FutureWarnings and SettingWithCopyWarnings
 warnings.filterwarnings("ignore", category=FutureWarning)
 warnings.filterwarnings("ignore", category=ConvergenceWarning, module="sklearn.neural_network")
 pd.options.mode.chained_assignment = None  # default='warn'
 
+# Round assigned to variants that have not been selected yet
+UNSELECTED = 1001
+
+# Modules only imported when the grid uses the regression type or first round strategy they back (torch for the batched
+# backends and pts files). A csvs ridge run imports none of them
+BACKEND_MODULES = {'neuralnet': ['sklearn.neural_network'], 'randomforest': ['sklearn.ensemble'], 'gradientboosting': ['xgboost'],
+                   'diverse_medoids': ['sklearn_extra.cluster']}
+BATCHED_BACKEND_MODULES = ['torch', 'batched_ridge', 'batched_mlp']
+
 # Create the parser for the command line arguments
 def create_parser():
     parser = argparse.ArgumentParser(description="Run experiments with different combinations of grid search variables.")
@@ -41,8 +52,27 @@ def create_parser():
     parser.add_argument("--first_round_strategies", type=str, nargs="+", help="Type of first round strategy. Options: random diverse_medoids representative_hie")
     parser.add_argument("--embedding_types", type=str, nargs="+", help="Types of embeddings to train on. Options: embeddings embeddings_norm embeddings_pca")
     parser.add_argument("--regression_types", type=str, nargs="+", help="Regression types. Options: ridge lasso elasticnet linear neuralnet randomforest gradientboosting")
-    parser.add_argument("--file_type", type=str, help="Type of file to read. Options: csvs pts")
-    parser.add_argument("--embeddings_type_pt", type=str, help="Type of pytorch embeddings to read. Options: average mutated both")
+    parser.add_argument("--file_type", type=str, help="Type of file to read. Options: csvs pts npys")
+    parser.add_argument("--embeddings_type_pt", type=str, help="Type of pytorch (or npys converted from pts) embeddings to read. Options: average mutated both")
+    parser.add_argument("--cache_dir", type=str, default=None, help="Directory of the preprocessing cache (scaled and PCA-projected embeddings), shared by jobs reading the same embeddings. Default: no cache")
+    parser.add_argument("--clara_threshold", type=int, default=CLARA_THRESHOLD, help=f"Libraries with more variants are clustered with CLARA instead of KMedoids in the diverse_medoids first round. Default: {CLARA_THRESHOLD}")
+    parser.add_argument("--incremental", action="store_true", help="Update the top layer of each simulation from round to round instead of fitting it from scratch (exact for ridge, warm starts for the other regression types)")
+    parser.add_argument("--share_prefixes", action="store_true", help="Run one simulation to the largest num_iterations for combinations that only differ in num_iterations, and report every smaller num_iterations from its first rounds (same results as separate runs)")
+    parser.add_argument("--fit_cache_mb", type=float, default=256, help="Memory (MB) of the cache of top layer fits per process, shared by simulations training on the same variants. 0 disables it. Default: 256")
+    parser.add_argument("--ridge_backend", type=str, default="sklearn", help="Backend of the ridge regression type. Options: sklearn (one RidgeCV per simulation and round), batched (all simulations of a combination fit together in the dual). Default: sklearn")
+    parser.add_argument("--neuralnet_backend", type=str, default="sklearn", help="Backend of the neuralnet regression type. Options: sklearn (one MLPRegressor per simulation and round), batched (the networks of all simulations of a combination trained together). Default: sklearn")
+    parser.add_argument("--resume", action="store_true", help="Skip the simulations already saved in the result store (results/{dataset_name}_results.sqlite) by a previous run with the same settings, instead of starting over")
+    parser.add_argument("--num_shards", type=int, default=1, help="Number of shards the grid is split into, e.g. the size of a SLURM job array. Each shard saves its simulations to its own result store, merged into the results csv by merge_shards.py. Default: 1")
+    parser.add_argument("--shard_index", type=int, default=None, help="Shard of the grid to run, from 0 to num_shards - 1. Default: the SLURM_ARRAY_TASK_ID of a job array")
+    parser.add_argument("--cost_model", type=str, default=None, help="Runtime model calibrated by cost_model.py from past runs, used to run the most expensive tasks first and project the wall-clock. Default: built-in estimates per regression type")
+    parser.add_argument("--successive_halving", action="store_true", help="Adaptive search: run halving_min_simulations simulations of every combination, then only give more simulations to the best combinations of each (num_iterations, num_mutants_per_round) bracket")
+    parser.add_argument("--halving_min_simulations", type=int, default=2, help="Simulations of every combination in the first rung of successive halving. Default: 2")
+    parser.add_argument("--halving_eta", type=int, default=2, help="Successive halving keeps the best 1/eta of the combinations of each bracket and gives them eta times more simulations. Default: 2")
+    parser.add_argument("--halving_metric", type=str, default="last_top_fitness_scaled", help="Metric successive halving ranks the combinations by. Options: last_top_fitness_scaled change_median_fitness_scaled. Default: last_top_fitness_scaled")
+    parser.add_argument("--target_ci", type=float, default=None, help="Adaptive replication: start from num_simulations simulations and add simulations to a combination until the half-width of the 95%% confidence interval of its mean last top_fitness_scaled and median_fitness_scaled is below target_ci, or it reaches max_simulations. Default: a fixed num_simulations")
+    parser.add_argument("--max_simulations", type=int, default=30, help="Maximum number of simulations of a combination with --target_ci. Default: 30")
+    parser.add_argument("--trace", type=str, default=None, help="Path of a Chrome trace (.json) of the wall time, CPU time and peak RSS of every stage of the run (see tracing.py), with per-stage and per-cell summary csvs next to it. Default: no trace")
+    parser.add_argument("--n_jobs", type=int, default=1, help="Number of worker processes for the (combination, simulation) tasks. -1 uses all cores. Default: 1")
     return parser
 
 # Function to read in the data
@@ -58,6 +88,8 @@ def read_data(dataset_name, base_path, file_type, first_round_strategies, embedd
         labels_file = os.path.join(base_path, 'labels', dataset_name.split('_')[-1] + '_labels.csv')
         hie_file = os.path.join(base_path, 'hie_temp', dataset_name.split('_')[-1] + '.csv')
         embeddings_file = os.path.join(base_path, 'pts', dataset_name + '.pt')
+        import torch
+
         # Read in pytorch tensor of embeddings
         embeddings = torch.load(embeddings_file)
         # Convert embeddings to a dataframe
@@ -73,15 +105,32 @@ def read_data(dataset_name, base_path, file_type, first_round_strategies, embedd
 
         # Convert embeddings dictionary to a dataframe
         embeddings = pd.DataFrame.from_dict(embeddings, orient='index')
+    elif file_type == "npys":
+        # Binary embedding store written by embedding_store.py or concatenate.py
+        # Memory-map the matrix, the average/mutated/both views are column slices of it (no copy)
+        matrix, variants, meta = open_store(os.path.join(base_path, 'npys', dataset_name))
+        if meta['source'] == 'pts':
+            if embeddings_type not in meta['views']:
+                print("Invalid embeddings_type. Please choose 'average', 'mutated', or 'both'")
+                return None, None
+            start, end = meta['views'][embeddings_type]
+            matrix = matrix[:, start:end]
+        # Labels are named the same way as for the layout the store was converted from
+        labels_name = dataset_name.split('_')[-1] if meta['source'] == 'pts' else dataset_name.split('_')[0]
+        labels_file = os.path.join(base_path, 'labels', labels_name + '_labels.csv')
+        hie_file = os.path.join(base_path, 'hie_temp', labels_name + '.csv')
+        if matrix.dtype == np.float16:
+            matrix = matrix.astype(np.float32)  # half precision is only a storage format
+        embeddings = pd.DataFrame(matrix, index=variants, copy=False)
     else:
-        print("Invalid file type. Please choose either 'csvs' or 'pts'")
+        print("Invalid file type. Please choose either 'csvs', 'pts' or 'npys'")
         return None, None
 
     # Read in labels
     labels = pd.read_csv(labels_file)
 
     # Read in hie
-    if first_round_strategies == "representative_hie":
+    if "representative_hie" in first_round_strategies:
         hie_data = pd.read_csv(hie_file)
     else:
         hie_data = pd.DataFrame()
@@ -90,13 +139,17 @@ def read_data(dataset_name, base_path, file_type, first_round_strategies, embedd
     labels = labels[labels['fitness'].notna()]
 
     # Filter out rows in embeddings where row names are not in labels variant column
-    embeddings = embeddings[embeddings.index.isin(labels['variant'])]
+    # (skipped when nothing is filtered, so a memory-mapped store is not copied)
+    in_labels = embeddings.index.isin(labels['variant'])
+    if not in_labels.all():
+        embeddings = embeddings[in_labels]
 
     # Align labels by variant
     labels = labels.sort_values(by=['variant'])
 
     # Align embeddings by row name
-    embeddings = embeddings.sort_index()
+    if not embeddings.index.is_monotonic_increasing:
+        embeddings = embeddings.sort_index()
 
     # Confirm that labels and embeddings are aligned, reset index
     labels = labels.reset_index(drop=True)
@@ -113,29 +166,28 @@ def read_data(dataset_name, base_path, file_type, first_round_strategies, embedd
     return embeddings, labels, hie_data
 
 # Function to scale the embeddings in the dataframe
-def scale_embeddings(embeddings_df):
+def scale_embeddings(embeddings_df, cache_dir=None, embeddings_fingerprint=None):
     
-    scaler = StandardScaler()
-    scaled_embeddings = scaler.fit_transform(embeddings_df)
+    scaled_embeddings = cached_transform(np.asarray(embeddings_df), 'scale', cache_dir=cache_dir,
+                                         matrix_fingerprint=embeddings_fingerprint)
 
     scaled_embeddings_df = pd.DataFrame(scaled_embeddings)
 
     return scaled_embeddings_df
 
 # Perform PCA on the embeddings
-def pca_embeddings(embeddings_df, labels_df, dataset_name, n_components=8):
-    # Perform PCA on the embeddings
-    pca = PCA(n_components=50)
-    embeddings_pca = pca.fit_transform(embeddings_df)
-    # Get the embeddings for the top n_components
-    embeddings_pca = embeddings_pca[:, :n_components]
+def pca_embeddings(embeddings_df, labels_df, dataset_name, n_components=8, cache_dir=None, embeddings_fingerprint=None):
+    # Perform PCA on the embeddings, only computing the top n_components
+    embeddings_pca = cached_transform(np.asarray(embeddings_df), 'pca', cache_dir=cache_dir,
+                                      matrix_fingerprint=embeddings_fingerprint, n_components=n_components)
     # Convert embeddings to a dataframe
     embeddings_pca_df = pd.DataFrame(embeddings_pca, columns=[f'PCA {i}' for i in range(1, n_components + 1)])
 
     return embeddings_pca_df
 
 # Function for selecting mutants in the first round
-def first_round(labels, embeddings, hie_data, num_mutants_per_round, first_round_strategy='random', random_seed=None):
+def first_round(labels, embeddings, hie_data, num_mutants_per_round, first_round_strategy='random', random_seed=None, medoid_features=None,
+                clara_threshold=CLARA_THRESHOLD):
 
     # Filter out 'WT' variant from labels
     variants_without_WT = labels.variant[labels.variant != 'WT']
@@ -154,15 +206,14 @@ def first_round(labels, embeddings, hie_data, num_mutants_per_round, first_round
             np.random.seed(random_seed)  # Use NumPy's random seed for consistent randomization
         num_clusters = num_mutants_per_round
         
-        # Perform PCA with 100 dimensions
-        pca = PCA(n_components=100)
-        pca_embeddings = pca.fit_transform(embeddings)
-        pca_embeddings_reduced = pca_embeddings[:, :2]
+        # Project the embeddings on their first 2 principal components, unless the projection was computed once for all simulations
+        if medoid_features is None:
+            medoid_features = pca_projection(np.asarray(embeddings), n_components=2)
+        pca_embeddings_reduced = medoid_features
         
-        # Perform K-medoids clustering on PCA embeddings
-        clusters = KMedoids(n_clusters=num_clusters, metric='euclidean', random_state=random_seed).fit(pca_embeddings_reduced)
-        cluster_medoids = clusters.medoid_indices_
-        cluster_labels = clusters.labels_
+        # Perform K-medoids clustering on PCA embeddings (CLARA on large libraries)
+        cluster_medoids, cluster_labels = fit_medoids(pca_embeddings_reduced, num_clusters, random_state=random_seed,
+                                                      clara_threshold=clara_threshold)
 
         # Select one medoid per cluster
         selected_mutants = []
@@ -180,49 +231,64 @@ def first_round(labels, embeddings, hie_data, num_mutants_per_round, first_round
         iteration_one_ids = hie_data.iloc[:, 0].tolist()
     else:
         print("Invalid first round search strategy.")
-        return None, None
-
-    # Create DataFrame for the first round
-    iteration_one = pd.DataFrame({'variant': iteration_one_ids, 'iteration': 1})
-    WT = pd.DataFrame({'variant': 'WT', 'iteration': 0}, index=[0])
-    iteration_one = iteration_one.append(WT)
-
-    # Merge with labels DataFrame and fill null values with 1001
-    labels_one = pd.merge(labels, iteration_one, on='variant', how='left')
-    labels_one.iteration[labels_one.iteration.isnull()] = 1001
-
-    return labels_one, iteration_one
+        return None
+
+    # Round assignment of every variant, aligned to the rows of labels and embeddings
+    rounds = np.full(len(labels), UNSELECTED, dtype=np.int16)
+
+    # Variants that are not in labels are ignored
+    iteration_one_idx = pd.Index(labels.variant).get_indexer(iteration_one_ids)
+    rounds[iteration_one_idx[iteration_one_idx >= 0]] = 1
+    rounds[(labels.variant == 'WT').to_numpy()] = 0
+
+    return rounds
+
+# Function to order values from largest to smallest, breaking ties the same way as DataFrame.sort_values(ascending=False)
+# and, like its na_position='last', ranking NaNs last (in their original order)
+def argsort_descending(values):
+    values = np.asarray(values)
+    nan_mask = np.isnan(values)
+    idx = np.flatnonzero(~nan_mask)
+    order = idx[::-1][values[idx][::-1].argsort(kind='quicksort')]
+    return np.concatenate([order[::-1], np.flatnonzero(nan_mask)])
+
+# Function to get the indices of the k largest values, the same set as argsort_descending(values)[:k] (in no particular
+# order). The values above the k-th largest are found with a partial sort, the full sort is only needed to break ties
+# at the k-th largest value like argsort_descending
+def top_k_descending(values, k):
+    values = np.asarray(values)
+    if k >= len(values):
+        return np.arange(len(values))
+    if k <= 0:
+        return np.empty(0, dtype=np.int64)
+    kth_largest = np.partition(values, len(values) - k)[len(values) - k]
+    top = np.flatnonzero(values >= kth_largest)
+    # ties at the k-th largest value, or NaNs, which the partition does not rank like argsort_descending
+    if len(top) != k or np.isnan(values).any():
+        return argsort_descending(values)[:k]
+    return top
 
 # Active learning function for one iteration
-def top_layer(iter_train, iter_test, embeddings_pd, labels_pd, measured_var, regression_type='ridge', top_n=None, final_round=10):
-    # reset the indices of embeddings_pd and labels_pd
-    embeddings_pd = embeddings_pd.reset_index(drop=True)
-    labels_pd = labels_pd.reset_index(drop=True)
-
-    # save column 'iteration' in the labels dataframe
-    iteration = labels_pd['iteration']
-
-    # save labels
-    labels = labels_pd
-
-    # save mean embeddings as numpy array
-    a = embeddings_pd
-
-    # subset a, y to only include the rows where iteration = iter_train and iter_test
-    idx_train = iteration[iteration.isin(iter_train)].index.to_numpy()
-    idx_test = iteration[iteration.isin([iter_test])].index.to_numpy()
-
-    # subset a to only include the rows where iteration = iter_train and iter_test
-    X_train = a.loc[idx_train, :]
-    X_test = a.loc[idx_test, :]
-
-    y_train = labels[iteration.isin(iter_train)][measured_var]
-    y_train_fitness_scaled = labels[iteration.isin(iter_train)]['fitness_scaled']
-    y_train_fitness_binary = labels[iteration.isin(iter_train)]['fitness_binary']
-
-    y_test = labels[iteration.isin([iter_test])][measured_var]
-    y_test_fitness_scaled = labels[iteration.isin([iter_test])]['fitness_scaled']
-    y_test_fitness_binary = labels[iteration.isin([iter_test])]['fitness_binary']
+def top_layer(X, y, y_scaled, y_binary, rounds, regression_type='ridge', top_n=None, final_round=10, incremental_model=None, fit_cache=None, cache_key=None):
+    # train on every variant selected so far (including WT), test on the rest of the library
+    train_mask = rounds != UNSELECTED
+    idx_train = np.flatnonzero(train_mask)
+    idx_test = np.flatnonzero(~train_mask)
+
+    # with the embeddings, measured_var (cache_key) and model fixed, the outputs only depend on the training set
+    if fit_cache is not None:
+        fit_key = cache_key + (regression_type, top_n, final_round, training_set_key(idx_train))
+        cached = fit_cache.get(fit_key)
+        if cached is not None:
+            return cached
+
+    # column-major like the dataframe slices used before: with fewer variants than embedding dimensions
+    # the linear fit is rank deficient and its least squares solution depends on the memory layout
+    X_train = np.asfortranarray(X[idx_train])
+    X_test = X[idx_test]
+
+    y_train = y[idx_train]
+    y_test = y[idx_test]
 
     # fit
     if regression_type == 'ridge':
@@ -234,179 +300,262 @@ def top_layer(iter_train, iter_test, embeddings_pd, labels_pd, measured_var, reg
     elif regression_type == 'linear':
         model = linear_model.LinearRegression()
     elif regression_type == 'neuralnet':
+        from sklearn.neural_network import MLPRegressor
         model = MLPRegressor(hidden_layer_sizes=(5), max_iter=1000, activation='relu', solver='adam', alpha=0.001,
                              batch_size='auto', learning_rate='constant', learning_rate_init=0.001, power_t=0.5,
                              momentum=0.9, nesterovs_momentum=True, shuffle=True, random_state=1, tol=0.0001,
                              verbose=False, warm_start=False, early_stopping=False, validation_fraction=0.1, beta_1=0.9,
                              beta_2=0.999, epsilon=1e-08)
     elif regression_type == 'randomforest':
+        from sklearn.ensemble import RandomForestRegressor
         model = RandomForestRegressor(n_estimators=100, criterion='friedman_mse', max_depth=None, min_samples_split=2,
                                       min_samples_leaf=1, min_weight_fraction_leaf=0.0, max_features='auto',
                                       max_leaf_nodes=None, min_impurity_decrease=0.0, bootstrap=True, oob_score=False,
                                       n_jobs=None, random_state=1, verbose=0, warm_start=False, ccp_alpha=0.0,
                                       max_samples=None)
     elif regression_type == 'gradientboosting':
+        import xgboost
         model = xgboost.XGBRegressor(objective='reg:squarederror', colsample_bytree=0.3, learning_rate=0.1,
                                      max_depth=5, alpha=10, n_estimators=10)
 
-    model.fit(X_train, y_train)
-
-    # make predictions on train data
-    y_pred_train = model.predict(X_train)
-    y_std_train = np.zeros(len(y_pred_train))
-    # make predictions on test data
-    # NOTE: can work on alternate 2-n round strategies here
-    y_pred_test = model.predict(X_test)
-    y_std_test = np.zeros(len(y_pred_test))
-
-    # calculate metrics
-    train_error = mean_squared_error(y_train, y_pred_train)
-    test_error = mean_squared_error(y_test, y_pred_test)
-    # compute train and test r^2
-    train_r_squared = r2_score(y_train, y_pred_train)
-    test_r_squared = r2_score(y_test, y_pred_test)
-    if regression_type == 'linear' or regression_type == 'neuralnet' or regression_type == 'randomforest' or regression_type == 'gradientboosting':
-        alpha = 0
+    with tracing.span('fit'):
+        if incremental_model is not None:
+            # reuse the model of the previous round
+            model = incremental_model.fit(model, X_train, y_train, idx_train)
+        else:
+            model.fit(X_train, y_train)
+
+    with tracing.span('predict'):
+        # make predictions on train data
+        y_pred_train = model.predict(X_train)
+        # make predictions on test data
+        # NOTE: can work on alternate 2-n round strategies here
+        y_pred_test = model.predict(X_test)
+
+    with tracing.span('metrics'):
+        # calculate metrics
+        train_error = mean_squared_error(y_train, y_pred_train)
+        test_error = mean_squared_error(y_test, y_pred_test)
+        # compute train and test r^2
+        train_r_squared = r2_score(y_train, y_pred_train)
+        test_r_squared = r2_score(y_test, y_pred_test)
+        if regression_type == 'linear' or regression_type == 'neuralnet' or regression_type == 'randomforest' or regression_type == 'gradientboosting':
+            alpha = 0
+        else:
+            alpha = model.alpha_
+        # rank the train and test predictions together (train first) and keep the top final_round + 1 variants
+        idx_all = np.concatenate([idx_train, idx_test])
+        top_idx = idx_all[top_k_descending(np.concatenate([y_pred_train, y_pred_test]), final_round + 1)]
+
+        # Calculate additional metrics
+        median_fitness_scaled = np.nanmedian(y_scaled[top_idx])
+        top_fitness_scaled = np.nanmax(y_scaled[top_idx])
+        fitness_binary_percentage = np.nanmean(y_binary[top_idx])
+
+    outputs = (train_error, test_error, train_r_squared, test_r_squared, alpha, median_fitness_scaled, top_fitness_scaled, fitness_binary_percentage, (idx_test, y_pred_test))
+    if fit_cache is not None:
+        fit_cache.put(fit_key, outputs)
+    return outputs
+
+# Function to get the random seeds of the simulations for a first round strategy
+def simulation_seeds(num_simulations, first_round_strategy='random'):
+    # representative_hie has a fixed first round, so it is only simulated once
+    if first_round_strategy == 'random' or first_round_strategy == 'diverse_medoids':
+        return list(range(num_simulations))
+    return [0]
+
+# Function to select the variants of the next round from the test variants
+def select_variants(learning_strategy, idx_test, y_pred_test, distance_index, num_mutants_per_round, rng):
+    # NOTE: work on alternate 2-n round strategies here
+    if learning_strategy == 'dist':
+        # distance of each test variant to its closest training variant
+        dist_metric_test = distance_index.distances(idx_test)
+        return idx_test[top_k_descending(dist_metric_test, num_mutants_per_round)]
+    elif learning_strategy == 'random':
+        return idx_test[rng.sample(range(len(idx_test)), num_mutants_per_round)]
+    elif learning_strategy == 'top5bottom5':
+        # NOTE: only the top half has ever been selected here, the bottom half was passed to the
+        # non in-place Series.append and dropped. Kept as is so results stay comparable.
+        return idx_test[top_k_descending(y_pred_test, int(num_mutants_per_round/2))]
+    elif learning_strategy == 'top10':
+        return idx_test[top_k_descending(y_pred_test, num_mutants_per_round)]
+    raise ValueError(f"Invalid learning strategy '{learning_strategy}'")
+
+# Function to run one simulation of directed evolution
+def run_simulation(labels, embeddings, hie_data, num_iterations, num_mutants_per_round=10, measured_var='fitness', regression_type='ridge', learning_strategy='top10', top_n=None, final_round=10, first_round_strategy='random', random_seed=0, medoid_features=None, initial_rounds=None, incremental=False, fit_cache=None, cache_key=None, distance_features=None):
+    # Each simulation owns its random generator so that simulations can run in any order (or process)
+    rng = random.Random(random_seed)
+
+    if initial_rounds is not None:
+        # first round planned once for every combination sharing it
+        rounds = initial_rounds.copy()
+    elif first_round_strategy == 'random' or first_round_strategy == 'diverse_medoids':
+        rounds = first_round(labels, embeddings, hie_data, num_mutants_per_round, first_round_strategy=first_round_strategy, random_seed=random_seed,
+                             medoid_features=medoid_features)
     else:
-        alpha = model.alpha_
-    dist_metric_train = cdist(X_train, X_test, metric='euclidean').min(axis=1)
-    dist_metric_test = cdist(X_test, X_train, metric='euclidean').min(axis=1)
-
-    # combine predicted and actual thermostability values with sequence IDs into a new dataframe
-    df_train = pd.DataFrame({'variant': labels.variant[idx_train], 'y_pred': y_pred_train, 'y_actual': y_train, 
-                             'y_actual_scaled': y_train_fitness_scaled, 'y_actual_binary': y_train_fitness_binary,
-                             'dist_metric': dist_metric_train, 'std_predictions': y_std_train})
-    df_test = pd.DataFrame({'variant': labels.variant[idx_test], 'y_pred': y_pred_test, 'y_actual': y_test, 
-                            'y_actual_scaled': y_test_fitness_scaled, 'y_actual_binary': y_test_fitness_binary,
-                            'dist_metric': dist_metric_test, 'std_predictions': y_std_test})
-    df_all = pd.concat([df_train, df_test])
-
-    df_sorted_all = df_all.sort_values('y_pred', ascending=False).reset_index(drop=True)
-
-    # Calculate additional metrics
-    median_fitness_scaled = df_sorted_all.loc[:final_round, 'y_actual_scaled'].median()
-    top_fitness_scaled = df_sorted_all.loc[:final_round, 'y_actual_scaled'].max()
-    fitness_binary_percentage = df_sorted_all.loc[:final_round, 'y_actual_binary'].mean()
+        rounds = first_round(labels, embeddings, hie_data, num_mutants_per_round, first_round_strategy=first_round_strategy)
+
+    # Take the embeddings and labels out of their dataframes once, rounds only index into these arrays
+    X = np.asarray(embeddings)
+    y = labels[measured_var].to_numpy()
+    y_scaled = labels['fitness_scaled'].to_numpy()
+    y_binary = labels['fitness_binary'].to_numpy()
+
+    test_error_list = []
+    train_error_list = []
+    train_r_squared_list = []
+    test_r_squared_list = []
+    alpha_list = []
+    median_fitness_scaled_list = []
+    top_fitness_scaled_list = []
+    fitness_binary_percentage_list = []
+    # size of the training set and time of every round, for the cost model (NaN when the fit came from the cache)
+    n_train_list = []
+    seconds_list = []
+
+    # distance of every variant to the training set, only kept for the dist strategy (on the features shared by the
+    # simulations of the run, if given)
+    distance_index = DistanceIndex(X, features=distance_features) if learning_strategy == 'dist' else None
+    if distance_index is not None:
+        distance_index.add(np.flatnonzero(rounds != UNSELECTED))
+
+    # model carried from round to round with --incremental
+    incremental_model = IncrementalTopLayer(regression_type) if incremental else None
+    # a cache hit skips a fit, which only leaves the next incremental fit unchanged for ridge
+    if fit_cache is not None and (cache_key is None or (incremental and regression_type != 'ridge')):
+        fit_cache = None
+
+    for j in range(2, num_iterations + 1):
+        misses = fit_cache.misses if fit_cache is not None else 0
+        start = time.perf_counter()
+        with tracing.span('top_layer'):
+            train_error, test_error, train_r_squared, test_r_squared, alpha, median_fitness_scaled, top_fitness_scaled, fitness_binary_percentage, (idx_test, y_pred_test) = top_layer(
+                X, y, y_scaled, y_binary, rounds, regression_type=regression_type, top_n=top_n, final_round=final_round,
+                incremental_model=incremental_model, fit_cache=fit_cache, cache_key=cache_key)
+        fit = fit_cache is None or fit_cache.misses > misses
+        n_train_list.append(len(X) - len(idx_test))
+        seconds_list.append(time.perf_counter() - start if fit else np.nan)
+
+        test_error_list.append(test_error)
+        train_error_list.append(train_error)
+        train_r_squared_list.append(train_r_squared)
+        test_r_squared_list.append(test_r_squared)
+        alpha_list.append(alpha)
+        median_fitness_scaled_list.append(median_fitness_scaled)
+        top_fitness_scaled_list.append(top_fitness_scaled)
+        fitness_binary_percentage_list.append(fitness_binary_percentage)
+
+        with tracing.span('select_variants'):
+            selected = select_variants(learning_strategy, idx_test, y_pred_test, distance_index, num_mutants_per_round, rng)
+            rounds[selected] = j
+        if distance_index is not None:
+            with tracing.span('distance_update'):
+                distance_index.add(selected)
+
+    df_metrics = pd.DataFrame({'test_error': test_error_list, 'train_error': train_error_list,
+                            'train_r_squared': train_r_squared_list, 'test_r_squared': test_r_squared_list,
+                            'alpha': alpha_list, 'median_fitness_scaled': median_fitness_scaled_list,
+                            'top_fitness_scaled': top_fitness_scaled_list,
+                            'fitness_binary_percentage': fitness_binary_percentage_list,
+                            'n_train': n_train_list, 'seconds': seconds_list})
+
+    return df_metrics
+
+# Function to fit the models of one round of several simulations together, returns a PrefitModel per simulation (None
+# for the simulations left to top_layer). network_keys identifies the simulation and round of every neuralnet, so its
+# random draws do not depend on the other simulations of the batch
+def fit_models_batched(X, y, idx_train_list, regression_type='ridge', network_keys=None):
+    from batched_ridge import PrefitModel, fit_ridge_gcv_batched
+    from batched_mlp import MLP_PARAMS, fit_mlp_batched
+
+    prefit_models = [None] * len(idx_train_list)
+    if regression_type == 'ridge':
+        # simulations with the same number of training variants are fit together, in the dual while there are fewer
+        # training variants than features
+        same_size = {}
+        for i, idx_train in enumerate(idx_train_list):
+            if len(idx_train) < X.shape[1]:
+                same_size.setdefault(len(idx_train), []).append(i)
+        for group in same_size.values():
+            models = fit_ridge_gcv_batched(np.stack([X[idx_train_list[i]] for i in group]),
+                                           np.stack([y[idx_train_list[i]] for i in group]))
+            for i, model in zip(group, models):
+                prefit_models[i] = PrefitModel(model)
+    elif regression_type == 'neuralnet':
+        models = fit_mlp_batched([X[idx_train] for idx_train in idx_train_list], [y[idx_train] for idx_train in idx_train_list],
+                                 network_keys=network_keys, **MLP_PARAMS)
+        prefit_models = [PrefitModel(model) for model in models]
+    else:
+        raise ValueError(f"No batched backend for regression type '{regression_type}'")
+    return prefit_models
+
+# Function to run the simulations of one combination in lockstep, fitting the models of each round of all of them in
+# one batch. Each simulation starts from its planned first round. Ridge gives the same metrics as run_simulation,
+# neuralnet trains networks like MLPRegressor's from different random initial weights
+def run_simulations_batched(labels, embeddings, initial_rounds_list, seeds, num_iterations, num_mutants_per_round=10,
+                            measured_var='fitness', regression_type='ridge', learning_strategy='top10', top_n=None,
+                            final_round=10, distance_features=None):
+    X = np.asarray(embeddings)
+    y = labels[measured_var].to_numpy()
+    y_scaled = labels['fitness_scaled'].to_numpy()
+    y_binary = labels['fitness_binary'].to_numpy()
+
+    rounds_list = [initial_rounds.copy() for initial_rounds in initial_rounds_list]
+    rngs = [random.Random(seed) for seed in seeds]
+    metrics_lists = [[] for _ in seeds]
+    distance_indexes = [None] * len(seeds)
+    if learning_strategy == 'dist':
+        # one copy of the distance features for all simulations
+        if distance_features is None:
+            distance_features = DistanceFeatures(X)
+        distance_indexes = [DistanceIndex(features=distance_features) for _ in seeds]
+        for distance_index, rounds in zip(distance_indexes, rounds_list):
+            distance_index.add(np.flatnonzero(rounds != UNSELECTED))
+
+    for j in range(2, num_iterations + 1):
+        # the time of the batched fit is shared by its simulations
+        start = time.perf_counter()
+        with tracing.span('fit_batched'):
+            prefit_models = fit_models_batched(X, y, [np.flatnonzero(rounds != UNSELECTED) for rounds in rounds_list],
+                                               regression_type=regression_type, network_keys=[(seed, j) for seed in seeds])
+        batch_seconds = (time.perf_counter() - start) / len(rounds_list)
+        for i, rounds in enumerate(rounds_list):
+            start = time.perf_counter()
+            with tracing.span('top_layer'):
+                *round_metrics, (idx_test, y_pred_test) = top_layer(
+                    X, y, y_scaled, y_binary, rounds, regression_type=regression_type, top_n=top_n, final_round=final_round,
+                    incremental_model=prefit_models[i])
+            metrics_lists[i].append(round_metrics + [len(X) - len(idx_test), batch_seconds + time.perf_counter() - start])
+            with tracing.span('select_variants'):
+                selected = select_variants(learning_strategy, idx_test, y_pred_test, distance_indexes[i], num_mutants_per_round, rngs[i])
+                rounds[selected] = j
+            if distance_indexes[i] is not None:
+                with tracing.span('distance_update'):
+                    distance_indexes[i].add(selected)
 
-    return train_error, test_error, train_r_squared, test_r_squared, alpha, median_fitness_scaled, top_fitness_scaled, fitness_binary_percentage, df_test
+    output_list = []
+    for metrics in metrics_lists:
+        train_error, test_error, train_r_squared, test_r_squared, alpha, median_fitness_scaled, top_fitness_scaled, fitness_binary_percentage, n_train, seconds = (
+            list(column) for column in zip(*metrics)) if metrics else ([] for _ in range(10))
+        output_list.append(pd.DataFrame({'test_error': test_error, 'train_error': train_error,
+                                         'train_r_squared': train_r_squared, 'test_r_squared': test_r_squared,
+                                         'alpha': alpha, 'median_fitness_scaled': median_fitness_scaled,
+                                         'top_fitness_scaled': top_fitness_scaled,
+                                         'fitness_binary_percentage': fitness_binary_percentage,
+                                         'n_train': n_train, 'seconds': seconds}))
+    return output_list
 
 # Function to run n simulations of directed evolution
-def directed_evolution_simulation(labels, embeddings, hie_data, num_simulations, num_iterations, num_mutants_per_round=10, measured_var = 'fitness', regression_type='ridge', learning_strategy='top10', top_n=None, final_round = 10, first_round_strategy = 'random'):
+def directed_evolution_simulation(labels, embeddings, hie_data, num_simulations, num_iterations, num_mutants_per_round=10, measured_var = 'fitness', regression_type='ridge', learning_strategy='top10', top_n=None, final_round = 10, first_round_strategy = 'random', medoid_features=None, incremental=False):
     output_list = []
 
-    if first_round_strategy == 'random' or first_round_strategy == 'diverse_medoids':
-        for i in range(num_simulations):
-            labels_one, iteration_one = first_round(labels, embeddings, hie_data, num_mutants_per_round, first_round_strategy=first_round_strategy, random_seed=i)
-
-            test_error_list = []
-            train_error_list = []
-            train_r_squared_list = []
-            test_r_squared_list = []
-            alpha_list = []
-            median_fitness_scaled_list = []
-            top_fitness_scaled_list = []
-            fitness_binary_percentage_list = []
-
-            labels_new = labels_one
-            iteration_new = iteration_one
-
-            for j in range(2, num_iterations + 1):
-                iteration_old = iteration_new
-
-                train_error, test_error, train_r_squared, test_r_squared, alpha, median_fitness_scaled, top_fitness_scaled, fitness_binary_percentage, df_test_new = top_layer(
-                    iter_train=iteration_old['iteration'].unique().tolist(), iter_test=1001,
-                    embeddings_pd=embeddings, labels_pd=labels_new,
-                    measured_var=measured_var, regression_type=regression_type, top_n=top_n, final_round=final_round)
-
-                test_error_list.append(test_error)
-                train_error_list.append(train_error)
-                train_r_squared_list.append(train_r_squared)
-                test_r_squared_list.append(test_r_squared)
-                alpha_list.append(alpha)
-                median_fitness_scaled_list.append(median_fitness_scaled)
-                top_fitness_scaled_list.append(top_fitness_scaled)
-                fitness_binary_percentage_list.append(fitness_binary_percentage)
-
-                # NOTE: work on alternate 2-n round strategies here
-                if learning_strategy == 'dist':
-                    iteration_new_ids = df_test_new.sort_values(by='dist_metric', ascending=False).head(num_mutants_per_round).variant
-                elif learning_strategy == 'random':
-                    iteration_new_ids = random.sample(list(df_test_new.variant), num_mutants_per_round)
-                elif learning_strategy == 'top5bottom5':
-                    iteration_new_ids = df_test_new.sort_values(by='y_pred', ascending=False).head(int(num_mutants_per_round/2)).variant
-                    iteration_new_ids.append(df_test_new.sort_values(by='y_pred', ascending=False).tail(int(num_mutants_per_round/2)).variant)
-                elif learning_strategy == 'top10':
-                    iteration_new_ids = df_test_new.sort_values(by='y_pred', ascending=False).head(num_mutants_per_round).variant
-
-                iteration_new = pd.DataFrame({'variant': iteration_new_ids, 'iteration': j})
-                iteration_new = iteration_new.append(iteration_old)
-                labels_new = pd.merge(labels, iteration_new, on='variant', how='left')
-                labels_new.iteration[labels_new.iteration.isnull()] = 1001
-
-            df_metrics = pd.DataFrame({'test_error': test_error_list, 'train_error': train_error_list,
-                                    'train_r_squared': train_r_squared_list, 'test_r_squared': test_r_squared_list,
-                                    'alpha': alpha_list, 'median_fitness_scaled': median_fitness_scaled_list,
-                                    'top_fitness_scaled': top_fitness_scaled_list,
-                                    'fitness_binary_percentage': fitness_binary_percentage_list})
-
-            output_list.append(df_metrics)
-        
-    else:
-        labels_one, iteration_one = first_round(labels, embeddings, hie_data, num_mutants_per_round, first_round_strategy=first_round_strategy)
-
-        test_error_list = []
-        train_error_list = []
-        train_r_squared_list = []
-        test_r_squared_list = []
-        alpha_list = []
-        median_fitness_scaled_list = []
-        top_fitness_scaled_list = []
-        fitness_binary_percentage_list = []
-
-        labels_new = labels_one
-        iteration_new = iteration_one
-
-        for j in range(2, num_iterations + 1):
-            iteration_old = iteration_new
-
-            train_error, test_error, train_r_squared, test_r_squared, alpha, median_fitness_scaled, top_fitness_scaled, fitness_binary_percentage, df_test_new = top_layer(
-                iter_train=iteration_old['iteration'].unique().tolist(), iter_test=1001,
-                embeddings_pd=embeddings, labels_pd=labels_new,
-                measured_var=measured_var, regression_type=regression_type, top_n=top_n, final_round=final_round)
-
-            test_error_list.append(test_error)
-            train_error_list.append(train_error)
-            train_r_squared_list.append(train_r_squared)
-            test_r_squared_list.append(test_r_squared)
-            alpha_list.append(alpha)
-            median_fitness_scaled_list.append(median_fitness_scaled)
-            top_fitness_scaled_list.append(top_fitness_scaled)
-            fitness_binary_percentage_list.append(fitness_binary_percentage)
-
-            # NOTE: work on alternate 2-n round strategies here
-            if learning_strategy == 'dist':
-                iteration_new_ids = df_test_new.sort_values(by='dist_metric', ascending=False).head(num_mutants_per_round).variant
-            elif learning_strategy == 'random':
-                iteration_new_ids = random.sample(list(df_test_new.variant), num_mutants_per_round)
-            elif learning_strategy == 'top5bottom5':
-                iteration_new_ids = df_test_new.sort_values(by='y_pred', ascending=False).head(int(num_mutants_per_round/2)).variant
-                iteration_new_ids.append(df_test_new.sort_values(by='y_pred', ascending=False).tail(int(num_mutants_per_round/2)).variant)
-            elif learning_strategy == 'top10':
-                iteration_new_ids = df_test_new.sort_values(by='y_pred', ascending=False).head(num_mutants_per_round).variant
-
-            iteration_new = pd.DataFrame({'variant': iteration_new_ids, 'iteration': j})
-            iteration_new = iteration_new.append(iteration_old)
-            labels_new = pd.merge(labels, iteration_new, on='variant', how='left')
-            labels_new.iteration[labels_new.iteration.isnull()] = 1001
-
-        df_metrics = pd.DataFrame({'test_error': test_error_list, 'train_error': train_error_list,
-                                'train_r_squared': train_r_squared_list, 'test_r_squared': test_r_squared_list,
-                                'alpha': alpha_list, 'median_fitness_scaled': median_fitness_scaled_list,
-                                'top_fitness_scaled': top_fitness_scaled_list,
-                                'fitness_binary_percentage': fitness_binary_percentage_list})
-
+    for i in simulation_seeds(num_simulations, first_round_strategy):
+        df_metrics = run_simulation(labels, embeddings, hie_data, num_iterations, num_mutants_per_round=num_mutants_per_round,
+                                    measured_var=measured_var, regression_type=regression_type, learning_strategy=learning_strategy,
+                                    top_n=top_n, final_round=final_round, first_round_strategy=first_round_strategy, random_seed=i,
+                                    medoid_features=medoid_features, incremental=incremental)
         output_list.append(df_metrics)
- 
+
     return output_list
 
 
@@ -421,33 +570,10 @@ def average_simulations(output_lists):
     
     return mean_metrics, std_metrics
 
-# Function to run the experiment with different combinations of parameters
-def grid_search(dataset_name, base_path, num_simulations, num_iterations, measured_var, learning_strategies,
-                   num_mutants_per_round, first_round_strategies, embedding_types, regression_types, file_type, embeddings_type_pt=None):
-    
-    # read in dataset
-    embeddings, labels, hie_data = read_data(dataset_name, base_path, file_type, embeddings_type_pt)
-
-    # scale embeddings
-    embeddings_norm = scale_embeddings(embeddings)
-
-    # generate embeddings_pca
-    embeddings_pca = pca_embeddings(embeddings, labels, dataset_name, n_components=8)
-
-    # save the embeddings in a list    
-    embeddings_list = {
-        'embeddings': embeddings,
-        'embeddings_norm': embeddings_norm,
-        'embeddings_pca': embeddings_pca
-    }
-
-    # save the labels in a list
-    output_results = {}
-
-    # Initialize the total combinations count
-    total_combinations = 0 
-
-    # Print the total number of combinations
+# Function to list every combination of grid search parameters, in the order they are reported
+def expand_combinations(learning_strategies, measured_var, num_iterations, num_mutants_per_round, embedding_types,
+                        regression_types, first_round_strategies):
+    combinations = []
     for strategy in learning_strategies:
         for var in measured_var:
             for iterations in num_iterations:
@@ -457,99 +583,310 @@ def grid_search(dataset_name, base_path, num_simulations, num_iterations, measur
                     for embedding_type in embedding_types:
                         for regression_type in regression_types:
                             for first_round_strategy in first_round_strategies:
-                                total_combinations += 1
-
-    # Print the corrected total_combinations count
-    print(f"Total combinations: {total_combinations}")
-
-    # Initialize the combination count
-    combination_count = 0
-
-    start_time = time.time()
-
-    for strategy in learning_strategies:
-        output_results[strategy] = {}
-        for var in measured_var:
-            output_results[strategy][var] = {}
-            for iterations in num_iterations:
-                output_results[strategy][var][iterations] = {}
-                for mutants_per_round in num_mutants_per_round:
-                    output_results[strategy][var][iterations][mutants_per_round] = {}
-                    for embedding_type in embedding_types:
-                        output_results[strategy][var][iterations][mutants_per_round][embedding_type] = {}
-                        for regression_type in regression_types:
-                            output_results[strategy][var][iterations][mutants_per_round][embedding_type][regression_type] = {}
-                            for first_round_strategy in first_round_strategies:
-                                output_results[strategy][var][iterations][mutants_per_round][embedding_type][regression_type][first_round_strategy] = {}
-                                if mutants_per_round == 128 and iterations != 3:
-                                    continue  # Skip other iterations when mutants_per_round is 128
-                                combination_count += 1
-                                # print overall progress
-                                print(
-                                    f"Progress: {combination_count}/{total_combinations} "
-                                    f"({(combination_count/total_combinations)*100:.2f}%)"
-                                )
-
-                                # run simulations for current combination of parameters
-                                output_list = directed_evolution_simulation(
-                                    labels=labels,
-                                    embeddings=embeddings_list[embedding_type],
-                                    num_simulations=num_simulations,
-                                    hie_data=hie_data,
-                                    num_iterations=iterations,
-                                    num_mutants_per_round=mutants_per_round,
-                                    measured_var=var,
-                                    regression_type=regression_type,
-                                    learning_strategy=strategy,
-                                    final_round=mutants_per_round,
-                                    first_round_strategy=first_round_strategy  
-                                )
-                                mean_metrics, std_metrics = average_simulations(output_list)
-                                output_results[strategy][var][iterations][mutants_per_round][embedding_type][regression_type][first_round_strategy] = (mean_metrics, std_metrics)
-
-    end_time = time.time()
-    execution_time = end_time - start_time
+                                combinations.append((strategy, var, iterations, mutants_per_round, embedding_type,
+                                                     regression_type, first_round_strategy))
+    return combinations
+
+# Function to get the key of a first round selection. It only depends on the strategy, the number of mutants and the
+# seed (and the embeddings for diverse_medoids), not on the regression type, learning strategy or measured_var
+def first_round_key(embedding_type, first_round_strategy, num_mutants_per_round, seed):
+    if first_round_strategy != 'diverse_medoids':
+        embedding_type = None
+    return (embedding_type, first_round_strategy, num_mutants_per_round, seed)
+
+# Function to compute every distinct first round selection of the grid once, reading them from the cache if possible
+def plan_first_rounds(combinations, num_simulations, labels, embeddings_list, hie_data, medoid_features_list,
+                      cache_dir=None, clara_threshold=CLARA_THRESHOLD):
+    fingerprints = {}
+    if cache_dir is not None:
+        fingerprints['labels'] = fingerprint(labels.variant.to_numpy(dtype=str))
+        if any(combination[6] == 'representative_hie' for combination in combinations):
+            fingerprints['hie'] = fingerprint(hie_data.iloc[:, 0].to_numpy(dtype=str))
+        for embedding_type, medoid_features in medoid_features_list.items():
+            fingerprints[embedding_type] = fingerprint(medoid_features)
+
+    first_rounds = {}
+    for combination in combinations:
+        mutants_per_round, embedding_type, first_round_strategy = combination[3], combination[4], combination[6]
+        for seed in simulation_seeds(num_simulations, first_round_strategy):
+            key = first_round_key(embedding_type, first_round_strategy, mutants_per_round, seed)
+            if key in first_rounds:
+                continue
+
+            random_seed = seed if first_round_strategy in ('random', 'diverse_medoids') else None
+            inputs = [fingerprints.get('labels')]
+            if first_round_strategy == 'diverse_medoids':
+                inputs.append(fingerprints.get(embedding_type))
+            elif first_round_strategy == 'representative_hie':
+                inputs.append(fingerprints.get('hie'))
+            cache_key = {'inputs': inputs, 'strategy': first_round_strategy, 'n': mutants_per_round, 'seed': random_seed,
+                         'clara_threshold': clara_threshold}
+            with tracing.span('first_round'):
+                first_rounds[key] = cached_array(cache_dir, 'first_round', cache_key, lambda: first_round(
+                    labels, embeddings_list[embedding_type], hie_data, mutants_per_round, first_round_strategy=first_round_strategy,
+                    random_seed=random_seed, medoid_features=medoid_features_list.get(embedding_type),
+                    clara_threshold=clara_threshold))
+    return first_rounds
+
+# Function to group the combinations that only differ in num_iterations under the combination with the most iterations.
+# A simulation with more iterations runs the same rounds first, so the smaller ones are prefixes of its metrics
+def group_prefixes(combinations):
+    longest = {}
+    for combination in combinations:
+        key = combination[:2] + combination[3:]
+        if key not in longest or combination[2] > longest[key][2]:
+            longest[key] = combination
+
+    task_members = {}
+    for combination in combinations:
+        task_members.setdefault(longest[combination[:2] + combination[3:]], []).append(combination)
+    return task_members
+
+# Data shared read-only with the worker processes of the process pool
+_shared_data = {}
+
+# Function to import the modules of the regression types and first round strategies of the grid, and torch with a
+# batched backend. Returns the modules
+def import_backends(regression_types, first_round_strategies, batched_types=()):
+    modules = [module for name in list(regression_types) + list(first_round_strategies) for module in BACKEND_MODULES.get(name, [])]
+    if batched_types:
+        modules += BATCHED_BACKEND_MODULES
+    for module in modules:
+        importlib.import_module(module)
+    return modules
+
+# Function to hand the shared data to a worker process (inherited without a copy when the pool forks)
+def _init_worker(labels, embeddings_list, hie_data, first_rounds=None, incremental=False, fit_cache_bytes=0,
+                 batched_types=(), single_thread=True, trace=False, distance_features_list=None):
+    _shared_data['labels'] = labels
+    _shared_data['embeddings_list'] = embeddings_list
+    _shared_data['hie_data'] = hie_data
+    _shared_data['first_rounds'] = first_rounds if first_rounds is not None else {}
+    _shared_data['incremental'] = incremental
+    _shared_data['fit_cache'] = FitCache(fit_cache_bytes) if fit_cache_bytes > 0 else None
+    _shared_data['batched_types'] = batched_types
+    _shared_data['distance_features_list'] = distance_features_list if distance_features_list is not None else {}
+    if trace:
+        # a forked worker inherits the spans of the main process, it only sends back its own
+        tracing.start()
+    if not single_thread:
+        return
+    # one BLAS (and torch) thread per worker, the parallelism comes from the pool. Torch only runs in the batched backends
+    if batched_types:
+        import torch
+        torch.set_num_threads(1)
+    try:
+        from threadpoolctl import threadpool_limits
+        threadpool_limits(1)
+    except ImportError:
+        pass
+
+# Function to run one (combination, simulations) task on the shared data, returns the metrics of every simulation
+def _run_task(task):
+    combination, seeds = task
+    strategy, var, iterations, mutants_per_round, embedding_type, regression_type, first_round_strategy = combination
+    tracing.set_cell('/'.join(map(str, combination)))
+    initial_rounds_list = [_shared_data['first_rounds'].get(first_round_key(embedding_type, first_round_strategy, mutants_per_round, seed))
+                           for seed in seeds]
+
+    if (regression_type in _shared_data['batched_types'] and not _shared_data['incremental']
+            and all(initial_rounds is not None for initial_rounds in initial_rounds_list)):
+        with tracing.span('simulation'):
+            output_list = run_simulations_batched(
+                labels=_shared_data['labels'],
+                embeddings=_shared_data['embeddings_list'][embedding_type],
+                initial_rounds_list=initial_rounds_list,
+                seeds=seeds,
+                num_iterations=iterations,
+                num_mutants_per_round=mutants_per_round,
+                measured_var=var,
+                regression_type=regression_type,
+                learning_strategy=strategy,
+                final_round=mutants_per_round,
+                distance_features=_shared_data['distance_features_list'].get(embedding_type)
+            )
+        return [(combination, seed, df_metrics) for seed, df_metrics in zip(seeds, output_list)]
+
+    results = []
+    for seed, initial_rounds in zip(seeds, initial_rounds_list):
+        with tracing.span('simulation'):
+            df_metrics = run_simulation(
+                labels=_shared_data['labels'],
+                embeddings=_shared_data['embeddings_list'][embedding_type],
+                hie_data=_shared_data['hie_data'],
+                num_iterations=iterations,
+                num_mutants_per_round=mutants_per_round,
+                measured_var=var,
+                regression_type=regression_type,
+                learning_strategy=strategy,
+                final_round=mutants_per_round,
+                first_round_strategy=first_round_strategy,
+                random_seed=seed,
+                initial_rounds=initial_rounds,
+                incremental=_shared_data['incremental'],
+                fit_cache=_shared_data['fit_cache'],
+                cache_key=(embedding_type, var),
+                distance_features=_shared_data['distance_features_list'].get(embedding_type)
+            )
+        results.append((combination, seed, df_metrics))
+    return results
+
+# Function to run a batch of tasks in one process, returns their results, the fit cache hits and misses and the trace
+# spans recorded
+def _run_batch(batch):
+    fit_cache = _shared_data['fit_cache']
+    hits, misses = (fit_cache.hits, fit_cache.misses) if fit_cache is not None else (0, 0)
+    results = [result for task in batch for result in _run_task(task)]
+    if fit_cache is not None:
+        hits, misses = fit_cache.hits - hits, fit_cache.misses - misses
+    tracing.set_cell(None)
+    return results, hits, misses, tracing.drain()
+
+# Function to batch the tasks that only differ in learning strategy and num_iterations. They train on the same
+# first round, so running them one after the other in the same process lets them share its fit cache
+def batch_tasks(tasks):
+    batches = {}
+    for combination, seeds in tasks:
+        key = (combination[1],) + combination[3:] + (seeds,)
+        batches.setdefault(key, []).append((combination, seeds))
+    return list(batches.values())
+
+# Function to get the number of worker processes, -1 for every core available
+def resolve_n_jobs(n_jobs):
+    if n_jobs is not None and n_jobs < 0:
+        # only count the cores this job is allowed to run on (e.g. the SLURM allocation)
+        return len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+    return n_jobs
+
+# Function to run all (combination, simulations) tasks, serially or on a process pool
+def run_tasks(tasks, labels, embeddings_list, hie_data, n_jobs=1, first_rounds=None, incremental=False, fit_cache_bytes=0,
+              cache_stats=None, batched_types=(), task_costs=None, distance_features_list=None):
+    if cache_stats is None:
+        cache_stats = {}
+    cache_stats.setdefault('hits', 0)
+    cache_stats.setdefault('misses', 0)
+    batches = batch_tasks(tasks)
+    if task_costs is not None:
+        # longest batches first, so that the pool does not end on a long batch started last
+        batches.sort(key=lambda batch: -sum(task_costs[task] for task in batch))
+
+    n_jobs = resolve_n_jobs(n_jobs)
+
+    if n_jobs is None or n_jobs <= 1:
+        _init_worker(labels, embeddings_list, hie_data, first_rounds, incremental, fit_cache_bytes, batched_types,
+                     single_thread=False, distance_features_list=distance_features_list)
+        for batch in batches:
+            results, hits, misses, events = _run_batch(batch)
+            cache_stats['hits'] += hits
+            cache_stats['misses'] += misses
+            tracing.add(events)
+            yield from results
+        return
+
+    # fork shares the embeddings with the workers copy-on-write, spawn pickles them once per worker
+    if 'fork' in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context('fork')
+    else:
+        context = multiprocessing.get_context()
+    with ProcessPoolExecutor(max_workers=n_jobs, mp_context=context, initializer=_init_worker,
+                             initargs=(labels, embeddings_list, hie_data, first_rounds, incremental, fit_cache_bytes,
+                                       batched_types, True, tracing.enabled(), distance_features_list)) as executor:
+        futures = [executor.submit(_run_batch, batch) for batch in batches]
+        for future in as_completed(futures):
+            results, hits, misses, events = future.result()
+            cache_stats['hits'] += hits
+            cache_stats['misses'] += misses
+            tracing.add(events)
+            yield from results
+
+# Function to build the tasks running the allotted seeds of every combination. With share_prefixes a task runs the seeds
+# allotted to any of its members, with a batched backend one task runs all seeds of a combination together
+def build_tasks(task_members, allotted, batched_types=()):
+    tasks = []
+    for combination, members in task_members.items():
+        seeds = tuple(sorted(set().union(*(allotted.get(member, ()) for member in members))))
+        if not seeds:
+            continue
+        if combination[5] in batched_types:
+            tasks.append((combination, seeds))
+        else:
+            tasks.extend((combination, (seed,)) for seed in seeds)
+    return tasks
+
+# Function to get the metric the combinations are ranked by in successive halving, from their mean metrics
+def halving_score(mean_metrics, halving_metric='last_top_fitness_scaled'):
+    if halving_metric == 'last_top_fitness_scaled':
+        return mean_metrics['top_fitness_scaled'].iloc[-1]
+    elif halving_metric == 'change_median_fitness_scaled':
+        return mean_metrics['median_fitness_scaled'].iloc[-1] - mean_metrics['median_fitness_scaled'].iloc[0]
+    raise ValueError(f"Invalid halving metric '{halving_metric}'")
+
+# Function to keep the best 1/halving_eta of the combinations of every bracket (same num_iterations and
+# num_mutants_per_round), ranked by the mean of their allotted simulations. Ties keep the grid order
+def halve_combinations(combinations, store, allotted, halving_metric='last_top_fitness_scaled', halving_eta=2):
+    brackets = {}
+    for combination in combinations:
+        simulation_results = store.get(combination)
+        mean_metrics, _ = average_simulations([simulation_results[seed] for seed in allotted[combination]])
+        score = halving_score(mean_metrics, halving_metric)
+        brackets.setdefault((combination[2], combination[3]), []).append((combination, -np.inf if np.isnan(score) else score))
+
+    survivors = set()
+    for bracket in brackets.values():
+        ranked = sorted(bracket, key=lambda item: -item[1])
+        survivors.update(combination for combination, _ in ranked[:max(1, math.ceil(len(ranked) / halving_eta))])
+    return [combination for combination in combinations if combination in survivors]
+
+# Function to get the path of the results of a dataset, without extension
+def results_prefix(dataset_name, embeddings_type_pt=None):
+    if embeddings_type_pt == None:
+        return f"results/{dataset_name}_results"
+    return f"results/{dataset_name}_{embeddings_type_pt}_results"
 
-    print(f"Total execution time: {execution_time:.2f} seconds")
+# Function to get the settings of a run that change its results, the key of its simulations in the result store
+def store_settings(dataset_name, file_type, embeddings_type_pt, incremental, clara_threshold, ridge_backend, neuralnet_backend):
+    return {'dataset_name': dataset_name, 'file_type': file_type, 'embeddings_type_pt': embeddings_type_pt,
+            'incremental': incremental, 'clara_threshold': clara_threshold, 'ridge_backend': ridge_backend,
+            'neuralnet_backend': neuralnet_backend}
 
+# Function to write the results csv, the first and last mean metrics of every combination
+def write_results(combinations, output_results, results_path, simulations_received=None):
     # Save the mean output across simulations for each combination of parameters
     rows = []
     # Iterate over the output_results dictionary and extract the desired information
-    for strategy in learning_strategies:
-        for var in measured_var:
-            for iterations in num_iterations:
-                for mutants_per_round in num_mutants_per_round:
-                    if mutants_per_round == 128 and iterations != 3:
-                        continue  # Skip other iterations when mutants_per_round is 128
-                    for embedding_type in embedding_types:
-                        for regression_type in regression_types:
-                            for first_round_strategy in first_round_strategies:  # Iterate over first_round_strategies
-                                # get the first and last values of the metrics
-                                first_median_fitness_scaled = output_results[strategy][var][iterations][mutants_per_round][embedding_type][regression_type][first_round_strategy][0]['median_fitness_scaled'].iloc[0]
-                                first_top_fitness_scaled = output_results[strategy][var][iterations][mutants_per_round][embedding_type][regression_type][first_round_strategy][0]['top_fitness_scaled'].iloc[0]
-                                first_fitness_binary_percentage = output_results[strategy][var][iterations][mutants_per_round][embedding_type][regression_type][first_round_strategy][0]['fitness_binary_percentage'].iloc[0]                        
-                                last_median_fitness_scaled = output_results[strategy][var][iterations][mutants_per_round][embedding_type][regression_type][first_round_strategy][0]['median_fitness_scaled'].iloc[-1]
-                                last_top_fitness_scaled = output_results[strategy][var][iterations][mutants_per_round][embedding_type][regression_type][first_round_strategy][0]['top_fitness_scaled'].iloc[-1]                        
-                                last_fitness_binary_percentage = output_results[strategy][var][iterations][mutants_per_round][embedding_type][regression_type][first_round_strategy][0]['fitness_binary_percentage'].iloc[-1]
-
-                                # Create a new row with the experimental setup and the metric
-                                new_row = {
-                                    'num_iterations': iterations,
-                                    'measured_var': var,
-                                    'learning_strategy': strategy,
-                                    'num_mutants_per_round': mutants_per_round,
-                                    'embedding_type': embedding_type,
-                                    'regression_type': regression_type,
-                                    'first_round_strategy': first_round_strategy,  # Add first_round_strategy
-                                    'first_median_fitness_scaled': first_median_fitness_scaled,
-                                    'first_top_fitness_scaled': first_top_fitness_scaled,
-                                    'first_fitness_binary_percentage': first_fitness_binary_percentage,
-                                    'last_top_fitness_scaled': last_top_fitness_scaled,
-                                    'last_median_fitness_scaled': last_median_fitness_scaled,
-                                    'last_fitness_binary_percentage': last_fitness_binary_percentage,
-                                }
-                                # Append the new row to the list of rows
-                                rows.append(new_row)
+    for combination in combinations:
+        strategy, var, iterations, mutants_per_round, embedding_type, regression_type, first_round_strategy = combination
+        mean_metrics = output_results[combination][0]
+
+        # get the first and last values of the metrics
+        first_median_fitness_scaled = mean_metrics['median_fitness_scaled'].iloc[0]
+        first_top_fitness_scaled = mean_metrics['top_fitness_scaled'].iloc[0]
+        first_fitness_binary_percentage = mean_metrics['fitness_binary_percentage'].iloc[0]
+        last_median_fitness_scaled = mean_metrics['median_fitness_scaled'].iloc[-1]
+        last_top_fitness_scaled = mean_metrics['top_fitness_scaled'].iloc[-1]
+        last_fitness_binary_percentage = mean_metrics['fitness_binary_percentage'].iloc[-1]
+
+        # Create a new row with the experimental setup and the metric
+        new_row = {
+            'num_iterations': iterations,
+            'measured_var': var,
+            'learning_strategy': strategy,
+            'num_mutants_per_round': mutants_per_round,
+            'embedding_type': embedding_type,
+            'regression_type': regression_type,
+            'first_round_strategy': first_round_strategy,  # Add first_round_strategy
+            'first_median_fitness_scaled': first_median_fitness_scaled,
+            'first_top_fitness_scaled': first_top_fitness_scaled,
+            'first_fitness_binary_percentage': first_fitness_binary_percentage,
+            'last_top_fitness_scaled': last_top_fitness_scaled,
+            'last_median_fitness_scaled': last_median_fitness_scaled,
+            'last_fitness_binary_percentage': last_fitness_binary_percentage,
+        }
+        if simulations_received is not None:
+            # number of simulations the combination was averaged over, with successive halving or target_ci
+            new_row['num_simulations'] = simulations_received[combination]
+        # Append the new row to the list of rows
+        rows.append(new_row)
 
     # create a dataframe from the list of rows
     df_results = pd.DataFrame(rows)
@@ -561,10 +898,238 @@ def grid_search(dataset_name, base_path, num_simulations, num_iterations, measur
     df_results['change_fitness_binary_percentage'] = df_results['last_fitness_binary_percentage'] - df_results['first_fitness_binary_percentage']
 
     # save the dataframe to a csv file using the dataset_name
-    if embeddings_type_pt == None:
-        df_results.to_csv(f"results/{dataset_name}_results.csv", index=False)
+    df_results.to_csv(f"{results_path}.csv", index=False)
+
+# Function to write the timing trace of the run and print its per-stage summary
+def write_run_trace(trace):
+    summary = tracing.write_trace(trace, tracing.drain())
+    print(f"Trace saved to {trace}, per-stage summary:")
+    print(summary.to_string(float_format=lambda value: f"{value:.3f}"))
+
+# Function to run the experiment with different combinations of parameters
+def grid_search(dataset_name, base_path, num_simulations, num_iterations, measured_var, learning_strategies,
+                   num_mutants_per_round, first_round_strategies, embedding_types, regression_types, file_type, embeddings_type_pt=None,
+                   n_jobs=1, cache_dir=None, clara_threshold=CLARA_THRESHOLD, incremental=False,
+                   share_prefixes=False, fit_cache_mb=256, ridge_backend='sklearn', neuralnet_backend='sklearn', resume=False,
+                   shard_index=None, num_shards=1, cost_model=None, successive_halving=False, halving_min_simulations=2,
+                   halving_eta=2, halving_metric='last_top_fitness_scaled', target_ci=None, max_simulations=30,
+                   trace=None):
+    if trace is not None:
+        tracing.start()
+
+    # read in dataset
+    with tracing.span('read_data'):
+        embeddings, labels, hie_data = read_data(dataset_name, base_path, file_type, first_round_strategies,
+                                                 embeddings_type_pt if embeddings_type_pt is not None else 'both')
+
+    # hash the embeddings once, the preprocessing cache is keyed by their content
+    embeddings_fingerprint = fingerprint(embeddings) if cache_dir is not None else None
+
+    # save the embeddings in a list, only preprocessing the embedding types of the grid
+    embeddings_list = {'embeddings': embeddings}
+    if 'embeddings_norm' in embedding_types:
+        # scale embeddings
+        with tracing.span('scale_embeddings'):
+            embeddings_list['embeddings_norm'] = scale_embeddings(embeddings, cache_dir, embeddings_fingerprint)
+    if 'embeddings_pca' in embedding_types:
+        # generate embeddings_pca
+        with tracing.span('pca_embeddings'):
+            embeddings_list['embeddings_pca'] = pca_embeddings(embeddings, labels, dataset_name, n_components=8,
+                                                               cache_dir=cache_dir, embeddings_fingerprint=embeddings_fingerprint)
+
+    # the diverse_medoids first round clusters a 2-component projection, computed once per embedding type
+    medoid_features_list = {}
+    if 'diverse_medoids' in first_round_strategies:
+        for embedding_type in embedding_types:
+            with tracing.span('medoid_features'):
+                medoid_features_list[embedding_type] = cached_transform(np.asarray(embeddings_list[embedding_type]), 'pca',
+                                                                        cache_dir=cache_dir, n_components=2)
+
+    # the dist strategy measures distances on centered float32 features, built once per embedding type and shared by
+    # every simulation (and worker)
+    distance_features_list = {}
+    if 'dist' in learning_strategies:
+        for embedding_type in embedding_types:
+            with tracing.span('distance_features'):
+                distance_features_list[embedding_type] = DistanceFeatures(embeddings_list[embedding_type])
+
+    # Expand the grid and print the total number of combinations
+    combinations = expand_combinations(learning_strategies, measured_var, num_iterations, num_mutants_per_round,
+                                       embedding_types, regression_types, first_round_strategies)
+    total_combinations = len(combinations)
+    print(f"Total combinations: {total_combinations}")
+
+    # Each (combination, simulation) pair is an independent task. With share_prefixes one task runs the longest
+    # simulation of the combinations that only differ in num_iterations, and reports all of them. With a batched
+    # backend one task runs all simulations of a combination of that regression type together
+    if share_prefixes:
+        task_members = group_prefixes(combinations)
     else:
-        df_results.to_csv(f"results/{dataset_name}_{embeddings_type_pt}_results.csv", index=False)
+        task_members = {combination: [combination] for combination in combinations}
+    batched_types = tuple(regression_type for regression_type, backend in (('ridge', ridge_backend), ('neuralnet', neuralnet_backend))
+                          if backend == 'batched')
+    # import the backends of the grid once, before the pool forks, so the workers inherit them
+    with tracing.span('import_backends'):
+        import_backends(regression_types, first_round_strategies, batched_types)
+    # seeds of every combination, all of them unless the grid is sharded
+    # (up to max_simulations with target_ci)
+    if target_ci is not None:
+        if successive_halving:
+            raise ValueError("--target_ci and --successive_halving both decide the simulations of every combination, use one of them")
+        if max_simulations < num_simulations:
+            raise ValueError(f"--max_simulations ({max_simulations}) is smaller than --num_simulations ({num_simulations})")
+    simulations_limit = max_simulations if target_ci is not None else num_simulations
+    grid_seeds = {combination: tuple(simulation_seeds(simulations_limit, combination[-1])) for combination in combinations}
+    # with shards, only run the simulations of this shard
+    if num_shards > 1:
+        if shard_index is None:
+            raise ValueError("--shard_index is required with --num_shards outside of a SLURM job array")
+        if successive_halving or target_ci is not None:
+            raise ValueError("--successive_halving and --target_ci decide the simulations of a combination from all of them, they cannot run on shards")
+        shard = shard_simulations([(combination, seed) for combination in combinations for seed in grid_seeds[combination]],
+                                  shard_index, num_shards)
+        print(f"Shard {shard_index}/{num_shards}: {len(shard)} simulations")
+        grid_seeds = {combination: tuple(seed for seed in seeds if (combination, seed) in shard) for combination, seeds in grid_seeds.items()}
+        combinations = [combination for combination in combinations if grid_seeds[combination]]
+        total_combinations = len(combinations)
+
+    # every simulation is saved to the result store as soon as it finishes, with --resume the ones saved by a previous
+    # run with the same settings are skipped
+    results_path = results_prefix(dataset_name, embeddings_type_pt)
+    store_path = f"{results_path}.sqlite" if num_shards <= 1 else shard_store_path(results_path, shard_index, num_shards)
+    store = ResultStore(store_path, store_settings(dataset_name, file_type, embeddings_type_pt, incremental, clara_threshold,
+                                                   ridge_backend, neuralnet_backend))
+    if not resume:
+        store.clear()
+    completed = store.completed()
+    if resume:
+        print(f"Resuming: {len(completed)} simulations already saved in {store_path}")
+
+    model = CostModel.load(cost_model) if cost_model is not None else CostModel()
+    num_workers = max(resolve_n_jobs(n_jobs) or 1, 1)
+
+    start_time = time.time()
+
+    # compute each distinct first round once, shared by every combination with the same strategy, mutants and seed
+    with tracing.span('plan_first_rounds'):
+        first_rounds = plan_first_rounds(combinations, simulations_limit, labels, embeddings_list, hie_data, medoid_features_list,
+                                         cache_dir=cache_dir, clara_threshold=clara_threshold)
+    print(f"Planned {len(first_rounds)} first rounds for {sum(len(seeds) for seeds in grid_seeds.values())} simulations")
+
+    # With successive halving every combination first runs halving_min_simulations simulations. Then, in every bracket
+    # of combinations with the same num_iterations and num_mutants_per_round (the same number of measured variants),
+    # only the best 1/halving_eta by halving_metric get halving_eta times more simulations, up to num_simulations
+    # With target_ci every combination first runs num_simulations simulations. The ones whose confidence interval of
+    # the mean last top and median fitness is wider than target_ci get the simulations that the standard deviation so
+    # far says they need (at least one more), up to max_simulations
+    rung_simulations = min(halving_min_simulations, num_simulations) if successive_halving else num_simulations
+    rung_allotted = {combination: grid_seeds[combination][:rung_simulations] for combination in combinations}
+    rung = 0
+    # seeds every combination is averaged over, those of the last rung it was in
+    allotted = {}
+    # streaming mean and variance of the simulations of every combination, with target_ci
+    running_stats = {}
+    cache_stats = {}
+    while rung_allotted:
+        allotted.update(rung_allotted)
+        rung_combinations = list(rung_allotted)
+        if successive_halving or target_ci is not None:
+            print(f"Rung {rung}: {len(rung_combinations)} combinations with up to {max(map(len, rung_allotted.values()))} simulations")
+
+        # tasks of the simulations left to run
+        tasks = [(combination, seeds) for combination, seeds in build_tasks(task_members, rung_allotted, batched_types)
+                 if not all((member, seed) in completed for member in task_members[combination] for seed in seeds
+                            if seed in rung_allotted.get(member, ()))]
+        remaining = {combination: sum((combination, seed) not in completed for seed in seeds) for combination, seeds in rung_allotted.items()}
+
+        # estimate the time of every task, to run the longest first and project the wall-clock of the run
+        task_costs = {task: model.task_seconds(task, embeddings_list[task[0][4]].shape[1]) for task in tasks}
+        batch_costs = sorted((sum(task_costs[task] for task in batch) for batch in batch_tasks(tasks)), reverse=True)
+        print(f"Projected wall-clock: {format_duration(projected_wall_clock(batch_costs, num_workers))} on {num_workers} workers "
+              f"({format_duration(sum(batch_costs))} of work, {cost_model if cost_model is not None else 'default cost model'})")
+
+        # Initialize the combination count
+        total_combinations = len(rung_combinations)
+        combination_count = sum(remaining[combination] == 0 for combination in rung_combinations)
+
+        for task_combination, seed, df_metrics in run_tasks(tasks, labels, embeddings_list, hie_data, n_jobs=n_jobs,
+                                                            first_rounds=first_rounds, incremental=incremental,
+                                                            fit_cache_bytes=int(fit_cache_mb * 2**20), cache_stats=cache_stats,
+                                                            batched_types=batched_types, task_costs=task_costs,
+                                                            distance_features_list=distance_features_list):
+            # the round times of the simulation calibrate the cost model of later runs
+            timed = df_metrics['seconds'].notna()
+            embeddings_shape = embeddings_list[task_combination[4]].shape
+            with tracing.span('save'):
+                store.put_timings([(task_combination[5], int(n_train), embeddings_shape[1], embeddings_shape[0], float(seconds))
+                                   for n_train, seconds in zip(df_metrics['n_train'][timed], df_metrics['seconds'][timed])])
+            for combination in task_members[task_combination]:
+                if (combination, seed) in completed or seed not in rung_allotted.get(combination, ()):
+                    # rerun with the other simulations of its task
+                    continue
+                # the metrics of rounds 2 to num_iterations
+                with tracing.span('save'):
+                    store.put(combination, seed, df_metrics.iloc[:combination[2] - 1])
+                completed.add((combination, seed))
+                remaining[combination] -= 1
+                if remaining[combination] > 0:
+                    continue
+
+                combination_count += 1
+                # print overall progress
+                print(
+                    f"Progress: {combination_count}/{total_combinations} "
+                    f"({(combination_count/total_combinations)*100:.2f}%)"
+                )
+
+        rung += 1
+        if successive_halving and rung_simulations < num_simulations:
+            survivors = halve_combinations(rung_combinations, store, allotted, halving_metric, halving_eta)
+            rung_simulations = min(rung_simulations * halving_eta, num_simulations)
+            rung_allotted = {combination: grid_seeds[combination][:rung_simulations] for combination in survivors}
+        elif target_ci is not None:
+            rung_allotted = {}
+            for combination in rung_combinations:
+                # add the new simulations in seed order, one at a time
+                combination_stats = running_stats.setdefault(combination, RunningStats())
+                for seed in allotted[combination][combination_stats.count:]:
+                    combination_stats.add(store.get_simulation(combination, seed))
+                num_seeds = len(allotted[combination])
+                if combination_stats.ci_half_width() > target_ci and num_seeds < len(grid_seeds[combination]):
+                    needed = min(max(combination_stats.simulations_needed(target_ci), num_seeds + 1), len(grid_seeds[combination]))
+                    rung_allotted[combination] = grid_seeds[combination][:needed]
+        else:
+            rung_allotted = {}
+
+    end_time = time.time()
+    execution_time = end_time - start_time
+
+    print(f"Total execution time: {execution_time:.2f} seconds")
+    if fit_cache_mb > 0:
+        print(f"Fit cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses")
+
+    if num_shards > 1:
+        store.close()
+        print(f"Saved shard {shard_index}/{num_shards} to {store_path}, merge the shards with merge_shards.py")
+        if trace is not None:
+            write_run_trace(trace)
+        return
+
+    with tracing.span('write_results'):
+        # average the allotted simulations in seed order, so that the output does not depend on the order tasks finish in
+        output_results = {}
+        for combination in combinations:
+            if target_ci is not None:
+                output_results[combination] = running_stats[combination].mean_std()
+                continue
+            simulation_results = store.get(combination)
+            output_results[combination] = average_simulations([simulation_results[seed] for seed in allotted[combination]])
+        store.close()
+        adaptive = successive_halving or target_ci is not None
+        write_results(combinations, output_results, results_path,
+                      simulations_received={combination: len(allotted[combination]) for combination in combinations} if adaptive else None)
+    if trace is not None:
+        write_run_trace(trace)
 
 def main():
     parser = create_parser()
@@ -572,7 +1137,15 @@ def main():
     grid_search(
         args.dataset_name, args.base_path, args.num_simulations, args.num_iterations,
         args.measured_var, args.learning_strategies, args.num_mutants_per_round, args.first_round_strategies,
-        args.embedding_types, args.regression_types, args.file_type, args.embeddings_type_pt
+        args.embedding_types, args.regression_types, args.file_type, args.embeddings_type_pt,
+        n_jobs=args.n_jobs, cache_dir=args.cache_dir, clara_threshold=args.clara_threshold,
+        incremental=args.incremental, share_prefixes=args.share_prefixes,
+        fit_cache_mb=args.fit_cache_mb, ridge_backend=args.ridge_backend,
+        neuralnet_backend=args.neuralnet_backend, resume=args.resume,
+        shard_index=args.shard_index if args.shard_index is not None else slurm_shard_index(), num_shards=args.num_shards,
+        cost_model=args.cost_model, successive_halving=args.successive_halving,
+        halving_min_simulations=args.halving_min_simulations, halving_eta=args.halving_eta, halving_metric=args.halving_metric,
+        target_ci=args.target_ci, max_simulations=args.max_simulations, trace=args.trace
     )
  
 if __name__ == "__main__":
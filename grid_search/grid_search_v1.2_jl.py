@@ -22,12 +22,16 @@ import argparse
 import torch
 from sklearn.cluster import KMeans
 from sklearn_extra.cluster import KMedoids
+from long_results import open_results_writer
 
 # Ignore FutureWarnings and SettingWithCopyWarnings
 warnings.filterwarnings("ignore", category=FutureWarning)
 warnings.filterwarnings("ignore", category=ConvergenceWarning, module="sklearn.neural_network")
 pd.options.mode.chained_assignment = None  # default='warn'
 
+# First round strategies that directed_evolution_simulation runs (first_round also implements representative_hie)
+SIMULATED_FIRST_ROUND_STRATEGIES = ('random', 'diverse_medoids')
+
 # Create the parser for the command line arguments
 def create_parser():
     parser = argparse.ArgumentParser(description="Run experiments with different combinations of grid search variables.")
@@ -38,11 +42,12 @@ def create_parser():
     parser.add_argument("--measured_var", type=str, nargs="+", help="Fitness type to train on. Options: fitness fitness_scaled")
     parser.add_argument("--learning_strategies", type=str, nargs="+", help="Type of learning strategy. Options: random top5bottom5 top10 dist")
     parser.add_argument("--num_mutants_per_round", type=int, nargs="+", help="Number of mutants per round. Example: 8 10 16 32 128")
-    parser.add_argument("--first_round_strategies", type=str, nargs="+", help="Type of first round strategy. Options: random diverse_medoids representative_hie")
+    parser.add_argument("--first_round_strategies", type=str, nargs="+", help="Type of first round strategy. Options: random diverse_medoids")
     parser.add_argument("--embedding_types", type=str, nargs="+", help="Types of embeddings to train on. Options: embeddings embeddings_norm embeddings_pca")
     parser.add_argument("--regression_types", type=str, nargs="+", help="Regression types. Options: ridge lasso elasticnet linear neuralnet randomforest gradientboosting")
     parser.add_argument("--file_type", type=str, help="Type of file to read. Options: csvs pts")
     parser.add_argument("--embeddings_type_pt", type=str, help="Type of pytorch embeddings to read. Options: average mutated both")
+    parser.add_argument("--output_format", type=str, default="csv", help="Format of the per-simulation results, written as each simulation finishes. Options: csv parquet (a directory of parts, picked variants as indices into the variant table, see long_results.py). Default: csv")
     return parser
 
 # Function to read in the data
@@ -295,8 +300,9 @@ def top_layer(iter_train, iter_test, embeddings_pd, labels_pd, measured_var, reg
 
     return train_error, test_error, train_r_squared, test_r_squared, alpha, median_fitness_scaled, top_fitness_scaled,top_variant, fitness_binary_percentage,spearman_corr, df_test
 
-# Function to run n simulations of directed evolution
-def directed_evolution_simulation(labels, embeddings, hie_data, num_simulations, num_iterations, num_mutants_per_round=10, measured_var = 'fitness', regression_type='ridge', learning_strategy='top10', top_n=None, final_round = 10, first_round_strategy = 'random'):
+# Function to run n simulations of directed evolution. With a results writer every simulation is written as soon as it
+# finishes and nothing is returned
+def directed_evolution_simulation(labels, embeddings, hie_data, num_simulations, num_iterations, num_mutants_per_round=10, measured_var = 'fitness', regression_type='ridge', learning_strategy='top10', top_n=None, final_round = 10, first_round_strategy = 'random', writer=None):
     output_list = []
 
     if first_round_strategy == 'random' or first_round_strategy == 'diverse_medoids':
@@ -397,16 +403,29 @@ def directed_evolution_simulation(labels, embeddings, hie_data, num_simulations,
                                     'alpha': alpha_list, 'median_fitness_scaled': median_fitness_scaled_list,
                                     'top_fitness_scaled': top_fitness_scaled_list,
                                     'fitness_binary_percentage': fitness_binary_percentage_list, 'labels': labels_list, "top_variant": top_variant_list, "spearman_corr": spearman_corr_list})
-            
-            output_list.append(df_metrics)        
-    
+
+            if writer is not None:
+                writer.write(df_metrics)
+            else:
+                output_list.append(df_metrics)
+    else:
+        raise ValueError(f"First round strategy '{first_round_strategy}' is not simulated by this script. Options: {' '.join(SIMULATED_FIRST_ROUND_STRATEGIES)}")
+
+    if writer is not None:
+        return None
     output_table = pd.concat(output_list)
     return output_table
 
 # Function to run the experiment with different combinations of parameters
 def grid_search(dataset_name, base_path, num_simulations, num_iterations, measured_var, learning_strategies,
-                   num_mutants_per_round, first_round_strategies, embedding_types, regression_types, file_type, embeddings_type_pt=None):
+                   num_mutants_per_round, first_round_strategies, embedding_types, regression_types, file_type, embeddings_type_pt=None,
+                   output_format='csv'):
     
+    # fail before the grid starts rather than when the first unsupported combination is reached
+    for first_round_strategy in first_round_strategies:
+        if first_round_strategy not in SIMULATED_FIRST_ROUND_STRATEGIES:
+            raise ValueError(f"First round strategy '{first_round_strategy}' is not simulated by this script. Options: {' '.join(SIMULATED_FIRST_ROUND_STRATEGIES)}")
+
     # read in dataset
     embeddings, labels, hie_data = read_data(dataset_name, base_path, file_type, embeddings_type_pt)
 
@@ -444,8 +463,14 @@ def grid_search(dataset_name, base_path, num_simulations, num_iterations, measur
     # Print the corrected total_combinations count
     print(f"Total combinations: {total_combinations}")
 
+    # every simulation is written to the results as soon as it finishes
+    if embeddings_type_pt == None:
+        results_prefix = f"{base_path}/results/{dataset_name}_results"
+    else:
+        results_prefix = f"{base_path}/results/{dataset_name}_{embeddings_type_pt}_results"
+    writer = open_results_writer(results_prefix, output_format, labels['variant'])
+
     # Initialize the combination count
-    output_list = []
     combination_count = 0
 
     start_time = time.time()
@@ -474,7 +499,7 @@ def grid_search(dataset_name, base_path, num_simulations, num_iterations, measur
                                 )
 
                                 # run simulations for current combination of parameters
-                                output_table = directed_evolution_simulation(
+                                directed_evolution_simulation(
                                     labels=labels,
                                     embeddings=embeddings_list[embedding_type],
                                     num_simulations=num_simulations,
@@ -485,10 +510,11 @@ def grid_search(dataset_name, base_path, num_simulations, num_iterations, measur
                                     regression_type=regression_type,
                                     learning_strategy=strategy,
                                     final_round=mutants_per_round,
-                                    first_round_strategy=first_round_strategy  
-                                
+                                    first_round_strategy=first_round_strategy,
+                                    writer=writer
                                 )
-                                output_list.append(output_table)
+                                # the parquet parts are written once per combination
+                                writer.flush()
 
 
     end_time = time.time()
@@ -496,14 +522,7 @@ def grid_search(dataset_name, base_path, num_simulations, num_iterations, measur
 
     print(f"Total execution time: {execution_time:.2f} seconds")
 
-    #concat the outputlist into a dataframe
-    df_results = pd.concat(output_list)
-
-    # save the dataframe to a csv file using the dataset_name
-    if embeddings_type_pt == None:
-        df_results.to_csv(f"{base_path}/results/{dataset_name}_results.csv", index=False)
-    else:
-        df_results.to_csv(f"{base_path}/results/{dataset_name}_{embeddings_type_pt}_results.csv", index=False)
+    writer.close()
 
 def main():
     parser = create_parser()
@@ -511,7 +530,7 @@ def main():
     grid_search(
         args.dataset_name, args.base_path, args.num_simulations, args.num_iterations,
         args.measured_var, args.learning_strategies, args.num_mutants_per_round, args.first_round_strategies,
-        args.embedding_types, args.regression_types, args.file_type, args.embeddings_type_pt
+        args.embedding_types, args.regression_types, args.file_type, args.embeddings_type_pt, args.output_format
     )
  
 if __name__ == "__main__":
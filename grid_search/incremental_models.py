@@ -0,0 +1,136 @@
+import numpy as np
+from sklearn import linear_model
+from sklearn.base import clone
+
+# Incremental fitting of the top layer across the rounds of a simulation (grid_search.py --incremental). Each round only
+# adds num_mutants_per_round variants to the training set, so instead of fitting a new model on every round:
+#   ridge                    keeps the Gram matrix X X^T of the training set and extends it with the rows of the new
+#                            variants, then solves the same generalized cross-validation as RidgeCV on it (exact)
+#   lasso, elasticnet        select alpha by cross-validation on the first round, then warm-start coordinate descent
+#                            from the previous coefficients at that alpha
+#   neuralnet                continues training from the previous weights (warm_start)
+#   randomforest             adds TREES_PER_ROUND trees fit on the current training set (warm_start)
+#   gradientboosting         adds the trees of one fit (n_estimators) to the previous booster
+#   linear                   refits, there is no state to reuse
+# Only ridge gives the same model as a fresh fit, the others are approximations that trade accuracy for speed.
+
+# Trees added to the random forest every round
+TREES_PER_ROUND = 20
+
+# Function to find the eigenvector closest to the constant direction, as sklearn's RidgeCV does for the intercept
+def _intercept_dim(Q):
+    ones = np.ones(Q.shape[0]) / np.sqrt(Q.shape[0])
+    return np.argmax(np.abs(Q.T @ ones))
+
+# Ridge model fit on a Gram matrix, predicting like RidgeCV
+class GramRidge:
+    def __init__(self, coef, intercept, alpha):
+        self.coef_ = coef
+        self.intercept_ = intercept
+        self.alpha_ = alpha
+
+    def predict(self, X):
+        return np.asarray(X, dtype=np.float64) @ self.coef_ + self.intercept_
+
+# Incremental RidgeCV (efficient leave-one-out over alphas) while there are fewer variants than features
+class IncrementalRidgeCV:
+    def __init__(self, alphas=(0.1, 1.0, 10.0)):
+        self.alphas = alphas
+        self.idx = np.empty(0, dtype=np.int64)   # training variants, in the order they were added
+        self.X = None                            # their embeddings
+        self.gram = None                         # uncentered X X^T
+
+    # Function to add the rows of the new training variants, with a block update of the Gram matrix
+    def _extend(self, X_new, idx_new):
+        X_new = np.asarray(X_new, dtype=np.float64)
+        if self.X is None:
+            self.X = X_new
+            self.gram = X_new @ X_new.T
+        else:
+            cross = self.X @ X_new.T
+            self.gram = np.block([[self.gram, cross], [cross.T, X_new @ X_new.T]])
+            self.X = np.vstack([self.X, X_new])
+        self.idx = np.concatenate([self.idx, idx_new])
+
+    def fit(self, X_train, y_train, idx_train):
+        # the training set only grows, otherwise start over
+        if not np.isin(self.idx, idx_train).all():
+            self.idx, self.X, self.gram = np.empty(0, dtype=np.int64), None, None
+        is_new = ~np.isin(idx_train, self.idx)
+        self._extend(X_train[is_new], idx_train[is_new])
+
+        # targets in the order of the stored rows
+        y = np.asarray(y_train, dtype=np.float64)[np.searchsorted(idx_train, self.idx)]
+        X_mean = self.X.mean(axis=0)
+        y_mean = y.mean()
+        y_centered = y - y_mean
+
+        # Gram matrix of the centered rows from the uncentered one, plus the constant column of the intercept
+        row_means = self.gram.mean(axis=1)
+        gram_centered = self.gram - row_means[:, None] - row_means[None, :] + row_means.mean()
+        eigvals, Q = np.linalg.eigh(gram_centered + 1.0)
+        QT_y = Q.T @ y_centered
+        intercept_dim = _intercept_dim(Q)
+
+        # leave-one-out squared error of every alpha, keeping the first best like RidgeCV
+        best = None
+        for alpha in self.alphas:
+            w = 1.0 / (eigvals + alpha)
+            w[intercept_dim] = 0
+            dual_coef = Q @ (w * QT_y)
+            G_inverse_diag = (w * Q ** 2).sum(axis=-1)
+            score = -((dual_coef / G_inverse_diag) ** 2).mean()
+            if best is None or score > best[0]:
+                best = (score, alpha, dual_coef)
+
+        _, alpha, dual_coef = best
+        coef = self.X.T @ dual_coef - X_mean * dual_coef.sum()
+        intercept = y_mean - X_mean @ coef
+        return GramRidge(coef, intercept, alpha)
+
+# State of the top layer of one simulation, fit again every round
+class IncrementalTopLayer:
+    def __init__(self, regression_type):
+        self.regression_type = regression_type
+        self.model = None
+        self.ridge = IncrementalRidgeCV() if regression_type == 'ridge' else None
+
+    # Function to fit the model of this round, model is the unfitted model top_layer would fit from scratch
+    def fit(self, model, X_train, y_train, idx_train):
+        if self.regression_type == 'ridge' and X_train.shape[0] < X_train.shape[1]:
+            return self.ridge.fit(X_train, y_train, idx_train)
+
+        if self.model is None or self.regression_type in ('ridge', 'linear'):
+            # first round (or no state to reuse): fit from scratch
+            model.fit(X_train, y_train)
+            self.model = model
+            return model
+
+        if self.regression_type in ('lasso', 'elasticnet'):
+            previous = self.model
+            if self.regression_type == 'lasso':
+                model = linear_model.Lasso(alpha=previous.alpha_, max_iter=previous.max_iter, tol=previous.tol, warm_start=True)
+            else:
+                model = linear_model.ElasticNet(alpha=previous.alpha_, l1_ratio=previous.l1_ratio_, max_iter=previous.max_iter,
+                                                tol=previous.tol, warm_start=True)
+                model.l1_ratio_ = previous.l1_ratio_
+            model.coef_ = previous.coef_.copy()
+            model.fit(X_train, y_train)
+            model.alpha_ = previous.alpha_
+        elif self.regression_type == 'neuralnet':
+            model = self.model
+            model.set_params(warm_start=True)
+            model.fit(X_train, y_train)
+        elif self.regression_type == 'randomforest':
+            model = self.model
+            model.set_params(warm_start=True, n_estimators=model.n_estimators + TREES_PER_ROUND)
+            model.fit(X_train, y_train)
+        elif self.regression_type == 'gradientboosting':
+            previous = self.model
+            model = clone(previous)
+            model.fit(X_train, y_train, xgb_model=previous.get_booster())
+        else:
+            model.fit(X_train, y_train)
+
+        self.model = model
+        return model
@@ -0,0 +1,188 @@
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+
+# Long-format (one row per simulation and round) results of grid_search_v1.2_jl.py, written as each simulation
+# finishes instead of concatenated at the end of the grid, so the memory does not grow with the grid and the finished
+# simulations are on disk if the job dies.
+#   csv:     {prefix}.csv, the original layout, appended simulation by simulation
+#   parquet: {prefix}/ directory of part-NNNNN.parquet files, each written at the end of every combination (or once
+#            rows_per_part rows are buffered within one), plus variants.txt, the variant table (labels.variant, one per
+#            line). The picked variants of a round ('labels') are a list of int32 indices into the variant table and
+#            'top_variant' is an index, the metrics without a model in the first round ("None" in the csv) are null.
+#            Parts are complete parquet files, so a killed job keeps every part it wrote.
+# A running job writes to {prefix}.csv.tmp (or the {prefix}.tmp/ directory), which replaces the results of the previous
+# run at close. A new run keeps the in-progress results of a killed job as {prefix}.killed-N.csv (or {prefix}.killed-N/)
+# instead of overwriting them.
+# LongResults reads the parquet results lazily for the top-layer-metrics notebooks: only the columns and rows asked for
+# are read, and the variant indices are decoded back to variant names on request.
+# pyarrow is only needed for parquet.
+
+# Rows buffered before a parquet part is written
+ROWS_PER_PART = 8192
+
+# Columns of the per-simulation metrics of directed_evolution_simulation, and their parquet types
+INT_COLUMNS = ['simulation_num', 'round_num', 'num_mutants_per_round']
+STRING_COLUMNS = ['first_round_strategy', 'learning_strategy', 'regression_type']
+FLOAT_COLUMNS = ['test_error', 'train_error', 'train_r_squared', 'test_r_squared', 'alpha', 'median_fitness_scaled',
+                 'top_fitness_scaled', 'fitness_binary_percentage', 'spearman_corr']
+VARIANT_LIST_COLUMN = 'labels'
+VARIANT_COLUMN = 'top_variant'
+
+# Function to get the arrow schema of the parquet results
+def parquet_schema():
+    import pyarrow as pa
+
+    fields = ([pa.field(column, pa.int32()) for column in INT_COLUMNS]
+              + [pa.field(column, pa.string()) for column in STRING_COLUMNS]
+              + [pa.field(column, pa.float64()) for column in FLOAT_COLUMNS]
+              + [pa.field(VARIANT_LIST_COLUMN, pa.list_(pa.int32())), pa.field(VARIANT_COLUMN, pa.int32())])
+    return pa.schema(fields)
+
+# Function to keep the in-progress results left by a killed job, which a new run would otherwise overwrite
+def keep_killed_results(tmp_path, prefix, extension):
+    if not os.path.exists(tmp_path):
+        return
+    n = 1
+    while os.path.exists(f"{prefix}.killed-{n}{extension}"):
+        n += 1
+    os.replace(tmp_path, f"{prefix}.killed-{n}{extension}")
+    print(f"Kept the results of a killed run in {prefix}.killed-{n}{extension}")
+
+class CsvResultsWriter:
+    def __init__(self, prefix):
+        self.path = f"{prefix}.csv"
+        self.tmp_path = self.path + '.tmp'
+        keep_killed_results(self.tmp_path, prefix, '.csv')
+        self.header = True
+
+    # Function to append the metrics of one simulation
+    def write(self, df_metrics):
+        df_metrics.to_csv(self.tmp_path, mode='w' if self.header else 'a', header=self.header, index=False)
+        self.header = False
+
+    # Function to end a combination, every simulation is already on disk
+    def flush(self):
+        pass
+
+    def close(self):
+        if self.header:
+            # empty grid
+            open(self.tmp_path, 'w').close()
+        os.replace(self.tmp_path, self.path)
+
+class ParquetResultsWriter:
+    def __init__(self, prefix, variants, rows_per_part=ROWS_PER_PART):
+        import pyarrow as pa
+
+        self.pa = pa
+        self.path = prefix
+        self.tmp_path = prefix + '.tmp'
+        self.schema = parquet_schema()
+        self.rows_per_part = rows_per_part
+        self.variant_index = {variant: i for i, variant in enumerate(variants)}
+        self.buffer = []
+        self.buffered_rows = 0
+        self.num_parts = 0
+
+        # start from an empty directory, the parts of an earlier run would be read with this one
+        keep_killed_results(self.tmp_path, prefix, '')
+        os.makedirs(self.tmp_path)
+        with open(os.path.join(self.tmp_path, 'variants.txt'), 'w') as f:
+            f.write('\n'.join(variants) + '\n')
+
+    # Function to convert the metrics of one simulation to an arrow table
+    def to_table(self, df_metrics):
+        columns = {column: df_metrics[column].to_numpy(dtype=np.int32) for column in INT_COLUMNS}
+        columns.update({column: df_metrics[column].astype(str).to_numpy() for column in STRING_COLUMNS})
+        columns.update({column: pd.to_numeric(df_metrics[column], errors='coerce').to_numpy(dtype=np.float64)
+                        for column in FLOAT_COLUMNS})
+        columns[VARIANT_LIST_COLUMN] = [np.array([self.variant_index[variant] for variant in picked.split(',') if variant],
+                                                 dtype=np.int32)
+                                        for picked in df_metrics[VARIANT_LIST_COLUMN]]
+        columns[VARIANT_COLUMN] = np.array([self.variant_index[variant] for variant in df_metrics[VARIANT_COLUMN]], dtype=np.int32)
+        return self.pa.Table.from_pydict(columns, schema=self.schema)
+
+    # Function to buffer the metrics of one simulation, writing a part once rows_per_part rows are buffered (the
+    # combination is written as one part by flush otherwise)
+    def write(self, df_metrics):
+        self.buffer.append(self.to_table(df_metrics))
+        self.buffered_rows += len(df_metrics)
+        if self.buffered_rows >= self.rows_per_part:
+            self.flush()
+
+    # Function to write the buffered rows as the next part, called at the end of every combination
+    def flush(self):
+        import pyarrow.parquet as pq
+
+        if not self.buffer:
+            return
+        part_path = os.path.join(self.tmp_path, f"part-{self.num_parts:05d}.parquet")
+        # write to a temporary file first, so a killed job never leaves a truncated part
+        pq.write_table(self.pa.concat_tables(self.buffer), part_path + '.tmp')
+        os.replace(part_path + '.tmp', part_path)
+        self.num_parts += 1
+        self.buffer = []
+        self.buffered_rows = 0
+
+    def close(self):
+        self.flush()
+        if os.path.isdir(self.path):
+            shutil.rmtree(self.path)
+        os.replace(self.tmp_path, self.path)
+
+# Function to open the writer of an output format
+def open_results_writer(prefix, output_format, variants, rows_per_part=ROWS_PER_PART):
+    if output_format == 'csv':
+        return CsvResultsWriter(prefix)
+    elif output_format == 'parquet':
+        return ParquetResultsWriter(prefix, list(variants), rows_per_part)
+    raise ValueError(f"Invalid output format '{output_format}'. Please choose either 'csv' or 'parquet'")
+
+class LongResults:
+    def __init__(self, path):
+        import pyarrow.dataset as ds
+
+        self.path = path
+        # the parts in the order they were written
+        parts = sorted(name for name in os.listdir(path) if name.startswith('part-') and name.endswith('.parquet'))
+        self.dataset = ds.dataset([os.path.join(path, name) for name in parts], schema=parquet_schema(), format='parquet')
+        with open(os.path.join(path, 'variants.txt')) as f:
+            self.variants = np.array(f.read().splitlines(), dtype=object)
+
+    @property
+    def columns(self):
+        return self.dataset.schema.names
+
+    # Function to build a row filter from {column: value or list of values}
+    def _filter(self, filters):
+        import pyarrow.dataset as ds
+
+        expression = None
+        for column, values in (filters or {}).items():
+            values = list(values) if isinstance(values, (list, tuple, set)) else [values]
+            condition = ds.field(column).isin(values)
+            expression = condition if expression is None else expression & condition
+        return expression
+
+    # Function to decode the variant indices of a DataFrame back to variant names
+    def decode(self, df):
+        if VARIANT_LIST_COLUMN in df:
+            df[VARIANT_LIST_COLUMN] = [list(self.variants[np.asarray(picked, dtype=np.int64)]) for picked in df[VARIANT_LIST_COLUMN]]
+        if VARIANT_COLUMN in df:
+            df[VARIANT_COLUMN] = self.variants[df[VARIANT_COLUMN].to_numpy(dtype=np.int64)]
+        return df
+
+    # Function to read the given columns of the rows matching filters, e.g.
+    # read(['round_num', 'top_fitness_scaled'], {'regression_type': 'ridge', 'num_mutants_per_round': [8, 16]})
+    def read(self, columns=None, filters=None, decode_variants=False):
+        df = self.dataset.to_table(columns=columns, filter=self._filter(filters)).to_pandas()
+        return self.decode(df) if decode_variants else df
+
+    # Function to read the rows matching filters batch by batch, for results that do not fit in memory
+    def iter_batches(self, columns=None, filters=None, batch_size=65536, decode_variants=False):
+        for batch in self.dataset.to_batches(columns=columns, filter=self._filter(filters), batch_size=batch_size):
+            df = batch.to_pandas()
+            yield self.decode(df) if decode_variants else df
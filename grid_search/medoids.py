@@ -0,0 +1,54 @@
+import numpy as np
+from scipy.spatial.distance import cdist
+
+# K-medoids for the diverse_medoids first round. KMedoids builds the full n x n distance matrix, which does not fit
+# in memory for large libraries (20k variants is 3.2 GB), so above CLARA_THRESHOLD variants CLARA is used instead:
+# KMedoids on a few random samples of the variants, keeping the medoids with the lowest total distance over all variants.
+
+# Libraries with more variants than this are clustered with CLARA
+CLARA_THRESHOLD = 10000
+
+# Number of samples of CLARA and their minimum size (the classic 40 + 2 * n_clusters is too small for 2-D features)
+CLARA_SAMPLES = 5
+CLARA_SAMPLE_SIZE = 2000
+
+# Function to assign every point to its closest medoid, returns the labels and the total distance
+def assign_to_medoids(features, medoid_indices, chunk_rows=4096):
+    labels = np.empty(len(features), dtype=np.int64)
+    cost = 0.0
+    for start in range(0, len(features), chunk_rows):
+        distances = cdist(features[start:start + chunk_rows], features[medoid_indices], metric='euclidean')
+        labels[start:start + chunk_rows] = distances.argmin(axis=1)
+        cost += distances.min(axis=1).sum()
+    return labels, cost
+
+# Function to cluster with CLARA, returns the medoid indices and the label of every point like KMedoids
+def clara(features, n_clusters, random_state=None, n_samples=CLARA_SAMPLES, sample_size=CLARA_SAMPLE_SIZE):
+    from sklearn_extra.cluster import KMedoids
+
+    rng = np.random.RandomState(random_state)
+    sample_size = min(max(sample_size, 40 + 2 * n_clusters), len(features))
+
+    best_medoids, best_labels, best_cost = None, None, np.inf
+    for _ in range(n_samples):
+        sample = rng.choice(len(features), size=sample_size, replace=False)
+        if best_medoids is not None:
+            # every sample after the first also holds the best medoids so far, so that the cost never increases
+            sample = np.union1d(best_medoids, sample[:sample_size - n_clusters])
+        sample = np.sort(sample)
+        fit = KMedoids(n_clusters=n_clusters, metric='euclidean', random_state=random_state).fit(features[sample])
+        medoids = sample[fit.medoid_indices_]
+        labels, cost = assign_to_medoids(features, medoids)
+        if cost < best_cost:
+            best_medoids, best_labels, best_cost = medoids, labels, cost
+
+    return best_medoids, best_labels
+
+# Function to cluster with KMedoids, or CLARA for libraries above clara_threshold variants
+def fit_medoids(features, n_clusters, random_state=None, clara_threshold=CLARA_THRESHOLD):
+    if clara_threshold is not None and len(features) > clara_threshold:
+        return clara(features, n_clusters, random_state=random_state)
+    from sklearn_extra.cluster import KMedoids
+
+    clusters = KMedoids(n_clusters=n_clusters, metric='euclidean', random_state=random_state).fit(features)
+    return clusters.medoid_indices_, clusters.labels_
@@ -0,0 +1,51 @@
+import os
+
+from grid_search import (average_simulations, create_parser, expand_combinations, results_prefix, simulation_seeds,
+                         store_settings, write_results)
+from result_store import ResultStore
+from sharding import find_shard_stores
+
+# Merge the result stores of the shards of a grid (grid_search.py --num_shards) into the results csv. Takes the
+# arguments of grid_search.py, so it runs with the same command line as the shards, and checks that every simulation
+# of the grid was saved by one of them.
+
+def main():
+    parser = create_parser()
+    parser.description = "Merge the shards of a grid search into its results csv."
+    args = parser.parse_args()
+    if args.num_shards <= 1:
+        parser.error("--num_shards must be the number of shards of the grid")
+
+    results_path = results_prefix(args.dataset_name, args.embeddings_type_pt)
+    paths = find_shard_stores(results_path, args.num_shards)
+    missing_shards = sorted(set(range(args.num_shards)) - set(paths))
+    if missing_shards:
+        raise FileNotFoundError(f"No result store for shards {missing_shards} of {args.num_shards} in {os.path.dirname(results_path)}")
+    settings = store_settings(args.dataset_name, args.file_type, args.embeddings_type_pt, args.incremental,
+                              args.clara_threshold, args.ridge_backend, args.neuralnet_backend)
+    stores = [ResultStore(paths[shard_index], settings) for shard_index in range(args.num_shards)]
+
+    combinations = expand_combinations(args.learning_strategies, args.measured_var, args.num_iterations,
+                                       args.num_mutants_per_round, args.embedding_types, args.regression_types,
+                                       args.first_round_strategies)
+    output_results = {}
+    missing = []
+    for combination in combinations:
+        simulation_results = {}
+        for store in stores:
+            simulation_results.update(store.get(combination))
+        seeds = simulation_seeds(args.num_simulations, combination[-1])
+        missing.extend((combination, seed) for seed in seeds if seed not in simulation_results)
+        if not missing:
+            output_results[combination] = average_simulations([simulation_results[seed] for seed in seeds])
+    for store in stores:
+        store.close()
+    if missing:
+        raise ValueError(f"{len(missing)} simulations are missing from the shards, e.g. {missing[0]}: resubmit the "
+                         f"unfinished shards with --resume")
+
+    write_results(combinations, output_results, results_path)
+    print(f"Merged {args.num_shards} shards into {results_path}.csv")
+
+if __name__ == "__main__":
+    main()
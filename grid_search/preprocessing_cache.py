@@ -0,0 +1,75 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+from sklearn.preprocessing import StandardScaler
+
+# Content-addressed cache of the preprocessed embeddings (embeddings_norm, embeddings_pca and the projection used
+# by the diverse_medoids first round) and of other arrays computed from them, such as the first round selections.
+# Every array is stored as {cache_dir}/{name}_{key}.npy, where key hashes the content of the input matrix, the
+# transform and its parameters, so all jobs of a sweep that read the same
+# embeddings share one fit, and a changed dataset or parameter never reads a stale entry.
+
+# Bumped when a transform changes, so that old entries are not read
+CACHE_VERSION = 1
+
+# Rows hashed at a time, so that memory-mapped matrices are not read into memory at once
+HASH_CHUNK_ROWS = 4096
+
+# Function to hash the shape, dtype and content of a matrix
+def fingerprint(matrix):
+    matrix = np.asarray(matrix)
+    digest = hashlib.sha256()
+    digest.update(json.dumps([list(matrix.shape), matrix.dtype.str]).encode())
+    for start in range(0, matrix.shape[0], HASH_CHUNK_ROWS):
+        digest.update(np.ascontiguousarray(matrix[start:start + HASH_CHUNK_ROWS]).tobytes())
+    return digest.hexdigest()
+
+# Function to get the cache path of an array from the parameters it was computed with
+def cache_path(cache_dir, name, key):
+    key = json.dumps(dict(key, version=CACHE_VERSION), sort_keys=True)
+    return os.path.join(cache_dir, f"{name}_{hashlib.sha256(key.encode()).hexdigest()[:16]}.npy")
+
+# Function to compute an array, or read it from the cache if it was computed before with the same key
+def cached_array(cache_dir, name, key, compute):
+    if cache_dir is None:
+        return compute()
+
+    path = cache_path(cache_dir, name, key)
+    if os.path.exists(path):
+        return np.load(path)
+
+    result = compute()
+    os.makedirs(cache_dir, exist_ok=True)
+    # write under a unique name and rename, so that concurrent jobs never read a partial file
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        np.save(f, result)
+    os.replace(tmp_path, path)
+    return result
+
+# Function to standardize every column to zero mean and unit variance
+def scale(matrix):
+    return StandardScaler().fit_transform(matrix)
+
+# Function to project a matrix on its first n_components principal components, with a truncated SVD (ARPACK) that
+# only computes those components. Unlike the randomized solver it converges to the exact components when the
+# spectrum is flat, so the projection matches a full PCA.
+def pca_projection(matrix, n_components, random_state=0):
+    from sklearn.decomposition import PCA
+
+    pca = PCA(n_components=n_components, svd_solver='arpack', random_state=random_state)
+    return pca.fit_transform(matrix)
+
+TRANSFORMS = {
+    'scale': scale,
+    'pca': pca_projection,
+}
+
+# Function to compute a transform of a matrix, or read it from the cache if it was computed before
+def cached_transform(matrix, transform, cache_dir=None, matrix_fingerprint=None, **params):
+    if cache_dir is not None and matrix_fingerprint is None:
+        matrix_fingerprint = fingerprint(matrix)
+    key = {'input': matrix_fingerprint, 'transform': transform, 'params': params}
+    return cached_array(cache_dir, transform, key, lambda: TRANSFORMS[transform](matrix, **params))
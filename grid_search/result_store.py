@@ -0,0 +1,67 @@
+import json
+import sqlite3
+
+import numpy as np
+import pandas as pd
+
+# Durable store of the per-simulation metrics of grid_search.py, written as each simulation finishes so that a job
+# killed before the end of the grid (e.g. by a SLURM time limit) can continue where it stopped with --resume. Every
+# row is keyed by the settings of the run that change the results (dataset, embeddings, backends), the combination
+# and the seed, and holds the metrics of rounds 2 to num_iterations as float64 bytes, so the csv built from the store
+# is the same as the one of an uninterrupted run. The store also keeps the time of every top layer round, which
+# cost_model.py calibrates its runtime model on.
+
+# Columns of the per-simulation metrics, in the order of run_simulation
+METRIC_COLUMNS = ['test_error', 'train_error', 'train_r_squared', 'test_r_squared', 'alpha', 'median_fitness_scaled',
+                  'top_fitness_scaled', 'fitness_binary_percentage']
+
+class ResultStore:
+    def __init__(self, path, settings):
+        self.path = path
+        self.settings = json.dumps(settings, sort_keys=True)
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS simulations (settings TEXT NOT NULL, combination TEXT NOT NULL, "
+                                "seed INTEGER NOT NULL, metrics BLOB NOT NULL, PRIMARY KEY (settings, combination, seed))")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS timings (regression_type TEXT NOT NULL, n_train INTEGER NOT NULL, "
+                                "n_features INTEGER NOT NULL, n_variants INTEGER NOT NULL, seconds REAL NOT NULL)")
+        self.connection.commit()
+
+    # Function to delete the results of these settings, for a run that starts over
+    def clear(self):
+        self.connection.execute("DELETE FROM simulations WHERE settings = ?", (self.settings,))
+        self.connection.commit()
+
+    # Function to save the metrics of one simulation, committed right away
+    def put(self, combination, seed, df_metrics):
+        metrics = np.ascontiguousarray(df_metrics[METRIC_COLUMNS].to_numpy(dtype=np.float64))
+        self.connection.execute("INSERT OR REPLACE INTO simulations VALUES (?, ?, ?, ?)",
+                                (self.settings, json.dumps(list(combination)), int(seed), metrics.tobytes()))
+        self.connection.commit()
+
+    # Function to save the times of top layer rounds, as (regression_type, n_train, n_features, n_variants, seconds) rows.
+    # They are committed with the next simulation
+    def put_timings(self, rows):
+        self.connection.executemany("INSERT INTO timings VALUES (?, ?, ?, ?, ?)", rows)
+
+    # Function to list the (combination, seed) pairs already saved
+    def completed(self):
+        rows = self.connection.execute("SELECT combination, seed FROM simulations WHERE settings = ?", (self.settings,))
+        return {(tuple(json.loads(combination)), seed) for combination, seed in rows}
+
+    # Function to load the metrics of every saved simulation of a combination, keyed by seed
+    def get(self, combination):
+        rows = self.connection.execute("SELECT seed, metrics FROM simulations WHERE settings = ? AND combination = ?",
+                                       (self.settings, json.dumps(list(combination))))
+        return {seed: pd.DataFrame(np.frombuffer(metrics, dtype=np.float64).reshape(-1, len(METRIC_COLUMNS)),
+                                   columns=METRIC_COLUMNS)
+                for seed, metrics in rows}
+
+    # Function to load the metrics of one saved simulation
+    def get_simulation(self, combination, seed):
+        (metrics,), = self.connection.execute("SELECT metrics FROM simulations WHERE settings = ? AND combination = ? AND seed = ?",
+                                              (self.settings, json.dumps(list(combination)), int(seed)))
+        return pd.DataFrame(np.frombuffer(metrics, dtype=np.float64).reshape(-1, len(METRIC_COLUMNS)), columns=METRIC_COLUMNS)
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
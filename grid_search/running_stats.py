@@ -0,0 +1,65 @@
+import numpy as np
+import pandas as pd
+from scipy import stats
+
+# Streaming mean and variance of the per-round metrics of a combination across its simulations (Welford's algorithm),
+# for grid_search.py --target_ci. Every simulation is added once and dropped, so adding seeds until the confidence
+# interval of the mean is narrow enough never holds all per-seed metrics in memory, and the update is numerically stable
+# for the small variances of near-deterministic combinations.
+
+# Metrics whose confidence interval decides if a combination needs more simulations
+CI_METRICS = ['top_fitness_scaled', 'median_fitness_scaled']
+
+class RunningStats:
+    def __init__(self):
+        self.count = 0
+        # simulations with a value of every metric and round, NaN values (e.g. the alpha of a regressor without one) are
+        # skipped like in average_simulations
+        self.counts = None
+        self.mean = None
+        self.m2 = None
+        self.index = None
+        self.columns = None
+
+    # Function to add the metrics (rounds x metrics DataFrame) of one simulation
+    def add(self, df_metrics):
+        values = df_metrics.to_numpy(dtype=np.float64)
+        if self.count == 0:
+            self.index, self.columns = df_metrics.index, df_metrics.columns
+            self.counts = np.zeros_like(values)
+            self.mean = np.zeros_like(values)
+            self.m2 = np.zeros_like(values)
+        self.count += 1
+        valid = ~np.isnan(values)
+        self.counts += valid
+        delta = np.where(valid, values - self.mean, 0)
+        self.mean += np.divide(delta, self.counts, out=np.zeros_like(delta), where=valid)
+        self.m2 += delta * np.where(valid, values - self.mean, 0)
+
+    # Function to get the mean and standard deviation (ddof=1, NaN with less than two values) of every metric and round,
+    # like average_simulations
+    def mean_std(self):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            std = np.where(self.counts > 1, np.sqrt(self.m2 / (self.counts - 1)), np.nan)
+        mean = np.where(self.counts > 0, self.mean, np.nan)
+        return (pd.DataFrame(mean, index=self.index, columns=self.columns),
+                pd.DataFrame(std, index=self.index, columns=self.columns))
+
+    # Function to get the largest standard deviation of the last round of the given metrics
+    def last_round_std(self, metrics=CI_METRICS):
+        columns = [self.columns.get_loc(metric) for metric in metrics]
+        return float(np.nanmax(np.sqrt(self.m2[-1, columns] / np.maximum(self.counts[-1, columns] - 1, 1))))
+
+    # Function to get the half-width of the Student t confidence interval of the mean of the last round of the given
+    # metrics, the widest of them. Infinite with less than two simulations
+    def ci_half_width(self, metrics=CI_METRICS, confidence=0.95):
+        if self.count < 2:
+            return np.inf
+        return float(stats.t.ppf((1 + confidence) / 2, self.count - 1) * self.last_round_std(metrics) / np.sqrt(self.count))
+
+    # Function to estimate the number of simulations that bring the confidence interval under target_ci, from the
+    # current standard deviation
+    def simulations_needed(self, target_ci, metrics=CI_METRICS, confidence=0.95):
+        if self.count < 2:
+            return 2
+        return int(np.ceil((stats.t.ppf((1 + confidence) / 2, self.count - 1) * self.last_round_std(metrics) / target_ci) ** 2))
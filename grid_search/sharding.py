@@ -0,0 +1,63 @@
+import glob
+import os
+import re
+
+# Sharding of the grid over the tasks of a SLURM job array (grid_search.py --shard_index/--num_shards). The simulations
+# of the grid are split deterministically over the shards in units of the simulations that share a fit cache (same
+# seed, measured_var, num_mutants_per_round, embedding type, regression type and first round strategy), which does not
+# depend on --share_prefixes or the backends. Units are balanced by their estimated cost: the most expensive unit goes
+# to the shard with the least estimated work first. Every shard saves its simulations to its own result store, and
+# merge_shards.py builds the results csv once all shards are done.
+
+# Relative time of one top layer round per regression type (fit and predict on a brenan-sized library, 97 training
+# variants of 1280 features, ridge = 1)
+REGRESSION_COST = {'ridge': 1, 'linear': 1, 'lasso': 5, 'elasticnet': 6, 'gradientboosting': 6, 'neuralnet': 20,
+                   'randomforest': 100}
+
+# Function to get the unit of a simulation, the combinations that only differ in learning strategy and num_iterations
+def shard_unit(combination, seed):
+    return (combination[1],) + combination[3:] + (seed,)
+
+# Function to estimate the cost of a simulation: its rounds times the cost of a round
+def estimate_simulation_cost(combination):
+    return (combination[2] - 1) * REGRESSION_COST.get(combination[5], 1)
+
+# Function to split the (combination, seed) simulations of the grid over num_shards shards, returns the simulations of
+# shard_index. Longest processing time first: units are taken from the most to the least expensive (ties in grid
+# order) and each goes to the shard with the lowest estimated cost so far (ties to the lowest index), so every shard
+# computes the same split
+def shard_simulations(simulations, shard_index, num_shards):
+    if not 0 <= shard_index < num_shards:
+        raise ValueError(f"Invalid shard index {shard_index} for {num_shards} shards")
+    units = {}
+    for combination, seed in simulations:
+        units.setdefault(shard_unit(combination, seed), []).append((combination, seed))
+    units = list(units.values())
+    costs = [sum(estimate_simulation_cost(combination) for combination, _ in unit) for unit in units]
+    loads = [0] * num_shards
+    selected = set()
+    for i in sorted(range(len(units)), key=lambda i: -costs[i]):
+        shard = min(range(num_shards), key=lambda shard: loads[shard])
+        loads[shard] += costs[i]
+        if shard == shard_index:
+            selected.update(units[i])
+    return selected
+
+# Function to get the shard index from the SLURM job array, None outside of a job array
+def slurm_shard_index():
+    if 'SLURM_ARRAY_TASK_ID' not in os.environ:
+        return None
+    return int(os.environ['SLURM_ARRAY_TASK_ID']) - int(os.environ.get('SLURM_ARRAY_TASK_MIN', 0))
+
+# Function to get the path of the result store of a shard
+def shard_store_path(results_path, shard_index, num_shards):
+    return f"{results_path}.shard{shard_index}of{num_shards}.sqlite"
+
+# Function to find the result stores of the shards of a run, returns them by shard index
+def find_shard_stores(results_path, num_shards):
+    paths = {}
+    for path in glob.glob(f"{glob.escape(results_path)}.shard*of{num_shards}.sqlite"):
+        match = re.search(rf"\.shard(\d+)of{num_shards}\.sqlite$", path)
+        if match is not None:
+            paths[int(match.group(1))] = path
+    return paths
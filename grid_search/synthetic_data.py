@@ -0,0 +1,165 @@
+import argparse
+import math
+import os
+
+import numpy as np
+import pandas as pd
+
+from embedding_store import store_paths, write_store_index
+
+# Synthetic deep mutational scanning datasets, for benchmarking the pipeline without the real embeddings. The library
+# is every single mutant of a random WT sequence (e.g. M12A). Embeddings are a low-rank latent signal plus noise, and
+# fitness is a nonlinear function of the latent signal plus noise. So the top layers learn something, and the
+# rounds select variants the way they do on real data. Labels follow data_processing_VEP.ipynb: fitness_scaled is
+# min-max scaled and fitness_binary marks fitness above the 90th percentile. Layouts, in the paths read_data reads:
+#   labels:      {base_path}/labels/{dataset_name}_labels.csv and hie_temp/{dataset_name}.csv (always written)
+#   csvs:        {base_path}/csvs/{dataset_name}.csv, variants x features
+#   pts:         {base_path}/pts/{dataset_name}.pt, {variant: {'average': tensor, 'mutated': tensor}}
+#   npys:        {base_path}/npys/{dataset_name}.npy, the binary embedding store of embedding_store.py
+#   per_variant: {base_path}/per_variant/{dataset_name}/model/{variant}.pt, one file per variant like extract.py
+#                writes them, the input of esm-extract/concatenate.py
+# Dataset names have no underscore, so every layout reads the same labels.
+
+# Library sizes (variants x embedding dimension)
+SIZES = {'small': (1000, 320), 'brenan': (6800, 1280), 'r2': (22000, 5120)}
+LAYOUTS = ('csvs', 'pts', 'npys', 'per_variant')
+
+AMINO_ACIDS = 'ACDEFGHIKLMNPQRSTVWY'
+# Dimension of the latent fitness signal
+LATENT_DIM = 16
+# Variants of the representative_hie first round
+NUM_HIE_VARIANTS = 96
+# Rows generated at a time, which bounds the memory of the float64 intermediates on large libraries
+CHUNK_ROWS = 4096
+
+# Create the parser for the command line arguments
+def create_parser():
+    parser = argparse.ArgumentParser(description="Generate a synthetic DMS dataset in the layouts read by grid_search.py.")
+    parser.add_argument("--base_path", type=str, default="bench_data", help="Base path of the dataset. Default: bench_data")
+    parser.add_argument("--size", type=str, default="brenan", help=f"Library size. Options: {' '.join(SIZES)}. Default: brenan")
+    parser.add_argument("--num_variants", type=int, default=None, help="Number of variants, instead of the one of --size")
+    parser.add_argument("--embedding_dim", type=int, default=None, help="Embedding dimension, instead of the one of --size")
+    parser.add_argument("--dataset_name", type=str, default=None, help="Name of the dataset. Default: synthetic-{num_variants}x{embedding_dim}")
+    parser.add_argument("--layouts", type=str, nargs="+", default=["csvs", "pts", "npys"], help=f"Layouts to write. Options: {' '.join(LAYOUTS)}. Default: csvs pts npys")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed. Default: 0")
+    return parser
+
+# Function to get the (num_variants, embedding_dim) of a size, with optional overrides
+def library_size(size='brenan', num_variants=None, embedding_dim=None):
+    if size not in SIZES:
+        raise ValueError(f"Invalid size '{size}'. Please choose one of {', '.join(SIZES)}")
+    default_variants, default_dim = SIZES[size]
+    return num_variants or default_variants, embedding_dim or default_dim
+
+# Function to get the default name of a dataset
+def dataset_name_for(num_variants, embedding_dim):
+    return f"synthetic-{num_variants}x{embedding_dim}"
+
+# Function to list num_variants single mutants of a random WT sequence, sorted like the rows of a store
+def synthetic_variants(num_variants, rng):
+    wt = rng.choice(list(AMINO_ACIDS), size=math.ceil(num_variants / (len(AMINO_ACIDS) - 1)))
+    variants = [f"{wt_aa}{position + 1}{aa}" for position, wt_aa in enumerate(wt) for aa in AMINO_ACIDS if aa != wt_aa]
+    return sorted(variants[:num_variants])
+
+class SyntheticLibrary:
+    def __init__(self, num_variants, embedding_dim, seed=0):
+        rng = np.random.default_rng(seed)
+        self.variants = synthetic_variants(num_variants, rng)
+        self.embedding_dim = embedding_dim
+        self.seed = seed
+        self.latent = rng.normal(size=(num_variants, LATENT_DIM))
+        # fitness: a few latent directions with an interaction and noise, so a linear top layer is not exact
+        weights = rng.normal(size=LATENT_DIM)
+        fitness = self.latent @ weights + 0.5 * np.tanh(self.latent[:, 0] * self.latent[:, 1]) + 0.3 * rng.normal(size=num_variants)
+        fitness_scaled = (fitness - fitness.min()) / (fitness.max() - fitness.min())
+        self.labels = pd.DataFrame({'variant': self.variants, 'fitness': fitness, 'fitness_scaled': fitness_scaled,
+                                    'fitness_binary': (fitness > np.quantile(fitness, 0.9)).astype(int)})
+        self.projection = rng.normal(size=(LATENT_DIM, embedding_dim)) / np.sqrt(LATENT_DIM)
+
+    # Function to generate the float32 embeddings of a view ('average' or 'mutated') chunk by chunk, yields (start, rows)
+    def embedding_chunks(self, view='average'):
+        rng = np.random.default_rng([self.seed, 0 if view == 'average' else 1])
+        for start in range(0, len(self.variants), CHUNK_ROWS):
+            latent = self.latent[start:start + CHUNK_ROWS]
+            rows = latent @ self.projection + rng.normal(size=(len(latent), self.embedding_dim))
+            yield start, rows.astype(np.float32)
+
+    # Function to get the float32 embeddings of a view as one matrix
+    def embeddings(self, view='average'):
+        matrix = np.empty((len(self.variants), self.embedding_dim), dtype=np.float32)
+        for start, rows in self.embedding_chunks(view):
+            matrix[start:start + len(rows)] = rows
+        return matrix
+
+# Function to write the labels and the representative_hie variants
+def write_labels(library, base_path, dataset_name):
+    os.makedirs(os.path.join(base_path, 'labels'), exist_ok=True)
+    os.makedirs(os.path.join(base_path, 'hie_temp'), exist_ok=True)
+    library.labels.to_csv(os.path.join(base_path, 'labels', f"{dataset_name}_labels.csv"), index=False)
+    hie_variants = np.random.default_rng(library.seed).choice(library.variants, size=min(NUM_HIE_VARIANTS, len(library.variants)), replace=False)
+    pd.DataFrame({'variant': hie_variants}).to_csv(os.path.join(base_path, 'hie_temp', f"{dataset_name}.csv"), index=False)
+
+# Function to write the embeddings as a csv, chunk by chunk
+def write_csvs(library, base_path, dataset_name):
+    os.makedirs(os.path.join(base_path, 'csvs'), exist_ok=True)
+    with open(os.path.join(base_path, 'csvs', f"{dataset_name}.csv"), 'w') as f:
+        for start, rows in library.embedding_chunks():
+            pd.DataFrame(rows, index=library.variants[start:start + len(rows)]).to_csv(f, header=start == 0)
+
+# Function to write the average and mutated embeddings as a pt file
+def write_pts(library, base_path, dataset_name):
+    import torch
+
+    os.makedirs(os.path.join(base_path, 'pts'), exist_ok=True)
+    average, mutated = torch.from_numpy(library.embeddings('average')), torch.from_numpy(library.embeddings('mutated'))
+    embeddings = {variant: {'average': average[i].clone(), 'mutated': mutated[i].clone()} for i, variant in enumerate(library.variants)}
+    torch.save(embeddings, os.path.join(base_path, 'pts', f"{dataset_name}.pt"))
+
+# Function to write the embeddings as a binary store, like embedding_store.py converts a csv
+def write_npys(library, base_path, dataset_name):
+    os.makedirs(os.path.join(base_path, 'npys'), exist_ok=True)
+    prefix = os.path.join(base_path, 'npys', dataset_name)
+    matrix_path, _, _ = store_paths(prefix)
+    shape = (len(library.variants), library.embedding_dim)
+    matrix = np.lib.format.open_memmap(matrix_path, mode='w+', dtype=np.float32, shape=shape)
+    for start, rows in library.embedding_chunks():
+        matrix[start:start + len(rows)] = rows
+    matrix.flush()
+    del matrix
+    write_store_index(prefix, library.variants, shape, np.float32, {'embeddings': [0, shape[1]]}, source='csvs')
+
+# Function to write one .pt file per variant, with the mean representation of the last layer like extract.py
+def write_per_variant(library, base_path, dataset_name):
+    import torch
+
+    model_path = os.path.join(base_path, 'per_variant', dataset_name, 'model')
+    os.makedirs(model_path, exist_ok=True)
+    for start, rows in library.embedding_chunks():
+        for variant, row in zip(library.variants[start:start + len(rows)], rows):
+            torch.save({'label': variant, 'mean_representations': {33: torch.from_numpy(row.copy())}},
+                       os.path.join(model_path, f"{variant}.pt"))
+
+# Function to generate a dataset in the given layouts, returns its name
+def generate_dataset(base_path, num_variants, embedding_dim, layouts=('csvs', 'pts', 'npys'), dataset_name=None, seed=0):
+    dataset_name = dataset_name or dataset_name_for(num_variants, embedding_dim)
+    if '_' in dataset_name:
+        raise ValueError(f"Invalid dataset name '{dataset_name}': read_data takes the labels name from before/after an underscore")
+    writers = {'csvs': write_csvs, 'pts': write_pts, 'npys': write_npys, 'per_variant': write_per_variant}
+    library = SyntheticLibrary(num_variants, embedding_dim, seed=seed)
+    write_labels(library, base_path, dataset_name)
+    for layout in layouts:
+        if layout not in writers:
+            raise ValueError(f"Invalid layout '{layout}'. Please choose from {', '.join(LAYOUTS)}")
+        writers[layout](library, base_path, dataset_name)
+    return dataset_name
+
+def main():
+    parser = create_parser()
+    args = parser.parse_args()
+
+    num_variants, embedding_dim = library_size(args.size, args.num_variants, args.embedding_dim)
+    dataset_name = generate_dataset(args.base_path, num_variants, embedding_dim, args.layouts, args.dataset_name, args.seed)
+    print(f"Wrote {dataset_name} ({num_variants} variants x {embedding_dim} features) to {args.base_path}: {' '.join(args.layouts)}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,31 @@
+import os
+import sys
+
+import pytest
+
+# The grid_search scripts import each other as top-level modules
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from synthetic_data import SyntheticLibrary, generate_dataset
+
+# Small synthetic library: fewer training variants than features in every round, like the real grids
+NUM_VARIANTS = 300
+EMBEDDING_DIM = 48
+
+@pytest.fixture(scope='session')
+def library():
+    return SyntheticLibrary(NUM_VARIANTS, EMBEDDING_DIM, seed=0)
+
+# Base path with the dataset in the csvs, pts and npys layouts, returns (base_path, dataset_name)
+@pytest.fixture(scope='session')
+def synthetic_base(tmp_path_factory):
+    base_path = str(tmp_path_factory.mktemp('base'))
+    dataset_name = generate_dataset(base_path, NUM_VARIANTS, EMBEDDING_DIM, layouts=('csvs', 'pts', 'npys'))
+    return base_path, dataset_name
+
+# Working directory with the results/ folder grid_search.py writes to
+@pytest.fixture
+def results_cwd(tmp_path, monkeypatch):
+    os.makedirs(tmp_path / 'results')
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
@@ -0,0 +1,64 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+import torch
+
+from embedding_store import convert_csv, convert_pt, open_store, store_paths, write_store_index
+
+def test_csv_round_trip(synthetic_base, tmp_path):
+    base_path, dataset_name = synthetic_base
+    csv = pd.read_csv(os.path.join(base_path, 'csvs', f"{dataset_name}.csv"), index_col=0)
+    # shuffled rows, the store sorts them by variant
+    shuffled = os.path.join(tmp_path, 'shuffled.csv')
+    csv.sample(frac=1, random_state=0).to_csv(shuffled)
+
+    convert_csv(shuffled, str(tmp_path / 'store'), chunksize=64)
+    matrix, variants, meta = open_store(str(tmp_path / 'store'))
+    assert variants == sorted(csv.index)
+    assert meta['source'] == 'csvs'
+    np.testing.assert_array_equal(matrix, csv.loc[variants].to_numpy(dtype=np.float32))
+
+def test_pt_round_trip(synthetic_base, tmp_path):
+    base_path, dataset_name = synthetic_base
+    pt_file = os.path.join(base_path, 'pts', f"{dataset_name}.pt")
+    embeddings = torch.load(pt_file)
+
+    convert_pt(pt_file, str(tmp_path / 'store'))
+    for view in ('average', 'mutated'):
+        matrix, variants, _ = open_store(str(tmp_path / 'store'), view=view)
+        assert variants == sorted(embeddings)
+        np.testing.assert_array_equal(matrix, np.stack([embeddings[variant][view].numpy() for variant in variants]))
+
+def test_synthetic_npys_match_csvs(synthetic_base, library):
+    base_path, dataset_name = synthetic_base
+    matrix, variants, _ = open_store(os.path.join(base_path, 'npys', dataset_name))
+    assert variants == library.variants
+    np.testing.assert_array_equal(matrix, library.embeddings())
+
+# Store of 4 variants whose index is then tampered with
+@pytest.fixture
+def small_store(tmp_path):
+    prefix = str(tmp_path / 'store')
+    matrix_path, variants_path, _ = store_paths(prefix)
+    np.save(matrix_path, np.arange(12, dtype=np.float32).reshape(4, 3))
+    write_store_index(prefix, ['A1C', 'A1D', 'A1E', 'WT'], (4, 3), np.float32, {'embeddings': [0, 3]}, source='csvs')
+    return prefix, matrix_path, variants_path
+
+def test_rejects_a_reordered_index(small_store):
+    prefix, _, variants_path = small_store
+    # same number of rows, so only the hash tells the index changed
+    with open(variants_path, 'w') as f:
+        f.write('A1D\nA1C\nA1E\nWT\n')
+    with pytest.raises(ValueError, match='variant index does not match'):
+        open_store(prefix)
+
+def test_rejects_a_matrix_of_another_shape(small_store):
+    prefix, matrix_path, _ = small_store
+    np.save(matrix_path, np.zeros((5, 3), dtype=np.float32))
+    with pytest.raises(ValueError, match='shape'):
+        open_store(prefix)
+
+def test_leaves_no_temporary_files(small_store, tmp_path):
+    assert not [name for name in os.listdir(tmp_path) if name.endswith('.tmp')]
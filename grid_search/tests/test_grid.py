@@ -0,0 +1,70 @@
+import sys
+
+import pandas as pd
+import pytest
+
+import grid_search
+import merge_shards
+from sharding import estimate_simulation_cost, shard_simulations, shard_unit
+
+# A small grid with every learning strategy and a few num_iterations, so that prefixes are shared
+def grid_arguments(base_path, dataset_name, *extra):
+    return ['--dataset_name', dataset_name, '--base_path', base_path, '--file_type', 'npys',
+            '--num_simulations', '3', '--num_iterations', '2', '3', '4', '--measured_var', 'fitness', 'fitness_scaled',
+            '--learning_strategies', 'random', 'top5bottom5', 'top10', 'dist', '--num_mutants_per_round', '8',
+            '--first_round_strategies', 'random', '--embedding_types', 'embeddings', '--regression_types', 'ridge',
+            *extra]
+
+# Function to run a script's main with the given command line, returns the results csv of the grid
+def run_main(monkeypatch, main, arguments, dataset_name):
+    monkeypatch.setattr(sys, 'argv', ['grid_search.py'] + arguments)
+    main()
+    return pd.read_csv(f"{grid_search.results_prefix(dataset_name)}.csv")
+
+@pytest.fixture
+def separate_results(synthetic_base, results_cwd, monkeypatch):
+    base_path, dataset_name = synthetic_base
+    return run_main(monkeypatch, grid_search.main, grid_arguments(base_path, dataset_name), dataset_name)
+
+def test_share_prefixes_matches_separate_runs(synthetic_base, separate_results, monkeypatch):
+    base_path, dataset_name = synthetic_base
+    shared = run_main(monkeypatch, grid_search.main, grid_arguments(base_path, dataset_name, '--share_prefixes'), dataset_name)
+    pd.testing.assert_frame_equal(shared, separate_results, check_exact=True)
+
+def test_merged_shards_match_an_unsharded_run(synthetic_base, separate_results, monkeypatch):
+    base_path, dataset_name = synthetic_base
+    for shard_index in range(2):
+        arguments = grid_arguments(base_path, dataset_name, '--num_shards', '2', '--shard_index', str(shard_index))
+        monkeypatch.setattr(sys, 'argv', ['grid_search.py'] + arguments)
+        grid_search.main()
+    merged = run_main(monkeypatch, merge_shards.main, grid_arguments(base_path, dataset_name, '--num_shards', '2'), dataset_name)
+    pd.testing.assert_frame_equal(merged, separate_results, check_exact=True)
+
+def test_merge_fails_on_a_missing_shard(synthetic_base, results_cwd, monkeypatch):
+    base_path, dataset_name = synthetic_base
+    monkeypatch.setattr(sys, 'argv', ['grid_search.py'] + grid_arguments(base_path, dataset_name, '--num_shards', '2', '--shard_index', '0'))
+    grid_search.main()
+    with pytest.raises(FileNotFoundError):
+        run_main(monkeypatch, merge_shards.main, grid_arguments(base_path, dataset_name, '--num_shards', '2'), dataset_name)
+
+def test_shards_partition_the_grid():
+    combinations = grid_search.expand_combinations(['random', 'top10'], ['fitness'], [2, 5], [8, 16], ['embeddings'],
+                                                   ['ridge', 'randomforest'], ['random'])
+    simulations = [(combination, seed) for combination in combinations for seed in grid_search.simulation_seeds(4)]
+    for num_shards in (1, 3, 7):
+        shards = [shard_simulations(simulations, shard_index, num_shards) for shard_index in range(num_shards)]
+        assert sum(len(shard) for shard in shards) == len(simulations)
+        assert set().union(*shards) == set(simulations)
+        # longest processing time first: the estimated loads differ by at most the cost of one unit
+        loads = [sum(estimate_simulation_cost(combination) for combination, _ in shard) for shard in shards]
+        unit_costs = {}
+        for combination, seed in simulations:
+            unit = shard_unit(combination, seed)
+            unit_costs[unit] = unit_costs.get(unit, 0) + estimate_simulation_cost(combination)
+        assert max(loads) - min(loads) <= max(unit_costs.values())
+        # the simulations of a unit share a fit cache, so they stay on one shard
+        shards_of_unit = {}
+        for shard_index, shard in enumerate(shards):
+            for combination, seed in shard:
+                shards_of_unit.setdefault(shard_unit(combination, seed), set()).add(shard_index)
+        assert all(len(unit_shards) == 1 for unit_shards in shards_of_unit.values())
@@ -0,0 +1,46 @@
+import os
+
+import pandas as pd
+import pytest
+
+from long_results import FLOAT_COLUMNS, INT_COLUMNS, STRING_COLUMNS, LongResults, open_results_writer
+
+# Metrics of one round of a simulation, in the layout of directed_evolution_simulation
+def simulation_metrics(library, simulation_num):
+    row = {'simulation_num': simulation_num, 'round_num': 1, 'num_mutants_per_round': 2}
+    row.update({column: 'random' for column in STRING_COLUMNS})
+    row.update({column: 0.5 for column in FLOAT_COLUMNS})
+    row.update({'test_error': 'None', 'labels': ','.join(library.variants[:2]), 'top_variant': library.variants[1]})
+    return pd.DataFrame([row], columns=INT_COLUMNS + STRING_COLUMNS + FLOAT_COLUMNS + ['labels', 'top_variant'])
+
+# Function to read the simulation numbers of csv or parquet results
+def read_simulations(path, output_format):
+    if output_format == 'csv':
+        return pd.read_csv(path + '.csv').simulation_num.tolist()
+    return LongResults(path).read(['simulation_num']).simulation_num.tolist()
+
+@pytest.mark.parametrize('output_format', ['csv', 'parquet'])
+def test_a_rerun_keeps_the_results_of_a_killed_run(library, tmp_path, output_format):
+    if output_format == 'parquet':
+        pytest.importorskip('pyarrow')
+    prefix = str(tmp_path / 'results')
+    extension = '.csv' if output_format == 'csv' else ''
+
+    writer = open_results_writer(prefix, output_format, library.variants)
+    writer.write(simulation_metrics(library, 1))
+    writer.flush()
+    writer.close()
+    # killed after two simulations: never closed
+    writer = open_results_writer(prefix, output_format, library.variants)
+    for simulation_num in (2, 3):
+        writer.write(simulation_metrics(library, simulation_num))
+        writer.flush()
+    assert read_simulations(prefix, output_format) == [1]
+
+    writer = open_results_writer(prefix, output_format, library.variants)
+    writer.write(simulation_metrics(library, 4))
+    writer.flush()
+    writer.close()
+    assert read_simulations(prefix, output_format) == [4]
+    assert read_simulations(f"{prefix}.killed-1", output_format) == [2, 3]
+    assert sorted(os.listdir(tmp_path)) == sorted([f"results{extension}", f"results.killed-1{extension}"])
@@ -0,0 +1,44 @@
+import numpy as np
+import pytest
+from sklearn.linear_model import RidgeCV
+
+from batched_ridge import RIDGE_ALPHAS, fit_ridge_gcv_batched
+from incremental_models import IncrementalRidgeCV
+
+# Training sets of a few rounds of one simulation: every round adds batch_size variants
+def growing_training_sets(num_variants, sizes, seed):
+    order = np.random.default_rng(seed).permutation(num_variants)
+    return [np.sort(order[:size]) for size in sizes]
+
+def assert_same_ridge(model, reference, X):
+    assert model.alpha_ == reference.alpha_
+    np.testing.assert_allclose(model.coef_, reference.coef_, rtol=1e-7, atol=1e-9)
+    np.testing.assert_allclose(model.intercept_, reference.intercept_, rtol=1e-7, atol=1e-9)
+    np.testing.assert_allclose(model.predict(X), reference.predict(X), rtol=1e-7, atol=1e-9)
+
+@pytest.mark.parametrize('measured_var', ['fitness', 'fitness_scaled'])
+def test_batched_ridge_matches_ridgecv(library, measured_var):
+    X = library.embeddings().astype(np.float64)
+    y = library.labels[measured_var].to_numpy()
+    idx_train_list = [np.sort(np.random.default_rng(seed).choice(len(X), 24, replace=False)) for seed in range(6)]
+
+    models = fit_ridge_gcv_batched(np.stack([X[idx] for idx in idx_train_list]), np.stack([y[idx] for idx in idx_train_list]))
+    for model, idx_train in zip(models, idx_train_list):
+        assert_same_ridge(model, RidgeCV(alphas=RIDGE_ALPHAS).fit(X[idx_train], y[idx_train]), X)
+
+def test_incremental_ridge_matches_refit(library):
+    X = library.embeddings().astype(np.float64)
+    y = library.labels['fitness'].to_numpy()
+    ridge = IncrementalRidgeCV(alphas=RIDGE_ALPHAS)
+    for idx_train in growing_training_sets(len(X), [9, 17, 25, 33], seed=1):
+        model = ridge.fit(X[idx_train], y[idx_train], idx_train)
+        assert_same_ridge(model, RidgeCV(alphas=RIDGE_ALPHAS).fit(X[idx_train], y[idx_train]), X)
+
+def test_incremental_ridge_restarts_when_the_training_set_shrinks(library):
+    X = library.embeddings().astype(np.float64)
+    y = library.labels['fitness'].to_numpy()
+    ridge = IncrementalRidgeCV(alphas=RIDGE_ALPHAS)
+    large, small = growing_training_sets(len(X), [30, 12], seed=2)
+    ridge.fit(X[large], y[large], large)
+    model = ridge.fit(X[small], y[small], small)
+    assert_same_ridge(model, RidgeCV(alphas=RIDGE_ALPHAS).fit(X[small], y[small]), X)
@@ -0,0 +1,36 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from grid_search import argsort_descending, top_k_descending
+
+# Predictions with ties (few distinct values), NaNs (a diverging model) or neither
+def predictions(rng, kind):
+    n = int(rng.integers(1, 80))
+    if kind == 'continuous':
+        return rng.normal(size=n)
+    values = rng.integers(0, 6, size=n).astype(np.float64)
+    if kind == 'nan':
+        values[rng.random(n) < 0.2] = np.nan
+    return values
+
+@pytest.mark.parametrize('kind', ['continuous', 'ties', 'nan'])
+def test_argsort_descending_matches_pandas(kind):
+    rng = np.random.default_rng(0)
+    for _ in range(300):
+        values = predictions(rng, kind)
+        expected = pd.Series(values).sort_values(ascending=False).index.to_numpy()
+        np.testing.assert_array_equal(argsort_descending(values), expected)
+
+@pytest.mark.parametrize('kind', ['continuous', 'ties', 'nan'])
+def test_top_k_descending_matches_a_full_sort(kind):
+    rng = np.random.default_rng(1)
+    for _ in range(300):
+        values = predictions(rng, kind)
+        k = int(rng.integers(0, len(values) + 2))
+        assert set(top_k_descending(values, k)) == set(argsort_descending(values)[:k])
+
+def test_nan_predictions_are_picked_last():
+    values = np.array([0.5, np.nan, 0.9, 0.1])
+    np.testing.assert_array_equal(argsort_descending(values), [2, 0, 3, 1])
+    assert set(top_k_descending(values, 2)) == {0, 2}
@@ -0,0 +1,123 @@
+import json
+import os
+import resource
+import sys
+import time
+from contextlib import nullcontext
+
+import pandas as pd
+
+# Opt-in timing trace of grid_search.py (--trace). Every stage of the run (reading and preprocessing the data, first
+# rounds, the fit, predict and metrics of each top layer round, the variant selection and distance updates of each
+# round) runs in a span that records its wall time, CPU time (of the whole process, so BLAS threads count) and the
+# peak RSS of the process at its end, labeled with the grid cell (combination) it ran for. Workers of the process
+# pool send their spans back with their results. At the end of the run the spans are written as a Chrome trace
+# (open in chrome://tracing or https://ui.perfetto.dev, one track per process) with a per-stage summary csv and a
+# per-cell csv next to it. Spans nest, so the time of a stage includes the stages inside it.
+# When tracing is off span() returns a shared no-op context, so the instrumented code only pays a function call.
+
+_NULL_SPAN = nullcontext()
+
+# spans recorded in this process, None when tracing is off
+_events = None
+# grid cell of the spans recorded from now on
+_cell = None
+
+# Function to start recording spans in this process, dropping the ones recorded so far (e.g. inherited by a forked
+# worker)
+def start():
+    global _events, _cell
+    _events = []
+    _cell = None
+
+# Function to know if spans are recorded
+def enabled():
+    return _events is not None
+
+# Function to label the spans recorded from now on with a grid cell
+def set_cell(cell):
+    global _cell
+    _cell = cell
+
+# Function to get the peak RSS of this process in MB
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on macOS
+    return peak / 2**20 if sys.platform == 'darwin' else peak / 2**10
+
+class _Span:
+    __slots__ = ('name', 'start', 'wall', 'cpu')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+        self.wall = time.perf_counter()
+        self.cpu = time.process_time()
+        return self
+
+    def __exit__(self, *exc_info):
+        wall = time.perf_counter() - self.wall
+        cpu = time.process_time() - self.cpu
+        _events.append((self.name, _cell, os.getpid(), self.start, wall, cpu, peak_rss_mb()))
+        return False
+
+# Function to time a stage, e.g. with tracing.span('fit'): ...
+def span(name):
+    if _events is None:
+        return _NULL_SPAN
+    return _Span(name)
+
+# Function to take the spans recorded so far, e.g. to send them from a worker to the main process
+def drain():
+    if _events is None:
+        return []
+    events = list(_events)
+    _events.clear()
+    return events
+
+# Function to add the spans recorded by another process
+def add(events):
+    if _events is not None:
+        _events.extend(events)
+
+# Function to get the spans as a DataFrame
+def events_frame(events):
+    return pd.DataFrame(events, columns=['stage', 'cell', 'pid', 'start', 'wall_seconds', 'cpu_seconds', 'peak_rss_mb'])
+
+# Function to summarize the spans per stage: calls, total and mean wall time, total CPU time and the largest peak RSS
+# of a process at the end of the stage, slowest stages first
+def summarize(events):
+    df = events_frame(events)
+    summary = df.groupby('stage').agg(calls=('wall_seconds', 'size'), wall_seconds=('wall_seconds', 'sum'),
+                                      cpu_seconds=('cpu_seconds', 'sum'), mean_wall_ms=('wall_seconds', 'mean'),
+                                      peak_rss_mb=('peak_rss_mb', 'max'))
+    summary['mean_wall_ms'] *= 1000
+    return summary.sort_values('wall_seconds', ascending=False)
+
+# Function to summarize the wall time of every stage per grid cell, slowest cells first
+def summarize_cells(events):
+    df = events_frame(events)
+    df = df[df['cell'].notna()]
+    cells = df.pivot_table(index='cell', columns='stage', values='wall_seconds', aggfunc='sum', fill_value=0)
+    cells['peak_rss_mb'] = df.groupby('cell')['peak_rss_mb'].max()
+    order = cells.get('simulation', cells.drop(columns='peak_rss_mb').sum(axis=1)).sort_values(ascending=False).index
+    return cells.loc[order]
+
+# Function to write the spans as a Chrome trace (complete events in microseconds from the first span) and the stage
+# and cell summaries as {path without .json}_summary.csv and _cells.csv. Returns the stage summary
+def write_trace(path, events):
+    origin = min((event[3] for event in events), default=0)
+    trace_events = [{'name': stage, 'cat': 'grid_search', 'ph': 'X', 'pid': pid, 'tid': pid,
+                     'ts': (start - origin) * 1e6, 'dur': wall * 1e6,
+                     'args': {'cell': cell, 'cpu_ms': cpu * 1000, 'peak_rss_mb': peak_rss}}
+                    for stage, cell, pid, start, wall, cpu, peak_rss in events]
+    with open(path, 'w') as f:
+        json.dump({'traceEvents': trace_events, 'displayTimeUnit': 'ms'}, f)
+
+    prefix = path[:-len('.json')] if path.endswith('.json') else path
+    summary = summarize(events)
+    summary.to_csv(f"{prefix}_summary.csv")
+    summarize_cells(events).to_csv(f"{prefix}_cells.csv")
+    return summary